@@ -0,0 +1,292 @@
+'''Benchmarks of the hot paths of the model: building lattices,
+finding shortest paths, moving cars, and cutting streets. Every
+benchmark uses fixed seeds, so two runs do the same work, and the
+results are written as JSON that later runs can be compared against:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+
+The second command exits with status 1 if any measurement regressed
+by more than the tolerance.'''
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+from traffic_components import *
+from simulation import Simulation
+
+
+
+# The version of the format of the results.
+RESULTS_FORMAT = 1
+
+
+
+def lattice_construction(quick=False):
+    '''Times square_lattice at several sizes, with and without
+    objects.'''
+
+    sizes = (10, 30) if quick else (10, 100, 300)
+    results = dict()
+    for size in sizes:
+        for compact in (False, True):
+            if size > 100 and not compact:
+                continue
+            times = _timings(lambda: StreetNetwork.square_lattice(
+                size, size, compact=compact), 3)
+            name = '{}x{}_{}'.format(size, size,
+                                     'compact' if compact else 'objects')
+            results[name] = _summary(times)
+    return results
+
+
+
+def shortest_path_latency(quick=False):
+    '''Times shortest_path queries between random pairs of
+    intersections, with an empty route cache, on a lattice with random
+    weights and on a random graph.'''
+
+    size = 20 if quick else 60
+    n_queries = 10 if quick else 100
+    rng = np.random.RandomState(0)
+    weights = [ rng.uniform(1, 2, shape) for shape in
+                ((size - 1, size), (size, size - 1)) * 2 ]
+    networks = { 'lattice':StreetNetwork.square_lattice(size, size, *weights,
+                                                        compact=True),
+                 'random_graph':random_network(size * size, 4, seed=1) }
+
+    results = dict()
+    for name, network in networks.items():
+        n = network.compact_graph().n_intersections
+        pairs = np.random.RandomState(2).randint(0, n, (n_queries, 2))
+        algorithms = ['dijkstra', 'bidirectional']
+        if network.lattice is not None:
+            algorithms.append('astar')
+        for algorithm in algorithms:
+            times = []
+            for source, destination in pairs.tolist():
+                source = network.intersections[source]
+                destination = network.intersections[destination]
+                network.routes.clear()
+                start = time.perf_counter()
+                try:
+                    network.shortest_path(source, destination, algorithm)
+                except DisconnectedPathError:
+                    pass
+                times.append(time.perf_counter() - start)
+            results['{}_{}'.format(name, algorithm)] = _summary(times)
+    return results
+
+
+
+def car_movement(quick=False):
+    '''Measures the car movements per second of a simulation of many
+    cars queued on a lattice, as Car objects and as a CarPopulation.'''
+
+    size = 20 if quick else 100
+    n_cars = 500 if quick else 20000
+    n_ticks = 5 if quick else 20
+
+    results = dict()
+    for kind in ('objects', 'population'):
+        # The trips run between a few zones, so that routing them
+        # does not dominate.
+        network = StreetNetwork.square_lattice(size, size, compact=True)
+        zones = np.zeros(size * size)
+        zones[::97] = 1
+        demand = network.random_od_matrix(n_cars, seed=3, weights=zones)
+        if kind == 'objects':
+            population = network.spawn_from_od_matrix(demand)
+            paths = [ population.path_ids(car).copy()
+                      for car in range(population.size) ]
+            network = StreetNetwork.square_lattice(size, size, compact=True)
+            for path in paths:
+                Car(network.streets_of(path), network)
+        else:
+            network.spawn_from_od_matrix(demand)
+
+        simulation = Simulation(network)
+        simulation.run(n_ticks)
+        results[kind] = { 'moves':simulation.moves,
+                          'seconds':simulation.elapsed,
+                          'moves_per_second':simulation.throughput }
+    return results
+
+
+
+def street_cutting(quick=False):
+    '''Times cut_street on a dense random network of objects, and
+    closing and reopening many streets at once with cut_streets and
+    restore_streets.'''
+
+    n = 200 if quick else 2000
+    n_cuts = 20 if quick else 200
+    network = random_network(n, 20, seed=4, compact=False)
+    network.compact_graph()
+    rng = np.random.RandomState(5)
+    streets = [ network.streets[i] for i in
+                rng.choice(len(network.streets), n_cuts, replace=False) ]
+    times = []
+    for street in streets:
+        start = time.perf_counter()
+        network.cut_street(street)
+        times.append(time.perf_counter() - start)
+    results = { 'cut_street':_summary(times) }
+
+    # Closure scenarios of a tenth of the streets each.
+    network.restore_streets(streets)
+    scenarios = [ [ network.streets[i] for i in rng.choice(
+                      len(network.streets), len(network.streets) // 10,
+                      replace=False) ]
+                  for _ in range(3) ]
+    def close_and_reopen():
+        for closed in scenarios:
+            network.cut_streets(closed)
+            network.restore_streets(closed)
+    results['closure_scenarios'] = _summary(_timings(close_and_reopen, 3))
+    return results
+
+
+
+BENCHMARKS = { 'lattice_construction':lattice_construction,
+               'shortest_path_latency':shortest_path_latency,
+               'car_movement':car_movement,
+               'street_cutting':street_cutting }
+
+
+
+def random_network(n_intersections, degree, seed=0, compact=True):
+    '''Builds a network of n_intersections intersections, each with
+    degree streets to random other intersections, with random
+    weights.'''
+
+    rng = np.random.RandomState(seed)
+    tail = np.repeat(np.arange(n_intersections), degree)
+    head = (tail + rng.randint(1, n_intersections, len(tail))) \
+        % n_intersections
+    weight = rng.uniform(1, 2, len(tail))
+    if compact:
+        return StreetNetwork.from_graph(CompactGraph(n_intersections, tail,
+                                                     head, weight))
+    intersections = [ Intersection(i) for i in range(n_intersections) ]
+    streets = [ Street(intersections[a], intersections[b], w)
+                for a, b, w in zip(tail.tolist(), head.tolist(),
+                                   weight.tolist()) ]
+    return StreetNetwork.no_cars(intersections, streets)
+
+
+
+def run(names=None, quick=False):
+    '''Runs the named benchmarks, or all of them, and returns their
+    results together with a description of the machine.'''
+
+    names = list(BENCHMARKS) if names is None else names
+    return { 'format':RESULTS_FORMAT,
+             'python':platform.python_version(),
+             'numpy':np.__version__,
+             'machine':platform.machine(),
+             'quick':quick,
+             'benchmarks':{ name:BENCHMARKS[name](quick)
+                            for name in names } }
+
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''Compares results with a baseline from an earlier run. Returns a
+    list of (benchmark, case, measurement, baseline value, value) for
+    every measurement that got worse by more than the tolerance, a
+    fraction: times that grew, or rates (measurements per_second)
+    that fell. Only medians, totals, and rates are compared.'''
+
+    regressions = []
+    for name, cases in results['benchmarks'].items():
+        for case, measurements in cases.items():
+            old = baseline.get('benchmarks', {}).get(name, {}).get(case)
+            if old is None:
+                continue
+            for measurement, value in measurements.items():
+                if measurement not in ('median', 'seconds',
+                                       'moves_per_second'):
+                    continue
+                before = old.get(measurement)
+                if before is None or before == 0:
+                    continue
+                if measurement.endswith('per_second'):
+                    worse = value < before * (1 - tolerance)
+                else:
+                    worse = value > before * (1 + tolerance)
+                if worse:
+                    regressions.append((name, case, measurement, before,
+                                        value))
+    return regressions
+
+
+
+def _timings(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+
+def _summary(times):
+    # Latency distribution in seconds.
+    times = np.asarray(times)
+    return { 'n':len(times),
+             'min':float(times.min()),
+             'median':float(np.median(times)),
+             'p90':float(np.percentile(times, 90)),
+             'p99':float(np.percentile(times, 99)),
+             'max':float(times.max()),
+             'mean':float(times.mean()) }
+
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='the benchmarks to run: {} (default: all)'
+                        .format(', '.join(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true',
+                        help='use small sizes, for a smoke test')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare the results with this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the fraction by which a measurement may'
+                        ' get worse than the baseline')
+    arguments = parser.parse_args(arguments)
+    for name in arguments.names:
+        if name not in BENCHMARKS:
+            parser.error('there is no benchmark called {}'.format(name))
+
+    results = run(arguments.names or None, arguments.quick)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, arguments.tolerance)
+        for name, case, measurement, before, value in regressions:
+            print('{} {} {}: {:.6g} -> {:.6g}'.format(name, case,
+                                                      measurement, before,
+                                                      value),
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import numpy as np
+from traffic_components import *
+
+
+
+class CannotRestoreError(Exception): pass
+
+
+
+class Checkpoint:
+    '''The complete dynamic state of a simulation: the tick, and every
+    car's path, cursor, and place in its street's queue, for the Car
+    objects of the network and the cars of its CarPopulations alike,
+    which are numbered in that order. Streets are
+    recorded by id, so a checkpoint can be restored into any network
+    with the same streets, such as a fresh copy loaded from disk.
+    Paths are stored as one flat array of street ids with offsets:
+    car c's path is path_streets[path_offsets[c]:path_offsets[c+1]].
+    Queues are stored as the street id and car of every queue entry,
+    grouped by street, front first. Population cars that have not
+    departed yet are in no queue, and have their departure tick in
+    departure, which is -1 for the cars on the road. If the network
+    has traffic lights, the phase of every signal and the time spent
+    in it are recorded too, but the signal plans are not.'''
+
+    def __init__(self, tick, n_streets, path_streets, path_offsets, cursor,
+                 queue_streets, queue_cars, departure=None,
+                 signal_phase=None, signal_elapsed=None):
+        if departure is None:
+            departure = np.full(len(cursor), -1, dtype=np.int64)
+        self.tick = tick
+        self.departure = departure
+        self.signal_phase = signal_phase
+        self.signal_elapsed = signal_elapsed
+        self.n_streets = n_streets
+        self.path_streets = path_streets
+        self.path_offsets = path_offsets
+        self.cursor = cursor
+        self.queue_streets = queue_streets
+        self.queue_cars = queue_cars
+
+    @staticmethod
+    def cars_of(network):
+        '''Returns the cars of a network in the order in which a
+        checkpoint numbers them, and the index of the CarPopulation of
+        each one (-1 for Car objects).'''
+
+        cars = list(network.cars)
+        groups = [ -1 ] * len(cars)
+        for group, population in enumerate(network.populations):
+            status = population.status[:population.size]
+            current = np.flatnonzero((status == population.ACTIVE)
+                                     | (status == population.WAITING))
+            cars.extend(population.car(car) for car in current.tolist())
+            groups.extend([ group ] * len(current))
+        return cars, np.array(groups, dtype=np.int64)
+
+    @classmethod
+    def capture(cls, network, tick=0):
+        '''Records the state of the cars in a network.'''
+
+        # The paths of Car objects are converted to ids, and those of
+        # population cars are copied from their arrays.
+        cars = list(network.cars)
+        paths = [ np.fromiter((network.street_id(street)
+                               for street in car.path),
+                              dtype=np.int32, count=len(car.path))
+                  for car in cars ]
+        cursors = [ car.cursor for car in cars ]
+        departures = [ -1 ] * len(cars)
+        for population in network.populations:
+            status = population.status[:population.size]
+            current = np.flatnonzero((status == population.ACTIVE)
+                                     | (status == population.WAITING))
+            cars.extend(population.car(car) for car in current.tolist())
+            paths.extend(population.path_ids(car)
+                         for car in current.tolist())
+            cursors.extend(population.cursor[current].tolist())
+            departures.extend(np.where(status[current] == population.WAITING,
+                                       population.departure[current],
+                                       -1).tolist())
+        index = { car:i for i, car in enumerate(cars) }
+
+        path_offsets = np.zeros(len(cars) + 1, dtype=np.int64)
+        np.cumsum([ len(path) for path in paths ], out=path_offsets[1:])
+        path_streets = (np.concatenate(paths) if paths
+                        else np.zeros(0, dtype=np.int32))
+        cursor = np.array(cursors, dtype=np.int64)
+
+        streets = sorted(network.occupied, key=network.street_id)
+        queue_streets = np.repeat(
+            np.array([ network.street_id(street) for street in streets ],
+                     dtype=np.int32),
+            [ len(street.q) for street in streets ])
+        queue_cars = np.fromiter(
+            (index[car] for street in streets for car in street.q),
+            dtype=np.int64, count=len(queue_streets))
+
+        signal_phase = signal_elapsed = None
+        if network.signals is not None:
+            signal_phase = network.signals.phase.copy()
+            signal_elapsed = network.signals.elapsed.copy()
+
+        return cls(tick, network.compact_graph().n_streets, path_streets,
+                   path_offsets, cursor, queue_streets, queue_cars,
+                   np.array(departures, dtype=np.int64), signal_phase,
+                   signal_elapsed)
+
+    def restore(self, network, population=None):
+        '''Recreates the recorded cars in a network that has the same
+        streets and no cars, as Car objects, or as cars of the given
+        CarPopulation of the network. Returns the cars (or their
+        views) in their recorded order.'''
+
+        cars = len(network.cars) + sum(len(other) + other.waiting
+                                       for other in network.populations)
+        if cars > 0:
+            raise CannotRestoreError(
+                'A checkpoint can only be restored into a network'
+                ' without cars, but this one has {}.'.format(cars))
+        if network.compact_graph().n_streets != self.n_streets:
+            raise CannotRestoreError(
+                'The checkpoint has {} streets but the network has {}.'
+                .format(self.n_streets, network.compact_graph().n_streets))
+        if self.signal_phase is not None:
+            if network.signals is None:
+                raise CannotRestoreError(
+                    'The checkpoint has traffic lights, but the network'
+                    ' does not.')
+            network.signals.set_state(self.signal_phase, self.signal_elapsed)
+
+        waiting = np.flatnonzero(self.departure >= 0)
+        if population is not None:
+            # Adding the cars in queue order queues them correctly.
+            def paths(order):
+                return [ self.path_streets[self.path_offsets[car]:
+                                           self.path_offsets[car+1]]
+                         for car in order.tolist() ]
+            order = self.queue_cars
+            views = population.add_paths(paths(order), self.cursor[order])
+            first = population.size
+            population.add_paths(paths(waiting), self.cursor[waiting],
+                                 self.departure[waiting])
+            cars = [None] * len(self.cursor)
+            for car, view in zip(order.tolist(), views):
+                cars[car] = view
+            for i, car in enumerate(waiting.tolist()):
+                cars[car] = population.car(first + i)
+            return cars
+
+        if len(waiting) > 0:
+            raise CannotRestoreError(
+                'The checkpoint has {} cars that have not departed yet,'
+                ' which can only be restored into a CarPopulation.'
+                .format(len(waiting)))
+
+        # Turn every distinct street id into a street once.
+        ids, inverse = np.unique(self.path_streets, return_inverse=True)
+        streets = network.streets_of(ids)
+        path_streets = [ streets[i] for i in inverse.tolist() ]
+        offsets = self.path_offsets.tolist()
+        cursor = self.cursor.tolist()
+        cars = [ Car.restore(path_streets[offsets[c]:offsets[c+1]],
+                             cursor[c], network)
+                 for c in range(len(cursor)) ]
+
+        for car in self.queue_cars.tolist():
+            car = cars[car]
+            car.location.q.put(car)
+            network.occupied[car.location] = None
+        return cars
+
+    def save(self, path):
+        '''Writes the checkpoint to an .npz file.'''
+
+        np.savez(path, tick=np.array(self.tick),
+                 n_streets=np.array(self.n_streets),
+                 path_streets=self.path_streets,
+                 path_offsets=self.path_offsets, cursor=self.cursor,
+                 queue_streets=self.queue_streets,
+                 queue_cars=self.queue_cars, departure=self.departure,
+                 **({} if self.signal_phase is None else
+                    { 'signal_phase':self.signal_phase,
+                      'signal_elapsed':self.signal_elapsed }))
+
+    @classmethod
+    def load(cls, path):
+        '''Reads a checkpoint written by save.'''
+
+        with np.load(path) as arrays:
+            return cls(int(arrays['tick']), int(arrays['n_streets']),
+                       arrays['path_streets'], arrays['path_offsets'],
+                       arrays['cursor'], arrays['queue_streets'],
+                       arrays['queue_cars'],
+                       *(arrays[name] if name in arrays.files else None
+                         for name in ('departure', 'signal_phase',
+                                      'signal_elapsed')))
@@ -0,0 +1,155 @@
+import collections
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+from traffic_components import *
+from simulation import Simulation
+
+
+
+class Variant:
+    '''A variant of the base network of an Ensemble and of the run on
+    it. The weights of the streets of a lattice can be replaced by
+    direction with 2d arrays, as for StreetNetwork.square_lattice, and
+    those of any streets with weights, a dict from street id to
+    weight. cuts holds the ids of streets that are closed, which get
+    an infinite weight, since compact networks cannot cut streets, so
+    that no route uses them. The default run, simulate, spawns
+    n_trips random trips drawn with seed and simulates them for
+    n_ticks ticks; parameters holds anything else a custom run needs.'''
+
+    def __init__(self, name=None, north_weights=None, east_weights=None,
+                 south_weights=None, west_weights=None, weights=None,
+                 cuts=(), n_trips=0, seed=0, n_ticks=100, parameters=None):
+        self.name = name
+        self.north_weights = north_weights
+        self.east_weights = east_weights
+        self.south_weights = south_weights
+        self.west_weights = west_weights
+        self.weights = weights
+        self.cuts = cuts
+        self.n_trips = n_trips
+        self.seed = seed
+        self.n_ticks = n_ticks
+        self.parameters = parameters
+
+    def apply(self, network):
+        '''Overlays the variant's weights on a compact network. Only
+        the weights of the changed streets are written, so if the
+        network is memory-mapped copy-on-write, as Ensemble opens it,
+        only their pages are copied.'''
+
+        graph = network.compact_graph()
+        directions = zip(network.lattice_ids()[1:],
+                         (self.north_weights, self.east_weights,
+                          self.south_weights, self.west_weights),
+                         ('north', 'east', 'south', 'west'))
+        for ids, weights, name in directions:
+            if weights is None:
+                continue
+            weights = np.asarray(weights, dtype=np.float64)
+            if ids is None or weights.size != len(ids):
+                raise LatticeDimensionsError(
+                    'The {}_weights of variant {} do not fit the network.'
+                    .format(name, self.name))
+            graph.set_weights(ids, weights.ravel())
+        if self.weights:
+            graph.set_weights(list(self.weights), list(self.weights.values()))
+        if len(self.cuts) > 0:
+            graph.set_weights(np.asarray(self.cuts, dtype=np.int64), np.inf)
+        return network
+
+
+
+def simulate(network, variant):
+    '''The default run of an Ensemble: spawns the variant's trips and
+    simulates them. Returns the name of the variant and the numbers
+    of ticks, car movements, and cars that arrived, are still on the
+    road, or are still waiting to depart.'''
+
+    result = { 'name':variant.name, 'ticks':0, 'moves':0, 'arrived':0,
+               'active':0, 'waiting':0 }
+    if variant.n_trips == 0:
+        return result
+    population = network.spawn_from_od_matrix(
+        network.random_od_matrix(variant.n_trips, variant.seed))
+    simulation = Simulation(network)
+    simulation.run(variant.n_ticks)
+    result.update(ticks=simulation.tick, moves=simulation.moves,
+                  arrived=population.arrived, active=population.active,
+                  waiting=population.waiting)
+    return result
+
+
+
+class Ensemble:
+    '''Runs many variants of one street network across a pool of
+    worker processes. The base network is saved once, to directory or
+    to a temporary directory that is removed with the Ensemble, and
+    every run memory-maps it copy-on-write with StreetNetwork.load, so
+    that all of the workers share its pages and a variant only copies
+    the pages of the weights it overlays. Nothing a run changes
+    outlives it.
+
+    processes is the number of worker processes; None uses one per
+    CPU, and 0 runs the variants in this process. The run function
+    must be picklable, i.e., defined at the top level of a module.'''
+
+    def __init__(self, network, processes=None, directory=None):
+        self._temporary = None
+        if directory is None:
+            self._temporary = tempfile.TemporaryDirectory()
+            directory = self._temporary.name
+        self.path = os.path.join(directory, 'network')
+        self.processes = processes
+        network.save(self.path)
+
+    def network(self):
+        '''Opens a fresh copy-on-write view of the base network.'''
+
+        return StreetNetwork.load(self.path)
+
+    def run(self, variants, function=simulate):
+        '''Runs function(network, variant) on a fresh copy of the base
+        network with each variant applied. Returns an iterator of
+        (variant, result) pairs in the order of the variants, which
+        may be a generator; at most two variants per worker are in
+        flight at once, so memory does not grow with their number.'''
+
+        if self.processes == 0:
+            for variant in variants:
+                yield variant, _run(self.path, function, variant)
+            return
+
+        processes = self.processes or multiprocessing.cpu_count()
+        with multiprocessing.Pool(processes) as pool:
+            pending = collections.deque()
+            for variant in variants:
+                pending.append((variant, pool.apply_async(
+                    _run, (self.path, function, variant))))
+                if len(pending) >= 2 * processes:
+                    variant, result = pending.popleft()
+                    yield variant, result.get()
+            while pending:
+                variant, result = pending.popleft()
+                yield variant, result.get()
+
+    def close(self):
+        '''Removes the temporary directory of the base network, if
+        there is one.'''
+
+        if self._temporary is not None:
+            self._temporary.cleanup()
+            self._temporary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+
+def _run(path, function, variant):
+    return function(variant.apply(StreetNetwork.load(path)), variant)
@@ -0,0 +1,159 @@
+import heapq
+import time
+from traffic_components import *
+
+
+
+class CannotSimulateError(Exception): pass
+
+
+
+class EventSimulation:
+    '''A discrete-event simulation of the cars in a street network, in
+    which time is continuous and a car takes the weight of a street
+    to travel it. A car that enters a street reaches its end after
+    that travel time, and then moves on as soon as it is at the front
+    of the street's queue, with Car.move, so cars still leave every
+    street in the order in which they entered it. Only the front car
+    of each occupied street has an event, in a heap keyed by the time
+    at which it can move and then by street id, which makes every run
+    deterministic; the work done is thus proportional to the number
+    of car movements, however large the network and however long the
+    cars take. Cars of a CarPopulation depart onto their first street
+    at their departure times, before any car moves at that time.
+    Two cars leave the same street at least headway apart, which with
+    the default of 1 matches the one move per street per tick of
+    Simulation.
+
+    If the network has limited capacities, a car whose next street is
+    full waits at the front of its street until a car leaves the full
+    one. The cars that are on the road when the simulation starts, or
+    that are added between runs, start at the beginning of their
+    streets. Traffic lights and rerouting count ticks, so networks
+    with signals are not supported.'''
+
+    def __init__(self, network, headway=1.0):
+        if network.signals is not None:
+            raise CannotSimulateError(
+                'Event simulations do not support traffic signals.')
+        self.network = network
+        self.headway = headway
+        self.time = 0.0
+        self.moves = 0
+        self.events = 0
+        self.elapsed = 0.0
+
+        # The time at which every car on the road reaches the end of
+        # its street, the time at which a car last left every street,
+        # the heap of (time, street id, street) events of the streets
+        # whose front cars have one, and the streets whose front cars
+        # wait for room on every full street.
+        self.ready = dict()
+        self._left = dict()
+        self._heap = []
+        self._scheduled = set()
+        self._blocked = dict()
+
+    def run(self, until=None):
+        '''Processes the events up to and including the time until, or
+        until no car is left on the road or waiting to depart. Returns
+        the number of car movements.'''
+
+        start = time.perf_counter()
+        network = self.network
+        weight = network.compact_graph().weight
+        street_id = network.street_id
+        self._enter_new_cars(weight, street_id)
+
+        moves = self.moves
+        heap = self._heap
+        departure = self._next_departure()
+        while True:
+            if heap and (departure is None or heap[0][0] < departure):
+                now = heap[0][0]
+            elif departure is not None:
+                now = departure
+            else:
+                break
+            if until is not None and now > until:
+                break
+            self.time = max(self.time, now)
+            if network.recorder is not None:
+                network.recorder.time = now
+
+            if departure is not None and departure <= now:
+                for population in network.populations:
+                    for car in population.depart(now):
+                        self._arrive(car, car.location, now, weight,
+                                     street_id)
+                departure = self._next_departure()
+                continue
+
+            now, _, street = heapq.heappop(heap)
+            self._scheduled.discard(street)
+            self.events += 1
+            car = street.q.peek()
+            if car is None:
+                continue
+            target = car.next_street()
+            if target is not None and target.q.full():
+                self._blocked.setdefault(target, []).append(street)
+                continue
+
+            car.move()
+            self.moves += 1
+            del self.ready[car]
+            self._left[street] = now
+            if target is not None:
+                self._arrive(car, target, now, weight, street_id)
+            self._schedule(street, now, street_id)
+            for waiting in self._blocked.pop(street, ()):
+                self._schedule(waiting, now, street_id)
+
+        if until is not None:
+            self.time = max(self.time, until)
+        self.elapsed += time.perf_counter() - start
+        return self.moves - moves
+
+    def _enter_new_cars(self, weight, street_id):
+        # Gives the cars that have no event time yet one, starting
+        # them at the beginning of their streets now.
+        for street in self.network.occupied:
+            for car in street.q:
+                if car not in self.ready:
+                    self.ready[car] = self.time + weight[street_id(street)]
+            self._schedule(street, self.time, street_id)
+
+    def _arrive(self, car, street, now, weight, street_id):
+        self.ready[car] = now + weight[street_id(street)]
+        if street.q.peek() == car:
+            self._schedule(street, now, street_id)
+
+    def _schedule(self, street, now, street_id):
+        # Adds an event for the front car of a street, unless it has
+        # one already.
+        car = street.q.peek()
+        if car is None or street in self._scheduled:
+            return
+        self._scheduled.add(street)
+        left = self._left.get(street)
+        if left is not None:
+            now = max(now, left + self.headway)
+        heapq.heappush(self._heap, (max(self.ready[car], now),
+                                    street_id(street), street))
+
+    def _next_departure(self):
+        departures = [ departure for departure in
+                       (population.next_departure()
+                        for population in self.network.populations)
+                       if departure is not None ]
+        return min(departures, default=None)
+
+    @property
+    def throughput(self):
+        '''The number of car movements per second of wall time spent
+        running the simulation.'''
+
+        if self.elapsed == 0:
+            return 0.0
+        return self.moves / self.elapsed
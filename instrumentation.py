@@ -0,0 +1,251 @@
+import csv
+import os
+import time
+import numpy as np
+from traffic_components import *
+
+
+
+class CannotExportError(Exception): pass
+
+
+
+class RingBuffer:
+    '''The most recent capacity rows of a table of named columns, each
+    preallocated as an array, so that appending a row allocates
+    nothing. A column is given by a dtype, or by a (dtype, shape)
+    pair for a column whose every entry is an array of that shape.'''
+
+    def __init__(self, capacity, **columns):
+        self.capacity = capacity
+        self.appended = 0
+        self._columns = dict()
+        for name, dtype in columns.items():
+            shape = ()
+            if isinstance(dtype, tuple):
+                dtype, shape = dtype
+            self._columns[name] = np.zeros((capacity,) + tuple(shape),
+                                           dtype=dtype)
+
+    @classmethod
+    def from_columns(cls, **columns):
+        '''Returns a full buffer that holds the given arrays as its
+        columns.'''
+
+        n = len(next(iter(columns.values())))
+        buffer = cls(max(n, 1), **{ name:(column.dtype, column.shape[1:])
+                                    for name, column in columns.items() })
+        for name, column in columns.items():
+            buffer._columns[name][:n] = column
+        buffer.appended = n
+        return buffer
+
+    def append(self, *values):
+        '''Appends a row, with a value for every column in order,
+        overwriting the oldest row if the buffer is full.'''
+
+        row = self.appended % self.capacity
+        for column, value in zip(self._columns.values(), values):
+            column[row] = value
+        self.appended += 1
+
+    def __len__(self):
+        return min(self.appended, self.capacity)
+
+    def columns(self):
+        '''Returns copies of the columns, oldest row first.'''
+
+        n = len(self)
+        start = self.appended - n
+        rows = np.arange(start, start + n) % self.capacity
+        return { name:column[rows] for name, column in self._columns.items() }
+
+    def flat_columns(self):
+        '''Returns the columns with those of arrays split into one
+        column per entry, named like name[i] or name[i,j].'''
+
+        flat = dict()
+        for name, column in self.columns().items():
+            if column.ndim == 1:
+                flat[name] = column
+                continue
+            for index in np.ndindex(*column.shape[1:]):
+                flat['{}[{}]'.format(name, ','.join(map(str, index)))] = \
+                    column[(slice(None),) + index]
+        return flat
+
+    def to_csv(self, path):
+        '''Writes the rows to a CSV file with a header row.'''
+
+        columns = self.flat_columns()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(zip(*(column.tolist()
+                                   for column in columns.values())))
+
+    def to_parquet(self, path):
+        '''Writes the rows to a Parquet file, which needs the optional
+        pyarrow package.'''
+
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise CannotExportError(
+                'Writing Parquet files needs the pyarrow package.')
+        pyarrow.parquet.write_table(pyarrow.table(self.flat_columns()), path)
+
+
+
+class Metrics:
+    '''Opt-in instrumentation of a street network and its simulations.
+    Creating a Metrics registers it as the metrics of the network;
+    until then, and after detach, the model only pays for checking
+    that there are none. While it is attached, it records:
+
+    ticks: the wall time of every Simulation tick, split into the
+    phases of releasing departing cars, routing (rerouting, and any
+    shortest_path calls or rendering since the last tick), movement,
+    and signals, with the number of cars moved and on the road;
+
+    routes: the source, destination, algorithm, expanded
+    intersections, and wall time of every shortest_path call;
+
+    trips: the arrival tick, travel time in ticks, and path length of
+    every car that entered the network while attached and arrived;
+
+    street_throughput: the number of cars that left every street;
+    and, only if street_samples is not 0, street_lengths: the queue
+    length of every street, every street_every ticks. Each of its
+    street_samples rows takes 4 bytes per street, all allocated up
+    front.
+
+    The records are kept in RingBuffers of the given capacities and
+    can be read as columns or exported to CSV or Parquet files.'''
+
+    PHASES = ('release', 'routing', 'movement', 'signals', 'rendering')
+    ALGORITHMS = ('cached', 'dijkstra', 'astar', 'bidirectional', 'ch')
+
+    def __init__(self, network, capacity=100000, street_samples=0,
+                 street_every=10):
+        n_streets = network.compact_graph().n_streets
+        self.network = network
+        self.street_every = street_every
+        self.tick = 0
+        self.ticks = RingBuffer(capacity, tick=np.int64, seconds=np.float64,
+                                **{ phase:np.float64
+                                    for phase in self.PHASES },
+                                moves=np.int64, cars=np.int64)
+        self.routes = RingBuffer(capacity, source=np.int64,
+                                 destination=np.int64, algorithm=np.int8,
+                                 expanded=np.int64, seconds=np.float64)
+        self.trips = RingBuffer(capacity, arrival=np.int64,
+                                travel_time=np.int64, length=np.int64)
+        self.street_lengths = None
+        if street_samples > 0:
+            self.street_lengths = RingBuffer(street_samples, tick=np.int64,
+                                             length=(np.int32, (n_streets,)))
+        self.street_throughput = np.zeros(n_streets, dtype=np.int64)
+
+        self._entered = dict()
+        self._times = dict.fromkeys(self.PHASES, 0.0)
+        self._tick_start = None
+        self._lap = None
+
+        network.metrics = self
+
+    def detach(self):
+        '''Stops recording; the records are kept.'''
+
+        if self.network.metrics is self:
+            self.network.metrics = None
+
+    def start_tick(self, tick):
+        self.tick = tick
+        self._tick_start = self._lap = time.perf_counter()
+
+    def lap(self, phase):
+        '''Adds the time since the last lap to a phase of the current
+        tick.'''
+
+        now = time.perf_counter()
+        self._times[phase] += now - self._lap
+        self._lap = now
+
+    def add_time(self, phase, seconds):
+        '''Adds time spent outside of a tick, such as rendering, to a
+        phase of the next tick.'''
+
+        self._times[phase] += seconds
+
+    def end_tick(self, moved_from):
+        '''Records the tick, given the ids of the streets whose front
+        cars moved.'''
+
+        network = self.network
+        if len(moved_from) > 0:
+            np.add.at(self.street_throughput, moved_from, 1)
+        cars = len(network.cars) + sum(len(population)
+                                       for population in network.populations)
+        seconds = time.perf_counter() - self._tick_start
+        self.ticks.append(self.tick, seconds,
+                          *[ self._times[phase] for phase in self.PHASES ],
+                          len(moved_from), cars)
+        self._times = dict.fromkeys(self.PHASES, 0.0)
+        if (self.street_lengths is not None
+                and self.tick % self.street_every == 0):
+            self.street_lengths.append(self.tick, network.queue_lengths())
+        self.tick += 1
+
+    def routed(self, source, destination, algorithm, expanded, seconds):
+        self.routes.append(source, destination,
+                           self.ALGORITHMS.index(algorithm), expanded,
+                           seconds)
+        self._times['routing'] += seconds
+
+    def entered(self, cars):
+        for car in cars:
+            self._entered[car] = self.tick
+
+    def arrived(self, car):
+        entered = self._entered.pop(car, None)
+        if entered is not None:
+            self.trips.append(self.tick, self.tick - entered + 1,
+                              len(car.path))
+
+    def columns(self):
+        '''Returns the records as a dict of tables, each a dict of
+        columns.'''
+
+        columns = { 'ticks':self.ticks.columns(),
+                    'routes':self.routes.columns(),
+                    'trips':self.trips.columns(),
+                    'street_throughput':
+                        { 'street':np.arange(len(self.street_throughput)),
+                          'throughput':self.street_throughput.copy() } }
+        if self.street_lengths is not None:
+            columns['street_lengths'] = self.street_lengths.columns()
+        return columns
+
+    def export(self, directory, format='csv'):
+        '''Writes every table to a file named after it in the directory,
+        which is created if needed, as 'csv' or 'parquet'.'''
+
+        if format not in ('csv', 'parquet'):
+            raise CannotExportError('Cannot export metrics as {}.'
+                                    .format(format))
+        os.makedirs(directory, exist_ok=True)
+        throughput = RingBuffer.from_columns(
+            street=np.arange(len(self.street_throughput)),
+            throughput=self.street_throughput)
+        tables = { 'ticks':self.ticks, 'routes':self.routes,
+                   'trips':self.trips, 'street_throughput':throughput }
+        if self.street_lengths is not None:
+            tables['street_lengths'] = self.street_lengths
+        for name, table in tables.items():
+            path = os.path.join(directory, '{}.{}'.format(name, format))
+            if format == 'csv':
+                table.to_csv(path)
+            else:
+                table.to_parquet(path)
@@ -0,0 +1,425 @@
+import collections
+import multiprocessing
+import time
+import numpy as np
+from traffic_components import *
+from checkpoint import Checkpoint
+from simulation import Simulation
+
+
+
+class CannotPartitionError(Exception): pass
+
+
+
+class PartitionedSimulation(Simulation):
+    '''A Simulation of a lattice network that is split into rectangular
+    tiles of rows x columns intersections, whose cars are moved by
+    separate worker processes. A street belongs to the tile of its
+    head intersection, so the cars queued on it and the decision
+    whether its front car moves belong to that tile too. On every
+    tick, each worker moves the front cars of its occupied streets,
+    and the cars that cross into another tile are passed on through
+    this process, which sends every worker the cars entering its
+    streets together with the order for the next tick. A worker
+    appends the cars entering each street in the order of the streets
+    they came from, exactly as the single-process Simulation does, so
+    both produce the same queues, arrivals, and move counts.
+
+    processes is the number of worker processes, which share the
+    tiles between them; None uses one per tile, up to the number of
+    CPUs, and 0 runs the tiles in this process. The workers start
+    from the state of the network on the first run, and stay alive
+    across runs and steps, so the cars and queues of the network are
+    only brought up to date with them by synchronize, which
+    checkpoint and TrafficMap.record call, and by close, which also
+    stops them, as the with statement does. The workers stop by
+    themselves once no cars are left. To change the network between
+    runs, close the simulation first; the next run starts the
+    workers again from the changed network. Signals, capacities,
+    rerouting, metrics, and trajectory recorders are not supported.'''
+
+    def __init__(self, network, tiles=(2, 2), processes=None):
+        super().__init__(network)
+        self.tiles = tiles
+        self.processes = processes
+        self._workers = None
+        self._cars = None
+        self._incoming = None
+        self._synchronized = True
+
+    def step(self):
+        return self.run(1)
+
+    def run(self, n_ticks):
+        '''Advances the simulation by n_ticks ticks, stopping early if
+        no cars are left on the road or waiting to depart. Returns the
+        number of car movements.'''
+
+        start = time.perf_counter()
+        self._check()
+        if self._workers is None and not self._start():
+            return 0
+        workers = self._workers
+        moves = 0
+        live = True
+        try:
+            incoming = self._incoming
+            for _ in range(n_ticks):
+                for worker, entries in zip(workers, incoming):
+                    worker.send('tick', entries, self.tick)
+                results = [ worker.receive() for worker in workers ]
+                incoming = [ [] for _ in workers ]
+                live = False
+                for outgoing, tile_moves, tile_live in results:
+                    for destination, entries in outgoing.items():
+                        incoming[destination].append(entries)
+                    moves += tile_moves
+                    live = live or tile_live
+                self.tick += 1
+                self._synchronized = False
+                live = live or any(incoming_entries
+                                   for incoming_entries in incoming)
+                if not live:
+                    break
+            self._incoming = incoming
+        except BaseException:
+            self._stop()
+            raise
+
+        self.moves += moves
+        if not live:
+            self.close()
+        self.elapsed += time.perf_counter() - start
+        return moves
+
+    def synchronize(self):
+        '''Writes the state that the workers have reached back to the
+        cars and queues of the network.'''
+
+        if self._workers is None or self._synchronized:
+            return
+        start = time.perf_counter()
+        for worker, entries in zip(self._workers, self._incoming):
+            worker.send('state', entries)
+        states = [ worker.receive() for worker in self._workers ]
+        self._incoming = [ [] for _ in self._workers ]
+        self._write_back(self._cars, states)
+        self._synchronized = True
+        self.elapsed += time.perf_counter() - start
+
+    def checkpoint(self):
+        self.synchronize()
+        return super().checkpoint()
+
+    def close(self):
+        '''Brings the network up to date and stops the workers.'''
+
+        try:
+            self.synchronize()
+        finally:
+            self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _start(self):
+        # Starts the workers from the state of the network, unless no
+        # cars are left on it or waiting to depart.
+        network = self.network
+        if not network.occupied and not any(
+                population.waiting for population in network.populations):
+            return False
+        checkpoint = Checkpoint.capture(network, self.tick)
+        self._cars, groups = Checkpoint.cars_of(network)
+        owner = self._owners()
+        n_workers = int(owner.max()) + 1
+
+        graph = network.compact_graph()
+        shared = (graph.tail, graph.head, owner, checkpoint.path_streets,
+                  checkpoint.path_offsets, groups, checkpoint.departure)
+        self._workers = []
+        try:
+            for worker in range(n_workers):
+                self._workers.append(_connect(
+                    _Tile(worker, shared, checkpoint), self.processes != 0))
+        except BaseException:
+            self._stop()
+            raise
+        self._incoming = [ [] for _ in self._workers ]
+        self._synchronized = True
+        return True
+
+    def _stop(self):
+        workers, self._workers = self._workers, None
+        self._cars = self._incoming = None
+        self._synchronized = True
+        for worker in workers or ():
+            worker.close()
+
+    def _check(self):
+        network = self.network
+        if network.lattice is None:
+            raise CannotPartitionError(
+                'Only lattice networks can be partitioned into tiles.')
+        if (network.signals is not None or network.capacity_limited
+                or self.rerouter is not None):
+            raise CannotPartitionError(
+                'Partitioned simulations do not support signals,'
+                ' capacities, or rerouting.')
+        # Cars that move or arrive in the workers are not seen by the
+        # metrics or the recorder of the network.
+        if network.metrics is not None or network.recorder is not None:
+            raise CannotPartitionError(
+                'Partitioned simulations do not support metrics or'
+                ' trajectory recorders.')
+
+    def _owners(self):
+        # The worker of the tile of the head of every street.
+        lattice = self.network.lattice_ids()[0]
+        height, width = lattice.shape
+        rows, columns = self.tiles
+        row_tile = np.arange(height) * rows // height
+        column_tile = np.arange(width) * columns // width
+        tile = row_tile[:, None] * columns + column_tile[None, :]
+
+        processes = self.processes
+        n_tiles = rows * columns
+        if processes is None:
+            processes = min(n_tiles, multiprocessing.cpu_count())
+        worker = np.arange(n_tiles) % max(processes, 1)
+
+        node_worker = np.zeros(lattice.size, dtype=np.int64)
+        node_worker[lattice.ravel()] = worker[tile.ravel()]
+        return node_worker[self.network.compact_graph().head]
+
+    def _write_back(self, cars, states):
+        # Puts the cars of the network where the workers left them.
+        network = self.network
+        for street in network.occupied:
+            street.q.queue.clear()
+        network.occupied.clear()
+
+        cursor = np.zeros(len(cars), dtype=np.int64)
+        on_road = np.zeros(len(cars), dtype=bool)
+        arrived = np.zeros(len(cars), dtype=bool)
+        queues = []
+        for queue_streets, queue_cars, car_cursor, tile_arrived in states:
+            cursor[queue_cars] = car_cursor
+            on_road[queue_cars] = True
+            arrived[tile_arrived] = True
+            queues.append((queue_streets, queue_cars))
+
+        populations = set()
+        for i, car in enumerate(cars):
+            if isinstance(car, Car):
+                if arrived[i]:
+                    car.location = None
+                    network.cars.remove(car)
+                elif on_road[i]:
+                    car.cursor = int(cursor[i])
+                    car.location = car.path[car.cursor]
+                continue
+            population = car.population
+            populations.add(population)
+            if arrived[i]:
+                population.status[car.id] = population.ARRIVED
+            elif on_road[i]:
+                population.status[car.id] = population.ACTIVE
+                population.cursor[car.id] = cursor[i]
+
+        for population in populations:
+            population.resynchronize()
+
+        queue_streets = np.concatenate([ streets for streets, _ in queues ])
+        queue_cars = np.concatenate([ queued for _, queued in queues ])
+        order = np.argsort(queue_streets, kind='stable')
+        streets = network.streets_of(queue_streets[order])
+        for street, car in zip(streets, queue_cars[order].tolist()):
+            street.q.put(cars[car])
+            network.occupied[street] = None
+
+
+
+class _Tile:
+    '''The part of a partitioned simulation that one worker runs: the
+    queues of the streets it owns, and the cars on them or waiting to
+    depart onto them, by their index in the Checkpoint the simulation
+    started from.'''
+
+    def __init__(self, worker, shared, checkpoint):
+        self.worker = worker
+        self.shared = shared
+        self.checkpoint = checkpoint
+
+    def start(self):
+        (self.tail, self.head, self.owner, self.path_streets,
+         self.path_offsets, groups, departure) = self.shared
+        checkpoint = self.checkpoint
+        self.cursor = checkpoint.cursor.copy()
+        self.queues = dict()
+        self.arrived = []
+        self.pending = []
+
+        mine = self.owner[checkpoint.queue_streets] == self.worker
+        for street, car in zip(checkpoint.queue_streets[mine].tolist(),
+                               checkpoint.queue_cars[mine].tolist()):
+            self.queues.setdefault(street, collections.deque()).append(car)
+
+        # The cars waiting to depart onto the streets of this tile, by
+        # population and then in the order in which it releases them.
+        waiting = np.flatnonzero(departure >= 0)
+        first = self.path_streets[self.path_offsets[waiting]
+                                  + self.cursor[waiting]]
+        waiting = waiting[self.owner[first] == self.worker]
+        self.releases = []
+        for group in np.unique(groups[waiting]).tolist():
+            cars = waiting[groups[waiting] == group]
+            cars = cars[np.argsort(departure[cars], kind='stable')]
+            self.releases.append([departure[cars], cars, 0])
+        self.shared = self.checkpoint = None
+
+    def tick(self, incoming, tick):
+        '''Enters the cars that moved into this tile's streets on the
+        last tick, releases the cars that depart, and moves the front
+        cars. Returns the cars that move into other tiles' streets, by
+        worker, the number of cars that moved, and whether this tile
+        still has any cars.'''
+
+        self._enter(incoming)
+
+        for release in self.releases:
+            departures, cars, n = release
+            stop = int(np.searchsorted(departures, tick, side='right'))
+            for car in cars[n:stop].tolist():
+                street = int(self.path_streets[self.path_offsets[car]
+                                               + self.cursor[car]])
+                self.queues.setdefault(street,
+                                       collections.deque()).append(car)
+            release[2] = stop
+
+        streets = sorted(street for street, q in self.queues.items() if q)
+        moved = []
+        for street in streets:
+            car = self.queues[street].popleft()
+            index = self.cursor[car] + 1
+            if self.path_offsets[car] + index >= self.path_offsets[car+1]:
+                self.arrived.append(car)
+                continue
+            next_street = int(self.path_streets[self.path_offsets[car]
+                                                + index])
+            if self.head[street] != self.tail[next_street]:
+                raise DisconnectedPathError(
+                    ('The car {} attempted to move from street {} to'
+                     +' street {}, but these streets were not joined by'
+                     +' an intersection.').format(car, street, next_street))
+            self.cursor[car] = index
+            moved.append((street, next_street, car, index))
+
+        outgoing = collections.defaultdict(list)
+        for entry in moved:
+            outgoing[int(self.owner[entry[1]])].append(entry)
+        outgoing = { worker:np.array(entries, dtype=np.int64).reshape(-1, 4)
+                     for worker, entries in outgoing.items() }
+
+        waiting = any(n < len(cars) for _, cars, n in self.releases)
+        live = waiting or any(self.queues.values())
+        return outgoing, len(streets), live
+
+    def state(self, incoming):
+        '''Enters the last cars to move into this tile, and returns its
+        queues as street and car indices, front first, the cursors of
+        those cars, and the cars that arrived since the last call.'''
+
+        self._enter(incoming)
+        streets = sorted(street for street, q in self.queues.items() if q)
+        queue_streets = np.repeat(np.array(streets, dtype=np.int64),
+                                  [ len(self.queues[street])
+                                    for street in streets ])
+        queue_cars = np.array([ car for street in streets
+                                for car in self.queues[street] ],
+                              dtype=np.int64)
+        arrived = np.array(self.arrived, dtype=np.int64)
+        self.arrived = []
+        return queue_streets, queue_cars, self.cursor[queue_cars], arrived
+
+    def _enter(self, incoming):
+        # Appends the cars entering this tile's streets in the order of
+        # the streets they left, as the single-process simulation does.
+        incoming = [ entries for entries in incoming if len(entries) ]
+        if not incoming:
+            return
+        entries = np.concatenate(incoming)
+        entries = entries[np.argsort(entries[:, 0], kind='stable')]
+        for _, street, car, index in entries.tolist():
+            self.cursor[car] = index
+            self.queues.setdefault(street, collections.deque()).append(car)
+
+
+
+def _connect(tile, separate):
+    # Runs a tile in a worker process of its own, or in this one,
+    # behind the same send and receive interface.
+    if separate:
+        return _TileProcess(tile)
+    return _TileLocal(tile)
+
+
+
+class _TileLocal:
+    def __init__(self, tile):
+        self.tile = tile
+        tile.start()
+        self.result = None
+
+    def send(self, command, *args):
+        self.result = getattr(self.tile, command)(*args)
+
+    def receive(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+
+class _TileProcess:
+    def __init__(self, tile):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(tile, child),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+
+    def send(self, command, *args):
+        self.connection.send((command, args))
+
+    def receive(self):
+        failed, result = self.connection.recv()
+        if failed:
+            raise result
+        return result
+
+    def close(self):
+        self.connection.send(None)
+        self.connection.close()
+        self.process.join()
+
+
+
+def _serve(tile, connection):
+    tile.start()
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        command, args = message
+        try:
+            connection.send((False, getattr(tile, command)(*args)))
+        except Exception as error:
+            connection.send((True, error))
+    connection.close()
@@ -0,0 +1,358 @@
+import numpy as np
+from traffic_components import *
+
+
+
+class CarPopulation:
+    '''A population of cars stored as parallel arrays rather than as
+    Car objects. Car i has status status[i] and has reached street
+    cursor[i] of its path, which is the slice
+    paths[path_start[i]:path_end[i]] of one flat array of street ids.
+    A car that is rerouted keeps its slice if its new path fits in
+    it, and otherwise gets a new one at the end of the array, which is
+    compacted once most of it holds no path.
+    The only per-car object is the PopulationCar view that
+    waits in its street's queue while the car is on the road, so a car
+    that arrives costs nothing to remove. A car may also wait off the
+    road until its departure tick, when Simulation releases it onto
+    the first street of its path. Populations register themselves
+    with their network.'''
+
+    ACTIVE = 1
+    ARRIVED = 2
+    WAITING = 3
+
+    def __init__(self, network, capacity=1024):
+        self.network = network
+        self.size = 0
+        self.active = 0
+        self.arrived = 0
+        self.waiting = 0
+        self.status = np.zeros(capacity, dtype=np.int8)
+        self.cursor = np.zeros(capacity, dtype=np.int64)
+        self.departure = np.zeros(capacity, dtype=np.int64)
+        self.path_start = np.zeros(capacity, dtype=np.int64)
+        self.path_end = np.zeros(capacity, dtype=np.int64)
+        self.paths = np.zeros(4 * capacity, dtype=np.int32)
+        self.n_path_streets = 0
+        # The number of entries of paths that hold no car's path.
+        self.dead_path_streets = 0
+
+        # The waiting cars, sorted by departure and then by id.
+        self._pending = np.zeros(0, dtype=np.int64)
+
+        network.populations.append(self)
+
+    def add(self, path):
+        '''Adds a car at the start of a path, given as a list of
+        streets or an array of street ids, and returns its view.'''
+
+        if len(path) > 0 and not isinstance(path[0], (int, np.integer)):
+            path = [ self.network.street_id(street) for street in path ]
+        return self.add_paths([path])[0]
+
+    def add_paths(self, paths, cursors=None, departures=None):
+        '''Adds a car for each path, given as arrays of street ids,
+        with their cursors at 0 unless cursors are given. Without
+        departures, the cars are queued on their streets in order and
+        their views are returned. Otherwise they wait until the
+        release of their departure ticks, and None is returned.'''
+
+        lengths = np.fromiter((len(path) for path in paths), dtype=np.int64,
+                              count=len(paths))
+        if (lengths == 0).any():
+            raise DisconnectedPathError('A car cannot have an empty path.')
+        first = self.size
+        last = first + len(paths)
+        used = self.n_path_streets
+        self._reserve(last, used + int(lengths.sum()))
+
+        ends = used + np.cumsum(lengths)
+        self.path_end[first:last] = ends
+        self.path_start[first:last] = ends - lengths
+        if len(paths) > 0:
+            self.paths[used:ends[-1]] = np.concatenate(paths)
+            self.n_path_streets = int(ends[-1])
+        self.cursor[first:last] = 0 if cursors is None else cursors
+        self.size = last
+
+        if departures is not None:
+            self.departure[first:last] = departures
+            self.status[first:last] = self.WAITING
+            self.waiting += len(paths)
+            pending = np.concatenate([self._pending,
+                                      np.arange(first, last)])
+            self._pending = pending[np.argsort(self.departure[pending],
+                                               kind='stable')]
+            return None
+        return self._enter(np.arange(first, last))
+
+    def release(self, tick):
+        '''Puts the waiting cars whose departure is at or before the
+        tick on the road, in order of departure. Returns the number of
+        cars released.'''
+
+        return len(self.depart(tick))
+
+    def depart(self, tick):
+        '''Releases the cars like release, but returns their views.'''
+
+        n = int(np.searchsorted(self.departure[self._pending], tick,
+                                side='right'))
+        if n == 0:
+            return []
+        cars, self._pending = self._pending[:n], self._pending[n:]
+        self.waiting -= n
+        return self._enter(cars)
+
+    def next_departure(self):
+        '''The departure tick of the next car waiting to be released,
+        or None if no car is waiting.'''
+
+        if len(self._pending) == 0:
+            return None
+        return int(self.departure[self._pending[0]])
+
+    def _enter(self, cars):
+        # Queue every car on its current street.
+        self.status[cars] = self.ACTIVE
+        self.active += len(cars)
+        locations = self.paths[self.path_start[cars] + self.cursor[cars]]
+        streets = self.network.streets_of(locations)
+        occupied = self.network.occupied
+        views = [ PopulationCar(self, car) for car in cars.tolist() ]
+        for car, street in zip(views, streets):
+            street.q.put(car)
+            occupied[street] = None
+        if self.network.metrics is not None:
+            self.network.metrics.entered(views)
+        if self.network.recorder is not None:
+            self.network.recorder.entered(views, locations.tolist())
+        return views
+
+    def _reserve(self, n_cars, n_streets):
+        if n_cars > len(self.status):
+            capacity = max(n_cars, 2 * len(self.status))
+            for name in ('status', 'cursor', 'departure', 'path_start',
+                         'path_end'):
+                array = getattr(self, name)
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:len(array)] = array
+                setattr(self, name, grown)
+        if n_streets > len(self.paths):
+            grown = np.zeros(max(n_streets, 2 * len(self.paths)),
+                             dtype=np.int32)
+            grown[:len(self.paths)] = self.paths
+            self.paths = grown
+
+    def reroute(self, car, path):
+        '''Replaces the rest of a car's path, after the street it is
+        on, with a path given as street ids.'''
+
+        start = int(self.path_start[car])
+        end = int(self.path_end[car])
+        kept = int(self.cursor[car]) + 1
+        length = kept + len(path)
+
+        # The new path is written over the old one if it fits, or if
+        # the old one is the last in the array, which can grow.
+        if start + length <= end or end == self.n_path_streets:
+            if end == self.n_path_streets:
+                self._reserve(self.size, start + length)
+                self.n_path_streets = start + length
+            else:
+                self.dead_path_streets += end - start - length
+            self.paths[start+kept:start+length] = path
+            self.path_end[car] = start + length
+            return
+
+        used = self.n_path_streets
+        self._reserve(self.size, used + length)
+        self.paths[used:used+kept] = self.paths[start:start+kept]
+        self.paths[used+kept:used+length] = path
+        self.path_start[car] = used
+        self.path_end[car] = used + length
+        self.n_path_streets = used + length
+        self.dead_path_streets += end - start
+        if 2 * self.dead_path_streets > self.n_path_streets:
+            self._compact()
+
+    def _compact(self):
+        # Moves the paths of all the cars together at the start of the
+        # array, in order of car id.
+        start = self.path_start[:self.size]
+        lengths = self.path_end[:self.size] - start
+        ends = np.cumsum(lengths)
+        used = int(ends[-1])
+        sources = (np.repeat(start - (ends - lengths), lengths)
+                   + np.arange(used))
+        self.paths[:used] = self.paths[sources]
+        self.path_start[:self.size] = ends - lengths
+        self.path_end[:self.size] = ends
+        self.n_path_streets = used
+        self.dead_path_streets = 0
+
+    def resynchronize(self):
+        '''Recounts the active, arrived, and waiting cars from their
+        statuses, after something else has changed those.'''
+
+        status = self.status[:self.size]
+        self.active = int(np.count_nonzero(status == self.ACTIVE))
+        self.arrived = int(np.count_nonzero(status == self.ARRIVED))
+        pending = np.flatnonzero(status == self.WAITING)
+        self.waiting = len(pending)
+        self._pending = pending[np.argsort(self.departure[pending],
+                                           kind='stable')]
+
+    def car(self, car):
+        '''Returns a view of a car by id.'''
+
+        return PopulationCar(self, car)
+
+    def cars(self):
+        '''Generates views of the cars that are on the road.'''
+
+        for car in np.flatnonzero(self.status[:self.size]
+                                  == self.ACTIVE).tolist():
+            yield PopulationCar(self, car)
+
+    def path_ids(self, car):
+        return self.paths[self.path_start[car]:self.path_end[car]]
+
+    def location_id(self, car):
+        return int(self.paths[self.path_start[car] + self.cursor[car]])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.status, self.cursor,
+                                              self.departure,
+                                              self.path_start, self.path_end,
+                                              self.paths,
+                                              self._pending))
+
+    def __len__(self):
+        return self.active
+
+
+
+class PopulationCar:
+    '''A view of one car of a CarPopulation, with the interface of a
+    Car: it has a path, a location, a cursor, and a network, and it
+    moves like a Car does.'''
+
+    __slots__ = ('population', 'id')
+
+    def __init__(self, population, id):
+        self.population = population
+        self.id = id
+
+    @property
+    def network(self):
+        return self.population.network
+
+    @property
+    def path(self):
+        return self.network.streets_of(self.population.path_ids(self.id))
+
+    @property
+    def cursor(self):
+        return int(self.population.cursor[self.id])
+
+    @property
+    def location(self):
+        if self.population.status[self.id] != CarPopulation.ACTIVE:
+            return None
+        return self.network.streets_of(
+            [self.population.location_id(self.id)])[0]
+
+    def reroute(self, path):
+        '''Replaces the rest of the car's path, after the street it is
+        on, with another path, given as streets or their ids.'''
+
+        if len(path) > 0 and not isinstance(path[0], (int, np.integer)):
+            path = [ self.network.street_id(street) for street in path ]
+        self.population.reroute(self.id, path)
+
+    def move(self):
+        '''Moves the car to the next street on its path, or out of the
+        network if it is at the end, as Car.move does.'''
+
+        population = self.population
+        network = population.network
+        car = self.id
+        start = population.path_start[car]
+        stop = population.path_end[car]
+        index = population.cursor[car] + 1
+        current = int(population.paths[start + index - 1])
+        location = network.streets_of([current])[0]
+
+        if start + index >= stop:
+            self._leave(location)
+            population.status[car] = CarPopulation.ARRIVED
+            population.active -= 1
+            population.arrived += 1
+            if network.metrics is not None:
+                network.metrics.arrived(self)
+            if network.recorder is not None:
+                network.recorder.arrived(self)
+            return
+
+        next_id = int(population.paths[start + index])
+        graph = network.compact_graph()
+        if graph.head[current] != graph.tail[next_id]:
+            next_street = network.streets_of([next_id])[0]
+            raise DisconnectedPathError(
+                ('The car {} attempted to move from {} to {}, but'
+                 +' these streets were not joined by an intersection.')
+                .format(self, location, next_street))
+        next_street = network.streets_of([next_id])[0]
+        if next_street.q.full():
+            self._check_front(location)
+            raise StreetFullError(
+                'The car {} could not enter {} because it is full.'
+                .format(self, next_street))
+        self._leave(location)
+        next_street.q.put(self)
+        network.occupied[next_street] = None
+        population.cursor[car] = index
+        if network.recorder is not None:
+            network.recorder.moved(self, next_id)
+
+    def next_street(self):
+        '''The street the car will move to next, or None if it will
+        leave the network.'''
+
+        population = self.population
+        index = population.path_start[self.id] + population.cursor[self.id] + 1
+        if index >= population.path_end[self.id]:
+            return None
+        return self.network.streets_of([population.paths[index]])[0]
+
+    def _check_front(self, location):
+        signals = self.network.signals
+        if signals is not None and not signals.is_green(location):
+            raise RedLightError(
+                'The car {} could not leave {} because its light is'
+                ' red.'.format(self, location))
+        if location.q.peek() != self:
+            raise NotAtFrontOfQueueError(
+                'The car {} could not leave the queue because it was'
+                ' not at the front of the queue.'.format(self))
+
+    def _leave(self, location):
+        self._check_front(location)
+        q = location.q
+        q.get()
+        if q.empty():
+            del self.network.occupied[location]
+
+    def __eq__(self, other):
+        if not isinstance(other, PopulationCar):
+            return NotImplemented
+        return self.population is other.population and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.population), self.id))
+
+    def __str__(self):
+        return 'Car {}'.format(self.id)
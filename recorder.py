@@ -0,0 +1,208 @@
+import json
+import os
+import numpy as np
+from traffic_components import *
+
+
+
+# The version of the format of recordings.
+RECORDING_FORMAT = 1
+
+COLUMNS = ('car', 'time', 'street')
+
+
+
+class TrajectoryRecorder:
+    '''Records every car entering or moving in a street network, and
+    leaving it, as events in columnar buffers of chunk_size events,
+    each of which is written to the directory as soon as it is full,
+    so that memory stays bounded however long the run. Cars are
+    numbered in the order in which they enter the network, or are on
+    it when recording starts. Creating a recorder registers it as the
+    recorder of the network, whose cars then report their moves to
+    it; Simulation and EventSimulation keep its time, with Simulation
+    stamping the cars released on a tick with that tick and the moves
+    made on it with the next one, when they are done. Simulations on
+    separate processes, such as PartitionedSimulation, are not
+    recorded. close, which the with statement calls, writes the last
+    chunk and stops recording.
+
+    The directory holds a header.json file and, for every chunk, one
+    .npy file per column: car_00000.npy, time_00000.npy, and
+    street_00000.npy. Every event is a car entering a street at a
+    time, with street -1 for a car leaving the network; read_chunks
+    and read_trajectories stream them back.'''
+
+    def __init__(self, network, directory, chunk_size=2**16, time=0):
+        self.network = network
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.time = time
+        self.n_cars = 0
+        self.n_chunks = 0
+        self.n_events = 0
+        self._car = np.zeros(chunk_size, dtype=np.int64)
+        self._time = np.zeros(chunk_size, dtype=np.float64)
+        self._street = np.zeros(chunk_size, dtype=np.int64)
+        self._buffered = 0
+        self._numbers = dict()
+
+        os.makedirs(directory, exist_ok=True)
+        self._write_header()
+        network.recorder = self
+        for street in list(network.occupied):
+            self.entered(list(street.q), [network.street_id(street)]
+                         * len(street.q))
+
+    def entered(self, cars, streets=None):
+        '''Records cars entering the network on their streets, given
+        by id or found from their locations.'''
+
+        if streets is None:
+            streets = [ self.network.street_id(car.location)
+                        for car in cars ]
+        for car, street in zip(cars, streets):
+            self._numbers[car] = self.n_cars
+            self._append(self.n_cars, street)
+            self.n_cars += 1
+
+    def moved(self, car, street):
+        '''Records a car entering the street with the given id.'''
+
+        number = self._numbers.get(car)
+        if number is not None:
+            self._append(number, street)
+
+    def arrived(self, car):
+        '''Records a car leaving the network.'''
+
+        number = self._numbers.pop(car, None)
+        if number is not None:
+            self._append(number, -1)
+
+    def _append(self, car, street):
+        i = self._buffered
+        self._car[i] = car
+        self._time[i] = self.time
+        self._street[i] = street
+        self._buffered += 1
+        self.n_events += 1
+        if self._buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''Writes the buffered events to disk as a chunk.'''
+
+        if self._buffered == 0:
+            return
+        n = self._buffered
+        for name, column in zip(COLUMNS, (self._car, self._time,
+                                          self._street)):
+            np.save(_chunk_path(self.directory, name, self.n_chunks),
+                    column[:n])
+        self.n_chunks += 1
+        self._buffered = 0
+        self._write_header()
+
+    def _write_header(self):
+        header = { 'format':RECORDING_FORMAT, 'columns':list(COLUMNS),
+                   'chunks':self.n_chunks }
+        with open(os.path.join(self.directory, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    def close(self):
+        '''Writes the last chunk and stops recording.'''
+
+        self.flush()
+        if self.network.recorder is self:
+            self.network.recorder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+
+class Trajectory:
+    '''The streets a car entered, by id, and the times at which it
+    entered them. departure is the time of the first, and arrival the
+    time at which the car left the network, or None if it had not by
+    the end of the recording.'''
+
+    def __init__(self, car, streets, times, arrival=None):
+        self.car = car
+        self.streets = streets
+        self.times = times
+        self.arrival = arrival
+
+    @property
+    def departure(self):
+        return float(self.times[0])
+
+    @property
+    def travel_time(self):
+        if self.arrival is None:
+            return None
+        return self.arrival - self.departure
+
+
+
+def read_chunks(directory, mmap_mode='r'):
+    '''Generates the chunks of events of a recording, one at a time,
+    as dicts of columns memory-mapped with the given mmap_mode (None
+    reads them into memory).'''
+
+    with open(os.path.join(directory, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != RECORDING_FORMAT:
+        raise ValueError('{} is not a recording in format {}.'
+                         .format(directory, RECORDING_FORMAT))
+    for chunk in range(header['chunks']):
+        yield { name:np.load(_chunk_path(directory, name, chunk),
+                             mmap_mode=mmap_mode)
+                for name in header['columns'] }
+
+
+
+def read_trajectories(directory):
+    '''Generates the Trajectory of every car in a recording, in the
+    order in which the cars arrived, followed by those of the cars
+    that had not arrived in car order. Only the trajectories of the
+    cars on the road at the point of the recording being read are
+    held in memory, besides one chunk.'''
+
+    partial = dict()
+    for chunk in read_chunks(directory, None):
+        cars = chunk['car']
+        order = np.argsort(cars, kind='stable')
+        starts = np.flatnonzero(np.diff(cars[order])) + 1
+        arrivals = []
+        for group in np.split(order, starts):
+            if len(group) == 0:
+                continue
+            car = int(cars[group[0]])
+            parts = partial.setdefault(car, [])
+            parts.append((chunk['street'][group], chunk['time'][group]))
+            if parts[-1][0][-1] == -1:
+                arrivals.append((group[-1], car))
+
+        # The cars that left the network, in the order they left it.
+        for _, car in sorted(arrivals):
+            parts = partial.pop(car)
+            streets = np.concatenate([ streets for streets, _ in parts ])
+            times = np.concatenate([ times for _, times in parts ])
+            yield Trajectory(car, streets[:-1], times[:-1],
+                             float(times[-1]))
+
+    for car in sorted(partial):
+        parts = partial[car]
+        yield Trajectory(car,
+                         np.concatenate([ streets for streets, _ in parts ]),
+                         np.concatenate([ times for _, times in parts ]))
+
+
+
+def _chunk_path(directory, name, chunk):
+    return os.path.join(directory, '{}_{:05d}.npy'.format(name, chunk))
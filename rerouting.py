@@ -0,0 +1,122 @@
+import numpy as np
+import routing
+from traffic_components import *
+
+
+
+def congestion_costs(weights, queue_lengths, capacity=1.0, alpha=0.15,
+                     beta=4.0):
+    '''The travel cost of every street given its weight and the number
+    of cars queued on it, following the Bureau of Public Roads
+    function: weight * (1 + alpha * (queue_length / capacity)**beta).
+    The capacity may be one number or an array with one per street.'''
+
+    load = np.asarray(queue_lengths, dtype=np.float64) / capacity
+    return np.asarray(weights, dtype=np.float64) * (1 + alpha * load**beta)
+
+
+
+class Rerouter:
+    '''Periodically reroutes the cars of a street network around
+    congestion. Every period ticks, the cost of every street is
+    recomputed from its queue length with congestion_costs, and every
+    car whose remaining path costs more than threshold times as much
+    as the cheapest one from where it is switches to the cheapest one.
+    The cheapest paths come from one DynamicShortestPathTree per
+    destination, which is repaired, rather than searched again, when
+    costs change. A Simulation given a Rerouter calls its step before
+    choosing the movers of every tick.'''
+
+    def __init__(self, network, period=10, threshold=1.2, capacity=1.0,
+                 alpha=0.15, beta=4.0):
+        self.network = network
+        self.period = period
+        self.threshold = threshold
+        self.capacity = capacity
+        self.alpha = alpha
+        self.beta = beta
+        self.rerouted = 0
+        self.expanded = 0
+        self.trees = dict()
+        self._cost = None
+        self._revision = None
+
+    def step(self, tick):
+        '''Reroutes the cars if the tick is a multiple of the period.
+        Returns the number of cars rerouted.'''
+
+        if tick % self.period != 0:
+            return 0
+        return self.reroute()
+
+    def costs(self):
+        '''The current congestion cost of every street, by id.'''
+
+        return congestion_costs(self.network.compact_graph().weight,
+                                self.network.queue_lengths(), self.capacity,
+                                self.alpha, self.beta)
+
+    def reroute(self):
+        '''Updates the street costs and reroutes the cars whose
+        remaining paths became too expensive. Returns the number of
+        cars rerouted.'''
+
+        network = self.network
+        graph = network.compact_graph()
+        cost = self.costs()
+
+        # A changed network invalidates every tree. Otherwise the trees
+        # only need to hear about the streets whose cost changed.
+        if network.revision != self._revision:
+            self.trees.clear()
+            self._revision = network.revision
+        elif self.trees:
+            changed = np.flatnonzero(cost != self._cost)
+            if len(changed) > 0:
+                for tree in self.trees.values():
+                    self.expanded += tree.update(changed, cost[changed])
+        self._cost = cost
+
+        tail, head = graph.adjacency_lists()[:2]
+        cost_list = cost.tolist()
+        used = set()
+        rerouted = 0
+        for car, path in self._remaining_paths():
+            destination = head[path[-1]]
+            used.add(destination)
+            tree = self.trees.get(destination)
+            if tree is None:
+                tree = routing.DynamicShortestPathTree(graph, destination,
+                                                       cost)
+                self.expanded += tree.expanded
+                self.trees[destination] = tree
+
+            best = tree.distance_from(tail[path[0]])
+            remaining = sum(cost_list[street] for street in path)
+            if remaining > self.threshold * best:
+                new_path = tree.path(tail[path[0]])
+                if isinstance(car, Car):
+                    new_path = network.streets_of(new_path)
+                car.reroute(new_path)
+                rerouted += 1
+
+        # Trees of destinations that no car is heading for any more are
+        # dropped.
+        for destination in set(self.trees) - used:
+            del self.trees[destination]
+        self.rerouted += rerouted
+        return rerouted
+
+    def _remaining_paths(self):
+        # Generates every car on the road that has streets left to
+        # travel, with the street ids of the rest of its path.
+        network = self.network
+        for car in network.cars:
+            if car.location is not None and car.cursor + 1 < len(car.path):
+                yield car, [ network.street_id(street)
+                             for street in car.path[car.cursor+1:] ]
+        for population in network.populations:
+            for car in population.cars():
+                path = population.path_ids(car.id)[car.cursor+1:]
+                if len(path) > 0:
+                    yield car, path.tolist()
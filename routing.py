@@ -0,0 +1,910 @@
+import collections
+import hashlib
+import heapq
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+
+
+class ShortestPathTree:
+    '''The shortest paths from a source intersection to every
+    intersection of a CompactGraph, stored as two arrays indexed by
+    intersection id: the distance from the source (inf if it cannot be
+    reached) and the street that leads into the intersection on its
+    shortest path (-1 for the source and for unreachable
+    intersections).'''
+
+    def __init__(self, source, distance, previous):
+        self.source = source
+        self.distance = distance
+        self.previous = previous
+
+    @classmethod
+    def search(cls, graph, source):
+        '''Computes the tree of the given source with Dijkstra's
+        algorithm.'''
+
+        distance, previous, _ = dijkstra(graph, source)
+        tree_distance = np.full(graph.n_intersections, np.inf)
+        tree_previous = np.full(graph.n_intersections, -1, dtype=np.int32)
+        nodes = np.fromiter(previous.keys(), dtype=np.int64,
+                            count=len(previous))
+        tree_distance[nodes] = [ distance[node] for node in previous ]
+        tree_previous[nodes] = list(previous.values())
+        return cls(source, tree_distance, tree_previous)
+
+    @property
+    def nbytes(self):
+        return self.distance.nbytes + self.previous.nbytes
+
+    def path(self, destination, tail):
+        '''Returns the street ids of the shortest path to the
+        destination, which is empty if there is none.'''
+
+        return trace(self.previous, tail, destination)
+
+
+
+class DynamicShortestPathTree:
+    '''The shortest paths from every intersection of a CompactGraph to
+    a destination intersection, under a cost for every street that can
+    change while the tree is in use. The tree is stored as the
+    distance of every intersection to the destination (inf if it
+    cannot reach it) and the next street on its shortest path (-1 for
+    the destination and for intersections that cannot reach it).
+
+    When a few costs change, update repairs the tree instead of
+    searching it again, in the manner of Ramalingam and Reps: only the
+    intersections whose shortest paths ran through a street that got
+    more expensive lose their distances, and a single Dijkstra search,
+    over the reversed streets, settles those and any intersection
+    that a cheaper street brings closer.'''
+
+    def __init__(self, graph, destination, cost):
+        n = graph.n_intersections
+        self.graph = graph
+        self.destination = destination
+        self.expanded = 0
+        self._cost = np.asarray(cost, dtype=np.float64).tolist()
+        self._distance = [ np.inf ] * n
+        self._next = [ -1 ] * n
+
+        self._distance[destination] = 0.0
+        self._search([ (0.0, destination) ])
+
+    @property
+    def distance(self):
+        return np.array(self._distance)
+
+    @property
+    def next(self):
+        return np.array(self._next, dtype=np.int32)
+
+    def distance_from(self, node):
+        return self._distance[node]
+
+    def path(self, source):
+        '''Returns the street ids of the shortest path from the source
+        intersection id to the destination, which is empty if there is
+        none.'''
+
+        head = self.graph.adjacency_lists()[1]
+        path = []
+        street = self._next[source]
+        while street >= 0:
+            path.append(street)
+            street = self._next[head[street]]
+        return path
+
+    def update(self, streets, costs):
+        '''Changes the costs of the given street ids and repairs the
+        tree. Returns the number of intersections expanded.'''
+
+        tail, head, out_offsets, out_streets, in_offsets, in_streets = \
+            self.graph.adjacency_lists()
+        cost, distance, next_street = self._cost, self._distance, self._next
+
+        changed = []
+        roots = []
+        for street, new in zip(np.asarray(streets).tolist(),
+                               np.asarray(costs, dtype=np.float64).tolist()):
+            old = cost[street]
+            if new == old:
+                continue
+            cost[street] = new
+            changed.append(street)
+            if new > old and next_street[tail[street]] == street:
+                roots.append(tail[street])
+
+        # The intersections whose shortest paths pass through a street
+        # that got more expensive lose their distances.
+        affected = set(roots)
+        stack = roots
+        while stack:
+            node = stack.pop()
+            for street in in_streets[in_offsets[node]:in_offsets[node+1]]:
+                neighbor = tail[street]
+                if next_street[neighbor] == street and neighbor not in affected:
+                    affected.add(neighbor)
+                    stack.append(neighbor)
+        for node in affected:
+            distance[node] = np.inf
+            next_street[node] = -1
+
+        # They start from their best neighbor that kept its distance,
+        # and the tails of streets that got cheaper from their heads.
+        heap = []
+        for node in affected:
+            for street in out_streets[out_offsets[node]:out_offsets[node+1]]:
+                neighbor = head[street]
+                if neighbor in affected:
+                    continue
+                alternative = distance[neighbor] + cost[street]
+                if alternative < distance[node]:
+                    distance[node] = alternative
+                    next_street[node] = street
+            if distance[node] < np.inf:
+                heap.append((distance[node], node))
+        for street in changed:
+            node = tail[street]
+            alternative = distance[head[street]] + cost[street]
+            if alternative < distance[node]:
+                distance[node] = alternative
+                next_street[node] = street
+                heap.append((alternative, node))
+
+        heapq.heapify(heap)
+        return self._search(heap)
+
+    def _search(self, heap):
+        tail, _, _, _, in_offsets, in_streets = self.graph.adjacency_lists()
+        cost, distance, next_street = self._cost, self._distance, self._next
+
+        expanded = 0
+        while heap:
+            dist, node = heapq.heappop(heap)
+            if dist > distance[node]:
+                continue
+            expanded += 1
+            for street in in_streets[in_offsets[node]:in_offsets[node+1]]:
+                neighbor = tail[street]
+                alternative = dist + cost[street]
+                if alternative < distance[neighbor]:
+                    distance[neighbor] = alternative
+                    next_street[neighbor] = street
+                    heapq.heappush(heap, (alternative, neighbor))
+        self.expanded = expanded
+        return expanded
+
+
+
+class RouteCache:
+    '''A least-recently-used cache of shortest path trees, keyed by
+    source intersection id, that holds at most max_bytes worth of
+    trees. Every tree is computed for a particular revision of a
+    network; asking for another revision empties the cache. It also
+    remembers the last max_sources sources that were missed, so that
+    a tree is only worth computing for a source that repeats.'''
+
+    def __init__(self, max_bytes=64 * 2**20, max_sources=4096):
+        self.max_bytes = max_bytes
+        self.max_sources = max_sources
+        self.nbytes = 0
+        self.revision = None
+        self.hits = 0
+        self.misses = 0
+        self._trees = collections.OrderedDict()
+        self._missed = collections.OrderedDict()
+
+    def get(self, source, revision):
+        '''Returns the cached tree of the source, or None.'''
+
+        if revision != self.revision:
+            self.clear()
+            self.revision = revision
+        tree = self._trees.get(source)
+        if tree is None:
+            self.misses += 1
+            self._missed[source] = self._missed.pop(source, 0) + 1
+            if len(self._missed) > self.max_sources:
+                self._missed.popitem(last=False)
+        else:
+            self.hits += 1
+            self._trees.move_to_end(source)
+        return tree
+
+    def put(self, tree, revision):
+        '''Caches a tree, evicting the least recently used trees until
+        the cache fits in its budget. Trees larger than the whole
+        budget are not cached.'''
+
+        if revision != self.revision:
+            self.clear()
+            self.revision = revision
+        if tree.nbytes > self.max_bytes:
+            return
+        old = self._trees.pop(tree.source, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self._trees[tree.source] = tree
+        self.nbytes += tree.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._trees.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def repeated(self, source):
+        '''Whether the source has been missed more than once since
+        the cache was last emptied.'''
+
+        return self._missed.get(source, 0) > 1
+
+    def clear(self):
+        self._trees.clear()
+        self._missed.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, source):
+        return source in self._trees
+
+
+
+class ContractionHierarchy:
+    '''A contraction hierarchy of a CompactGraph, which answers
+    shortest path queries by searching only a small part of the graph.
+    Intersections are contracted one at a time, least important
+    first; contracting an intersection adds a shortcut between two of
+    its remaining neighbors whenever the only shortest path between
+    them went through it. A query then runs a bidirectional search
+    that only climbs to more important intersections, and expands
+    the shortcuts on the path it finds back into streets.
+
+    Edges are the graph's streets, whose ids they keep, followed by
+    the shortcuts; shortcut e stands for edge first[e - n_streets]
+    followed by edge second[e - n_streets]. A hierarchy only fits the
+    graph it was built from, which it identifies by a fingerprint of
+    the graph's arrays.'''
+
+    def __init__(self, fingerprint, n_streets, rank,
+                 edge_tail, edge_head, edge_weight, first, second):
+        self.fingerprint = fingerprint
+        self.n_streets = n_streets
+        self.rank = rank
+        self.edge_tail = edge_tail
+        self.edge_head = edge_head
+        self.edge_weight = edge_weight
+        self.first = first
+        self.second = second
+
+        # The upward search from the source follows edges to more
+        # important heads; the one from the target follows edges
+        # backward to more important tails.
+        up = rank[edge_head] > rank[edge_tail]
+        self.up_offsets, self.up_edges = _group(edge_tail, up, len(rank))
+        self.down_offsets, self.down_edges = _group(edge_head, ~up, len(rank))
+        self._sides = ((self.up_offsets, self.up_edges,
+                        edge_head[self.up_edges],
+                        edge_weight[self.up_edges]),
+                       (self.down_offsets, self.down_edges,
+                        edge_tail[self.down_edges],
+                        edge_weight[self.down_edges]))
+
+    @classmethod
+    def build(cls, graph, witness_limit=50):
+        '''Contracts every intersection of the graph. Witness searches,
+        which look for a path that makes a shortcut unnecessary, give
+        up after settling witness_limit intersections, in which case
+        the shortcut is added anyway.'''
+
+        n = graph.n_intersections
+        edge_tail = graph.tail.tolist()
+        edge_head = graph.head.tolist()
+        edge_weight = graph.weight.tolist()
+        first = []
+        second = []
+
+        # The remaining graph, as the lightest edge from every
+        # intersection to each of its neighbors and back.
+        out_edges = [ dict() for _ in range(n) ]
+        in_edges = [ dict() for _ in range(n) ]
+        for edge in range(graph.n_streets):
+            tail, head = edge_tail[edge], edge_head[edge]
+            if tail == head:
+                continue
+            current = out_edges[tail].get(head)
+            if current is None or edge_weight[edge] < edge_weight[current]:
+                out_edges[tail][head] = edge
+                in_edges[head][tail] = edge
+
+        def shortcuts(node):
+            '''The shortcuts needed to contract the intersection, as
+            (tail, head, first edge, second edge, weight).'''
+
+            needed = []
+            for tail, in_edge in in_edges[node].items():
+                targets = { head:edge_weight[in_edge] + edge_weight[edge]
+                            for head, edge in out_edges[node].items()
+                            if head != tail }
+                if not targets:
+                    continue
+                witness = _witness_search(out_edges, edge_weight, tail, node,
+                                          max(targets.values()),
+                                          witness_limit)
+                for head, weight in targets.items():
+                    if witness.get(head, np.inf) > weight:
+                        needed.append((tail, head, in_edge,
+                                       out_edges[node][head], weight))
+            return needed
+
+        def priority(node, needed):
+            return (len(needed) - len(in_edges[node]) - len(out_edges[node])
+                    + contracted_neighbors[node])
+
+        # Contract the intersections in order of priority, checking
+        # that a popped priority is still up to date before using it.
+        contracted_neighbors = [0] * n
+        heap = [ (priority(node, shortcuts(node)), node) for node in range(n) ]
+        heapq.heapify(heap)
+        rank = np.empty(n, dtype=np.int64)
+        order = 0
+        while heap:
+            _, node = heapq.heappop(heap)
+            needed = shortcuts(node)
+            current = priority(node, needed)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, node))
+                continue
+
+            for tail, head, in_edge, out_edge, weight in needed:
+                existing = out_edges[tail].get(head)
+                if existing is not None and edge_weight[existing] <= weight:
+                    continue
+                edge = len(edge_tail)
+                edge_tail.append(tail)
+                edge_head.append(head)
+                edge_weight.append(weight)
+                first.append(in_edge)
+                second.append(out_edge)
+                out_edges[tail][head] = edge
+                in_edges[head][tail] = edge
+
+            neighbors = set(in_edges[node]) | set(out_edges[node])
+            for neighbor in in_edges[node]:
+                del out_edges[neighbor][node]
+            for neighbor in out_edges[node]:
+                del in_edges[neighbor][node]
+            for neighbor in neighbors:
+                contracted_neighbors[neighbor] += 1
+            rank[node] = order
+            order += 1
+
+        return cls(fingerprint(graph), graph.n_streets, rank,
+                   np.array(edge_tail, dtype=np.int32),
+                   np.array(edge_head, dtype=np.int32),
+                   np.array(edge_weight, dtype=np.float64),
+                   np.array(first, dtype=np.int64),
+                   np.array(second, dtype=np.int64))
+
+    def save(self, path):
+        '''Writes the hierarchy to an .npz file.'''
+
+        np.savez(path, fingerprint=np.array(self.fingerprint),
+                 n_streets=np.array(self.n_streets), rank=self.rank,
+                 edge_tail=self.edge_tail, edge_head=self.edge_head,
+                 edge_weight=self.edge_weight,
+                 first=self.first, second=self.second)
+
+    @classmethod
+    def load(cls, path):
+        '''Reads a hierarchy written by save.'''
+
+        with np.load(path) as arrays:
+            return cls(str(arrays['fingerprint']), int(arrays['n_streets']),
+                       arrays['rank'], arrays['edge_tail'],
+                       arrays['edge_head'], arrays['edge_weight'],
+                       arrays['first'], arrays['second'])
+
+    def fits(self, graph):
+        '''Whether the hierarchy was built from a graph with the same
+        topology and weights as the given one.'''
+
+        return self.fingerprint == fingerprint(graph)
+
+    def query(self, source, target):
+        '''Returns the street ids of the shortest path from the source
+        to the target intersection id, which is empty if there is
+        none, and the number of intersections that were expanded.'''
+
+        if source == target:
+            return [], 0
+
+        sides = [ ({ source:0.0 }, { source:-1 }, [ (0.0, source) ])
+                  + self._sides[0],
+                  ({ target:0.0 }, { target:-1 }, [ (0.0, target) ])
+                  + self._sides[1] ]
+        best = np.inf
+        meeting = None
+        expanded = 0
+        while sides[0][2] or sides[1][2]:
+            tops = [ side[2][0][0] if side[2] else np.inf for side in sides ]
+            if min(tops) >= best:
+                break
+            side = 0 if tops[0] <= tops[1] else 1
+            distance, previous, heap, offsets, edges, ends, weights = \
+                sides[side]
+
+            dist, node = heapq.heappop(heap)
+            if dist > distance[node]:
+                continue
+            expanded += 1
+            other = sides[1 - side][0].get(node)
+            if other is not None and dist + other < best:
+                best = dist + other
+                meeting = node
+
+            start, stop = offsets[node], offsets[node+1]
+            for edge, neighbor, weight in zip(edges[start:stop].tolist(),
+                                              ends[start:stop].tolist(),
+                                              weights[start:stop].tolist()):
+                alternative = dist + weight
+                if alternative < distance.get(neighbor, np.inf):
+                    distance[neighbor] = alternative
+                    previous[neighbor] = edge
+                    heapq.heappush(heap, (alternative, neighbor))
+
+        if meeting is None:
+            return [], expanded
+
+        # Collect the edges from the source up to the meeting
+        # intersection and from there down to the target, then expand
+        # the shortcuts among them.
+        edges = []
+        node = meeting
+        while sides[0][1][node] >= 0:
+            edge = sides[0][1][node]
+            edges.append(edge)
+            node = int(self.edge_tail[edge])
+        edges.reverse()
+        node = meeting
+        while sides[1][1][node] >= 0:
+            edge = sides[1][1][node]
+            edges.append(edge)
+            node = int(self.edge_head[edge])
+        return self.unpack(edges), expanded
+
+    def unpack(self, edges):
+        '''Replaces every shortcut in a sequence of edges by the
+        streets it stands for.'''
+
+        path = []
+        stack = list(reversed(edges))
+        while stack:
+            edge = stack.pop()
+            if edge < self.n_streets:
+                path.append(edge)
+            else:
+                stack.append(int(self.second[edge - self.n_streets]))
+                stack.append(int(self.first[edge - self.n_streets]))
+        return path
+
+
+
+def fingerprint(graph):
+    '''A digest of a CompactGraph's topology and weights.'''
+
+    digest = hashlib.sha1()
+    for array in (graph.tail, graph.head, graph.weight):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return '{}:{}:{}'.format(graph.n_intersections, graph.n_streets,
+                             digest.hexdigest())
+
+
+
+def _group(endpoints, mask, n):
+    '''Groups the ids of the edges selected by the mask by their
+    endpoint, in CSR form.'''
+
+    edges = np.flatnonzero(mask)
+    edges = edges[np.argsort(endpoints[edges], kind='stable')]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(endpoints[edges], minlength=n), out=offsets[1:])
+    return offsets, edges
+
+
+
+def _witness_search(out_edges, edge_weight, source, avoid, limit, max_settled):
+    '''Runs a Dijkstra search in the remaining graph from the source
+    that avoids one intersection and stops beyond the given distance
+    or after settling max_settled intersections. Returns the
+    distances it found.'''
+
+    distance = { source:0.0 }
+    heap = [ (0.0, source) ]
+    settled = 0
+    while heap:
+        dist, node = heapq.heappop(heap)
+        if dist > distance[node]:
+            continue
+        if dist > limit or settled >= max_settled:
+            break
+        settled += 1
+        for neighbor, edge in out_edges[node].items():
+            if neighbor == avoid:
+                continue
+            alternative = dist + edge_weight[edge]
+            if alternative < distance.get(neighbor, np.inf):
+                distance[neighbor] = alternative
+                heapq.heappush(heap, (alternative, neighbor))
+    return distance
+
+
+
+def dijkstra(graph, source, targets=None):
+    '''Runs Dijkstra's algorithm over a CompactGraph from the source
+    intersection id. If targets are given, the search stops as soon as
+    all of them are settled. Returns the distance and previous street
+    of every intersection that was reached, as dicts, and the number
+    of intersections that were expanded. Ties between intersections
+    at the same distance are broken by id.'''
+
+    out_lists = graph.out_lists()
+    remaining = None if targets is None else set(targets)
+
+    # A settled intersection is never reached by a shorter path, as
+    # the weights are not negative, so it needs no check of its own.
+    distance = { source:0.0 }
+    previous = { source:-1 }
+    settled = set()
+    heap = [ (0.0, source) ]
+    while heap:
+        dist, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled.add(node)
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+
+        for street, neighbor, weight in out_lists[node]:
+            alternative = dist + weight
+            if alternative < distance.get(neighbor, np.inf):
+                distance[neighbor] = alternative
+                previous[neighbor] = street
+                heapq.heappush(heap, (alternative, neighbor))
+
+    return distance, previous, len(settled)
+
+
+
+def astar(graph, source, target):
+    '''Runs A* search over a CompactGraph that has coordinates, from
+    the source to the target intersection id, guided by the Manhattan
+    distance to the target scaled by graph.manhattan_scale(). Returns
+    the previous street of every intersection on the path, as a dict,
+    and the number of intersections that were expanded. The path is
+    the one dijkstra finds, ties included.'''
+
+    offsets = graph.adjacency_lists()[2]
+    out_streets, out_head, out_weight = graph.out_arrays()
+    scale = graph.manhattan_scale()
+
+    # If the ids are numbered row by row, the coordinates of each
+    # neighbor are worked out as it is reached, from the estimated
+    # distances along the rows and the columns. Otherwise the
+    # estimated distance from every intersection to the target is
+    # computed up front, laid out like out_head.
+    width = graph.lattice_width
+    if width is not None:
+        target_row, target_column = divmod(target, width)
+        height = -(-graph.n_intersections // width)
+        row_estimate = [ scale * abs(row - target_row)
+                         for row in range(height) ]
+        column_estimate = [ scale * abs(column - target_column)
+                            for column in range(width) ]
+        out_estimate = None
+    else:
+        rows, columns = graph.coordinates.T
+        estimate = scale * (np.abs(rows - rows[target])
+                            + np.abs(columns - columns[target]))
+        out_estimate = estimate[out_head]
+
+    # The search goes on past the target until it has expanded every
+    # intersection whose estimated total is no more than the length of
+    # the shortest path, which includes every intersection that a
+    # shortest path can come from, so that the ties between them can
+    # be broken as dijkstra breaks them.
+    distance = { source:0.0 }
+    settled = set()
+    bound = np.inf
+    heap = [ (0.0, source) ]
+    while heap:
+        total, node = heapq.heappop(heap)
+        if total > bound:
+            break
+        if node in settled:
+            continue
+        settled.add(node)
+        dist = distance[node]
+        if node == target:
+            bound = dist + 1e-9 * max(dist, 1.0)
+
+        start, stop = offsets[node], offsets[node+1]
+        neighbors = out_head[start:stop].tolist()
+        if out_estimate is None:
+            estimates = [ row_estimate[neighbor // width]
+                          + column_estimate[neighbor % width]
+                          for neighbor in neighbors ]
+        else:
+            estimates = out_estimate[start:stop].tolist()
+        for neighbor, weight, estimate in zip(
+                neighbors, out_weight[start:stop].tolist(), estimates):
+            if neighbor in settled:
+                continue
+            alternative = dist + weight
+            if alternative < distance.get(neighbor, np.inf):
+                distance[neighbor] = alternative
+                heapq.heappush(heap, (alternative + estimate, neighbor))
+
+    if target not in settled:
+        return { source:-1 }, len(settled)
+    return _dijkstra_path(graph, distance, settled, source, target), \
+        len(settled)
+
+
+
+def _dijkstra_path(graph, distance, settled, source, target):
+    # Follows the path back from the target, choosing the previous
+    # street of every intersection as dijkstra does: the one from the
+    # intersection that dijkstra settles first, in order of distance
+    # and then id, among those that reach it at its distance.
+    tail = graph.tail
+    weight = graph.weight
+    in_offsets = graph.in_offsets
+    in_streets = graph.in_streets
+    previous = { source:-1 }
+    node = target
+    while node != source:
+        order = (distance[node], node)
+        best = None
+        for street in in_streets[in_offsets[node]:
+                                 in_offsets[node+1]].tolist():
+            neighbor = int(tail[street])
+            if neighbor not in settled:
+                continue
+            key = (distance[neighbor] + weight[street], distance[neighbor],
+                   neighbor)
+            if key[1:] < order and (best is None or key < best[0]):
+                best = (key, street)
+        previous[node] = best[1]
+        node = int(tail[best[1]])
+    return previous
+
+
+
+def bidirectional(graph, source, target):
+    '''Runs Dijkstra's algorithm over a CompactGraph from the source
+    forward and from the target backward at the same time, always
+    expanding the side whose next intersection is closer, until no
+    shorter path can be found. Returns the street ids of the shortest
+    path, which is empty if there is none, and the number of
+    intersections that were expanded.'''
+
+    if source == target:
+        return [], 0
+
+    # Each side keeps its distances, the streets it reached each
+    # intersection by, its settled intersections, and its heap.
+    sides = []
+    for start, arrays, offsets in (
+            (source, graph.out_arrays(), graph.out_offsets),
+            (target, graph.in_arrays(), graph.in_offsets)):
+        sides.append(({ start:0.0 }, { start:-1 }, set(),
+                      [ (0.0, start) ], arrays, offsets))
+
+    best = np.inf
+    meeting = None
+    expanded = 0
+    while sides[0][3] and sides[1][3]:
+        if sides[0][3][0][0] + sides[1][3][0][0] >= best:
+            break
+        side = 0 if sides[0][3][0][0] <= sides[1][3][0][0] else 1
+        distance, previous, settled, heap, arrays, offsets = sides[side]
+        other_distance = sides[1 - side][0]
+
+        dist, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled.add(node)
+        expanded += 1
+
+        streets, neighbors, weights = arrays
+        start, stop = offsets[node], offsets[node+1]
+        for street, neighbor, weight in zip(streets[start:stop].tolist(),
+                                            neighbors[start:stop].tolist(),
+                                            weights[start:stop].tolist()):
+            if neighbor in settled:
+                continue
+            alternative = dist + weight
+            if alternative < distance.get(neighbor, np.inf):
+                distance[neighbor] = alternative
+                previous[neighbor] = street
+                heapq.heappush(heap, (alternative, neighbor))
+            if neighbor in other_distance:
+                length = alternative + other_distance[neighbor]
+                if length < best:
+                    best = length
+                    meeting = neighbor
+
+    if meeting is None:
+        return [], expanded
+
+    # Join the forward path to the meeting intersection with the
+    # backward path from it.
+    path = trace(sides[0][1], graph.tail, meeting)
+    node = meeting
+    street = sides[1][1].get(node, -1)
+    while street >= 0:
+        path.append(street)
+        node = int(graph.head[street])
+        street = sides[1][1].get(node, -1)
+    return path, expanded
+
+
+
+def route(graph, source, target, algorithm='dijkstra'):
+    '''Computes the shortest path between two intersection ids of a
+    CompactGraph with the given algorithm, which is 'dijkstra',
+    'astar' (only for graphs with coordinates), or 'bidirectional'.
+    Returns the street ids of the path, which is empty if there is
+    none, and the number of intersections that were expanded.'''
+
+    if algorithm == 'dijkstra':
+        _, previous, expanded = dijkstra(graph, source, [target])
+        return trace(previous, graph.adjacency_lists()[0], target), expanded
+    elif algorithm == 'astar':
+        if graph.coordinates is None:
+            raise ValueError('A* search needs a graph with coordinates.')
+        previous, expanded = astar(graph, source, target)
+        return trace(previous, graph.adjacency_lists()[0], target), expanded
+    elif algorithm == 'bidirectional':
+        return bidirectional(graph, source, target)
+    else:
+        raise ValueError('Unknown routing algorithm {!r}.'.format(algorithm))
+
+
+
+def plan_routes(graph, od_pairs, workers=None, algorithm='dijkstra'):
+    '''Computes the shortest paths between many (source, target)
+    pairs of intersection ids of a CompactGraph in a pool of worker
+    processes; workers=None uses one per CPU, or none if there is
+    only one, and workers=0 computes them in this process. The graph's
+    arrays are copied once into
+    shared memory, which every worker reads from, and the pairs are
+    grouped by source so that each source needs only one search.
+    Returns a list of int32 arrays of street ids in the order of the
+    pairs; an array is empty if there is no path.'''
+
+    od_pairs = np.asarray(od_pairs, dtype=np.int64).reshape(-1, 2)
+    if len(od_pairs) == 0:
+        return []
+    order = np.argsort(od_pairs[:,0], kind='stable')
+    _, starts = np.unique(od_pairs[order,0], return_index=True)
+    groups = np.split(order, starts[1:])
+    tasks = [ (int(od_pairs[group[0],0]), od_pairs[group,1].tolist())
+              for group in groups ]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+        if workers == 1:
+            workers = 0
+    if workers == 0:
+        results = [ _plan_from(graph, source, targets, algorithm)
+                    for source, targets in tasks ]
+    else:
+        blocks = []
+        try:
+            layout = dict()
+            for name, array in _shared_arrays(graph).items():
+                block = shared_memory.SharedMemory(create=True,
+                                                   size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, array.dtype, block.buf)[...] = array
+                layout[name] = (block.name, array.shape, array.dtype.str)
+            with multiprocessing.Pool(workers, _attach_graph,
+                                      (graph.n_intersections,
+                                       graph.lattice_width, layout,
+                                       algorithm)) as pool:
+                results = pool.map(_plan_in_worker, tasks,
+                                   chunksize=max(1, len(tasks)
+                                                 // (4 * workers)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    paths = [None] * len(od_pairs)
+    for group, group_paths in zip(groups, results):
+        for pair, path in zip(group.tolist(), group_paths):
+            paths[pair] = path
+    return paths
+
+
+
+def _shared_arrays(graph):
+    arrays = { 'tail':graph.tail, 'head':graph.head, 'weight':graph.weight,
+               'out_streets':graph.out_streets,
+               'in_streets':graph.in_streets }
+    if graph.coordinates is not None:
+        arrays['coordinates'] = graph.coordinates
+    return arrays
+
+
+
+def _plan_from(graph, source, targets, algorithm):
+    '''The paths from one source to each of its targets: with one
+    Dijkstra search, shared by all of them, if there are several.'''
+
+    if len(targets) == 1:
+        path, _ = route(graph, source, targets[0], algorithm)
+        return [ np.array(path, dtype=np.int32) ]
+    _, previous, _ = dijkstra(graph, source, targets)
+    tail = graph.adjacency_lists()[0]
+    return [ np.array(trace(previous, tail, target), dtype=np.int32)
+             for target in targets ]
+
+
+
+# The graph that a worker process of plan_routes reads from, and the
+# shared memory blocks behind it.
+_worker = dict()
+
+
+
+def _attach_graph(n_intersections, lattice_width, layout, algorithm):
+    from traffic_components import CompactGraph
+
+    blocks = { name:shared_memory.SharedMemory(block_name)
+               for name, (block_name, _, _) in layout.items() }
+    arrays = { name:np.ndarray(shape, np.dtype(dtype), blocks[name].buf)
+               for name, (_, shape, dtype) in layout.items() }
+    graph = CompactGraph(n_intersections, arrays['tail'], arrays['head'],
+                         arrays['weight'], arrays['out_streets'],
+                         arrays['in_streets'])
+    graph.coordinates = arrays.get('coordinates')
+    graph.lattice_width = lattice_width
+    _worker.update(graph=graph, blocks=blocks, algorithm=algorithm)
+
+
+
+def _plan_in_worker(task):
+    source, targets = task
+    return _plan_from(_worker['graph'], source, targets, _worker['algorithm'])
+
+
+
+def trace(previous, tail, destination):
+    '''Follows the previous streets back from the destination and
+    returns the street ids of the path that leads to it, which is
+    empty if the destination was not reached. previous may be a dict
+    or an array.'''
+
+    path = []
+    node = destination
+    street = _previous(previous, node)
+    while street >= 0:
+        path.append(street)
+        node = int(tail[street])
+        street = _previous(previous, node)
+    path.reverse()
+    return path
+
+
+
+def _previous(previous, node):
+    if isinstance(previous, dict):
+        return previous.get(node, -1)
+    return int(previous[node])
@@ -0,0 +1,175 @@
+import numpy as np
+from traffic_components import *
+
+
+
+class SignalController:
+    '''The traffic lights of a street network. A signalled
+    intersection cycles through phases, each of which turns some of
+    its instreets green; the cars at the front of the other instreets
+    have to wait. Instreets of intersections without a signal are
+    always green. A fixed-time signal holds every phase for its
+    duration. An actuated signal holds a phase for at least min_green
+    ticks, and then moves on as soon as its green streets are empty
+    while cars wait at a red one, or after max_green ticks.
+
+    The state of every signal lives in arrays indexed by intersection
+    id, and the phase of every instreet in an array indexed by street
+    id (-1 for streets that are always green), so that step advances
+    all of the signals at once with a few array operations, and
+    green holds whether every street may move. The controller
+    registers itself as the signals of its network, which makes cars
+    refuse to run red lights and Simulation only move cars with a
+    green light.'''
+
+    def __init__(self, network):
+        graph = network.compact_graph()
+        n = graph.n_intersections
+        self.network = network
+        self.head = graph.head
+        self.street_phase = np.full(graph.n_streets, -1, dtype=np.int32)
+        self.n_phases = np.zeros(n, dtype=np.int32)
+        self.phase = np.zeros(n, dtype=np.int32)
+        self.elapsed = np.zeros(n, dtype=np.int64)
+        self.durations = np.zeros((n, 1), dtype=np.int64)
+        self.actuated = np.zeros(n, dtype=bool)
+        self.min_green = np.zeros(n, dtype=np.int64)
+        self.max_green = np.zeros(n, dtype=np.int64)
+        self.green = np.ones(graph.n_streets, dtype=bool)
+
+        network.signals = self
+
+    def set_fixed_time(self, intersection, phases, durations):
+        '''Gives an intersection a fixed-time signal. phases is a list
+        of the lists of instreets that each phase turns green, and
+        durations the number of ticks that each phase lasts.'''
+
+        node = self._set_phases(intersection, phases)
+        self.durations[node, :len(phases)] = durations
+        self.actuated[node] = False
+        self._update_green()
+
+    def set_actuated(self, intersection, phases, min_green=5, max_green=30):
+        '''Gives an intersection an actuated signal. phases is a list
+        of the lists of instreets that each phase turns green.'''
+
+        node = self._set_phases(intersection, phases)
+        self.actuated[node] = True
+        self.min_green[node] = min_green
+        self.max_green[node] = max_green
+        self._update_green()
+
+    def signalize_all(self, durations=(10, 10), actuated=False, min_green=5,
+                      max_green=30):
+        '''Gives every intersection with more than one instreet a
+        signal of the same kind. On a lattice there are two phases, for
+        the north and south streets and for the east and west streets;
+        elsewhere every instreet has a phase of its own. durations
+        holds the duration of each phase of fixed-time signals, or one
+        duration for all of them.'''
+
+        graph = self.network.compact_graph()
+        degree = np.diff(graph.in_offsets)
+        signalled = degree > 1
+        _, north, east, south, west = self.network.lattice_ids()
+        if north is not None:
+            n_phases = np.where(signalled, 2, 0)
+            self.street_phase[:] = -1
+            self.street_phase[np.concatenate([north, south])] = 0
+            self.street_phase[np.concatenate([east, west])] = 1
+        else:
+            n_phases = np.where(signalled, degree, 0)
+            position = (np.arange(graph.n_streets)
+                        - graph.in_offsets[graph.head[graph.in_streets]])
+            self.street_phase[graph.in_streets] = position
+        self.street_phase[~signalled[graph.head]] = -1
+
+        self._reserve_phases(int(n_phases.max(initial=1)))
+        self.n_phases[:] = n_phases
+        self.phase[:] = 0
+        self.elapsed[:] = 0
+        self.durations[:] = np.broadcast_to(
+            np.resize(np.asarray(durations), self.durations.shape[1]),
+            self.durations.shape)
+        self.actuated[:] = actuated & signalled
+        self.min_green[:] = min_green
+        self.max_green[:] = max_green
+        self._update_green()
+
+    def _set_phases(self, intersection, phases):
+        node = self.network.intersection_id(intersection)
+        graph = self.network.compact_graph()
+        self.street_phase[graph.instreet_ids(node)] = -1
+        for phase, streets in enumerate(phases):
+            self.street_phase[[ self.network.street_id(street)
+                                for street in streets ]] = phase
+        self._reserve_phases(len(phases))
+        self.n_phases[node] = len(phases)
+        self.phase[node] = 0
+        self.elapsed[node] = 0
+        return node
+
+    def _reserve_phases(self, n_phases):
+        if n_phases > self.durations.shape[1]:
+            grown = np.zeros((len(self.durations), n_phases), dtype=np.int64)
+            grown[:, :self.durations.shape[1]] = self.durations
+            self.durations = grown
+
+    def step(self):
+        '''Advances every signal by one tick. Returns the number of
+        signals that changed phase.'''
+
+        signalled = self.n_phases > 0
+        self.elapsed += 1
+        nodes = np.arange(len(self.phase))
+        switch = (signalled & ~self.actuated
+                  & (self.elapsed >= self.durations[nodes, self.phase]))
+
+        if self.actuated.any():
+            current, waiting = self._demand()
+            switch |= (self.actuated
+                       & (self.elapsed >= self.min_green)
+                       & ((self.elapsed >= self.max_green)
+                          | ((current == 0) & (waiting > 0))))
+
+        self.phase[switch] = (self.phase[switch] + 1) % self.n_phases[switch]
+        self.elapsed[switch] = 0
+        self._update_green()
+        return int(np.count_nonzero(switch))
+
+    def set_state(self, phase, elapsed):
+        '''Sets the phase of every signal and the number of ticks it
+        has been in it, e.g., from a Checkpoint.'''
+
+        self.phase[:] = phase
+        self.elapsed[:] = elapsed
+        self._update_green()
+
+    def _demand(self):
+        # The number of cars on the green and on the red instreets of
+        # every intersection.
+        n = len(self.phase)
+        lengths = self.network.queue_lengths()
+        signalled = self.street_phase >= 0
+        green = np.bincount(self.head[self.green & signalled],
+                            weights=lengths[self.green & signalled],
+                            minlength=n)
+        red = np.bincount(self.head[~self.green],
+                          weights=lengths[~self.green], minlength=n)
+        return green, red
+
+    def _update_green(self):
+        self.green = ((self.street_phase < 0)
+                      | (self.street_phase == self.phase[self.head]))
+
+    def is_green(self, street):
+        '''Whether the light at the head of a street is green.'''
+
+        return bool(self.green[self.network.street_id(street)])
+
+    def green_streets(self, intersection):
+        '''The instreets of an intersection whose light is green.'''
+
+        graph = self.network.compact_graph()
+        ids = graph.instreet_ids(self.network.intersection_id(intersection))
+        return self.network.streets_of(ids[self.green[ids]])
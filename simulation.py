@@ -0,0 +1,199 @@
+import time
+from traffic_components import *
+from checkpoint import Checkpoint
+
+
+
+class Simulation:
+    '''A time-stepped simulation of the cars in a street network. On
+    every tick, the car at the front of each occupied street moves
+    once: it either enters the next street on its path or, at the
+    end of its path, leaves the network. All of a tick's movers are
+    chosen before any of them moves, so a car that enters a street
+    on this tick waits until the next one. Cars of a CarPopulation
+    that depart on a tick enter the network before its movers are
+    chosen, and then the rerouter, if there is one, may change the
+    paths of cars around congestion. If the network has traffic
+    lights, only the cars facing a green light move, and the lights
+    advance at the end of the tick. Movers are processed in the order
+    of their streets in the network, which makes every run
+    deterministic. If the network has limited capacities, a car can
+    only enter a street with room for it, possibly the room that the
+    street's front car leaves as it moves on in the same tick; cars
+    that cannot advance are counted in blocked, and the cycles of
+    streets whose front cars wait on each other are gridlocks.'''
+
+    def __init__(self, network, rerouter=None):
+        self.network = network
+        self.rerouter = rerouter
+        self.tick = 0
+        self.moves = 0
+        self.blocked = 0
+        self.gridlocks = []
+        self.elapsed = 0.0
+        self._position = dict()
+
+    def step(self):
+        '''Advances the simulation by one tick. Returns the number of
+        cars that moved.'''
+
+        start = time.perf_counter()
+        network = self.network
+        metrics = network.metrics
+        if metrics is not None:
+            metrics.start_tick(self.tick)
+        if network.recorder is not None:
+            network.recorder.time = self.tick
+
+        for population in network.populations:
+            population.release(self.tick)
+        if metrics is not None:
+            metrics.lap('release')
+        if self.rerouter is not None:
+            self.rerouter.step(self.tick)
+        if metrics is not None:
+            metrics.lap('routing')
+        streets = sorted(network.occupied, key=self._street_order)
+        signals = network.signals
+        if signals is not None:
+            green = signals.green
+            street_id = network.street_id
+            streets = [ street for street in streets
+                        if green[street_id(street)] ]
+        movers = [ street.q.peek() for street in streets ]
+        if network.capacity_limited:
+            movers = self._advancing(streets, movers)
+        if metrics is not None:
+            moved_from = [ network.street_id(car.location) for car in movers ]
+        if network.recorder is not None:
+            # Cars finish moving at the end of the tick.
+            network.recorder.time = self.tick + 1
+        for car in movers:
+            car.move()
+        if metrics is not None:
+            metrics.lap('movement')
+        if signals is not None:
+            signals.step()
+        if metrics is not None:
+            metrics.lap('signals')
+            metrics.end_tick(moved_from)
+
+        self.tick += 1
+        self.moves += len(movers)
+        self.elapsed += time.perf_counter() - start
+        return len(movers)
+
+    def _advancing(self, streets, movers):
+        # Finds which of the movers can advance into streets with
+        # bounded queues, and returns them in an order in which they
+        # can move one at a time. The movers into a street take its
+        # free places in the order of their own streets, and the first
+        # one that finds no place may still take the place of the car
+        # at the front of the street if that car advances too. Every
+        # mover thus depends on at most one other, and following these
+        # dependencies settles each mover once; a chain that comes
+        # back on itself is a gridlock, in which no car can advance.
+        position = { street:i for i, street in enumerate(streets) }
+        depends = []
+        entering = dict()
+        for car in movers:
+            target = car.next_street()
+            if target is None:
+                depends.append(-1)
+                continue
+            rank = entering.get(target, 0)
+            entering[target] = rank + 1
+            q = target.q
+            free = q.maxsize - len(q) if q.maxsize > 0 else rank + 1
+            if rank < free:
+                depends.append(-1)
+            elif rank == free and target in position:
+                depends.append(position[target])
+            else:
+                depends.append(-2)
+
+        # 0: unvisited, 1: on the current chain, 2: settled.
+        state = [0] * len(movers)
+        advances = [False] * len(movers)
+        order = []
+        self.gridlocks = []
+        for i in range(len(movers)):
+            chain = []
+            j = i
+            while j >= 0 and state[j] == 0:
+                state[j] = 1
+                chain.append(j)
+                j = depends[j]
+            if j == -1:
+                result = True
+            elif j == -2:
+                result = False
+            elif state[j] == 1:
+                result = False
+                self.gridlocks.append(
+                    [ streets[k] for k in chain[chain.index(j):] ])
+            else:
+                result = advances[j]
+            for k in reversed(chain):
+                state[k] = 2
+                advances[k] = result
+                if result:
+                    order.append(k)
+        self.blocked += len(movers) - len(order)
+        return [ movers[k] for k in order ]
+
+    def run(self, n_ticks):
+        '''Advances the simulation by n_ticks ticks, stopping early if
+        no cars are left on the road or waiting to depart. Returns the
+        number of car movements.'''
+
+        moves = 0
+        for _ in range(n_ticks):
+            if not self.network.occupied and not any(
+                    population.waiting
+                    for population in self.network.populations):
+                break
+            moves += self.step()
+        return moves
+
+    def synchronize(self):
+        '''Brings the network up to date with the simulation, which it
+        always is unless the cars are moved in other processes.'''
+
+        pass
+
+    def checkpoint(self):
+        '''Records the state of the simulation in a Checkpoint, which
+        can be saved to disk and restored any number of times.'''
+
+        return Checkpoint.capture(self.network, self.tick)
+
+    @classmethod
+    def restore(cls, network, checkpoint, population=None):
+        '''Resumes a simulation from a checkpoint in a network with the
+        same streets and no cars, e.g., one freshly loaded from disk.
+        The cars are restored into the population if one is given.'''
+
+        checkpoint.restore(network, population)
+        simulation = cls(network)
+        simulation.tick = checkpoint.tick
+        return simulation
+
+    @property
+    def throughput(self):
+        '''The number of car movements per second of wall time spent
+        stepping the simulation.'''
+
+        if self.elapsed == 0:
+            return 0.0
+        return self.moves / self.elapsed
+
+    def _street_order(self, street):
+        if self.network.graph is not None:
+            return street.id
+        position = self._position.get(street)
+        if position is None:
+            self._position = { street:i for i, street
+                               in enumerate(self.network.streets) }
+            position = self._position[street]
+        return position
@@ -1,7 +1,21 @@
 from traffic_components import *
 from traffic_map import *
+from simulation import *
+from checkpoint import *
+from population import *
+from rerouting import *
+from signals import *
+from partition import *
+from instrumentation import *
+from events import *
+from ensemble import *
+from recorder import *
 from nose.tools import *
 import numpy as np
+import json
+import queue
+import os
+import tempfile
 
 
 def test_contruct_simple_network():
@@ -58,7 +72,7 @@ def test_contruct_simple_network():
     car = Car([BC], network1)
     assert car in BC.q.queue
     assert_raises(CannotCutStreetError,
-                  network1.cut_street(BC))
+                  network1.cut_street, BC)
     
 
 
@@ -92,6 +106,8 @@ def test_cars_on_simple_network():
     car3 = Car([BC, CB], network)
     assert car3 in network.cars
     assert_raises(NotAtFrontOfQueueError, car3.move)
+    assert_equal(car2, BC.q.peek())
+    assert_equal(2, BC.q.qsize())
 
     # Move car2 then car3.
     car2.move()
@@ -282,4 +298,1228 @@ def test_grid_with_weights():
 def test_traffic_map():
     network = StreetNetwork.square_lattice(5, 7)
 
-    TrafficMap(network).draw()
+    img = TrafficMap(network).draw()
+    assert_equal((600, 600), img.size)
+
+    # A street with cars on it is painted in a congestion color
+    # instead of the color of empty streets.
+    traffic_map = TrafficMap(network, jam_length=2)
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[4][6])
+    before = traffic_map.render_indexed()
+    Car(path, network)
+    Car(path, network)
+    after = traffic_map.render_indexed()
+    street = network.street_id(path[0])
+    pixels = traffic_map.street_pixels[traffic_map.pixel_streets == street]
+    assert (before.ravel()[pixels] == 2).all()
+    assert (after.ravel()[pixels] == 2 + traffic_map.levels).all()
+    assert_equal(np.count_nonzero(before != after), len(pixels))
+    assert_raises(CannotMapError, TrafficMap,
+                  StreetNetwork.no_cars([], []))
+
+    # Frames are streamed once per tick.
+    directory = tempfile.mkdtemp()
+    traffic_map.record(Simulation(network), 3,
+                       os.path.join(directory, 'frame{}.png'))
+    assert_equal(['frame0.png', 'frame1.png', 'frame2.png', 'frame3.png'],
+                 sorted(os.listdir(directory)))
+    gif = os.path.join(directory, 'run.gif')
+    traffic_map.record(Simulation(network), 3, gif)
+    with Image.open(gif) as image:
+        assert_equal(4, image.n_frames)
+        image.seek(3)
+        assert_equal(traffic_map.palette[traffic_map.render_indexed()]
+                     .tolist(), np.array(image.convert('RGB')).tolist())
+
+
+
+def test_shortest_path_on_weighted_grid():
+    # Compare the length of every route on a randomly weighted grid
+    # with the distances found by a plain Bellman-Ford relaxation.
+    height = 6
+    width = 7
+    rng = np.random.RandomState(0)
+    network = StreetNetwork.square_lattice(
+        height, width,
+        rng.randint(1, 10, (height-1, width)),
+        rng.randint(1, 10, (height, width-1)),
+        rng.randint(1, 10, (height-1, width)),
+        rng.randint(1, 10, (height, width-1)))
+
+    source = network.lattice[0][0]
+    distance = { node:float('inf') for node in network.intersections }
+    distance[source] = 0
+    for _ in network.intersections:
+        for street in network.streets:
+            alternative = distance[street.tail] + street.weight
+            if alternative < distance[street.head]:
+                distance[street.head] = alternative
+
+    for destination in network.intersections:
+        if destination == source:
+            continue
+        path = network.shortest_path(source, destination)
+        assert_equal(path[0].tail, source)
+        assert_equal(path[-1].head, destination)
+        for street, next_street in zip(path, path[1:]):
+            assert next_street in street.head.outstreets
+        assert_equal(distance[destination],
+                     sum(street.weight for street in path))
+
+
+
+def test_compact_network():
+    height = 4
+    width = 5
+    rng = np.random.RandomState(1)
+    network = StreetNetwork.square_lattice(
+        height, width,
+        rng.randint(1, 10, (height-1, width)),
+        rng.randint(1, 10, (height, width-1)),
+        rng.randint(1, 10, (height-1, width)),
+        rng.randint(1, 10, (height, width-1)))
+    compact = network.compact()
+
+    # Check that the compact network has the same topology, labels,
+    # and weights, and that its views behave like the originals.
+    assert_equal(len(network.intersections), len(compact.intersections))
+    assert_equal(len(network.streets), len(compact.streets))
+    for street, view in zip(network.streets, compact.streets):
+        assert_equal(street.label, view.label)
+        assert_equal(street.weight, view.weight)
+        assert_equal(street.tail.label, view.tail.label)
+        assert_equal(street.head.label, view.head.label)
+        assert_equal([ s.label for s in street.head.outstreets ],
+                     [ s.label for s in view.head.outstreets ])
+        assert view in view.tail.outstreets
+        assert view in view.head.instreets
+    assert_equal(compact.lattice[2][3].label, (2,3))
+    assert_equal(str(compact.north_streets[0]), str(network.north_streets[0]))
+
+    # Routes are the same in both representations.
+    source = network.lattice[0][0]
+    destination = network.lattice[-1][-1]
+    path = network.shortest_path(source, destination)
+    compact_path = compact.shortest_path(compact.lattice[0][0],
+                                         compact.lattice[-1][-1])
+    assert_equal([ street.label for street in path ],
+                 [ street.label for street in compact_path ])
+
+    # Cars move along compact streets.
+    car = Car(compact_path, compact)
+    assert car in compact_path[0].q.queue
+    for street in compact_path[1:]:
+        car.move()
+        assert_equal(car.location, street)
+    car.move()
+    assert car not in compact.cars
+    assert_raises(CannotCutStreetError, compact.cut_street, compact_path[0])
+
+    # The compact graph is far smaller than the objects it replaces.
+    assert compact.graph.nbytes < 40 * len(compact.streets)
+
+
+
+def test_grid_directional_weights():
+    height = 4
+    width = 3
+    weights = { 'North':1 * np.ones((height-1, width)),
+                'East':2 * np.ones((height, width-1)),
+                'South':3 * np.ones((height-1, width)),
+                'West':4 * np.ones((height, width-1)) }
+
+    # Each street gets the weight of its own direction, in both the
+    # object and the compact lattice, and the two are identical.
+    network = StreetNetwork.square_lattice(
+        height, width, weights['North'], weights['East'],
+        weights['South'], weights['West'])
+    compact = StreetNetwork.square_lattice(
+        height, width, weights['North'], weights['East'],
+        weights['South'], weights['West'], compact=True)
+    for street, view in zip(network.streets, compact.streets):
+        direction = street.label.split(':')[0]
+        assert_equal(street.weight, weights[direction][0][0])
+        assert_equal(street.label, view.label)
+        assert_equal(street.weight, view.weight)
+    for node, view in zip(network.intersections, compact.intersections):
+        assert_equal(node.label, view.label)
+        assert_equal([ street.label for street in node.outstreets ],
+                     [ street.label for street in view.outstreets ])
+        assert_equal([ street.label for street in node.instreets ],
+                     [ street.label for street in view.instreets ])
+    assert_equal('North: (1,2)->(0,2)', network.north_streets[2].label)
+
+    assert_raises(LatticeDimensionsError,
+                  StreetNetwork.square_lattice, height, width,
+                  None, [[1, 1], [1, 1], [1], [1, 1]], compact=True)
+
+
+
+def test_simulation():
+    network = StreetNetwork.square_lattice(4, 4)
+    corner = network.lattice[0][0]
+    path = network.shortest_path(corner, network.lattice[3][3])
+
+    # Two cars queue up behind each other on the same route; a third
+    # car's route revisits a street, which the path cursor allows.
+    first = Car(path, network)
+    second = Car(path, network)
+    loop = [ street for street in corner.outstreets
+             if street != path[0] ]
+    loop.append([ street for street in loop[0].head.outstreets
+                  if street.head == corner ][0])
+    loop.append(loop[0])
+    third = Car(loop, network)
+    assert_equal(2, len(network.occupied))
+
+    simulation = Simulation(network)
+    assert_equal(2, simulation.step())
+    assert_equal(first.location, path[1])
+    assert_equal(second.location, path[0])
+    assert_equal(third.location, loop[1])
+    assert_equal(1, third.cursor)
+
+    # Each car moves at most once per tick, and every car leaves the
+    # network once its path is done.
+    simulation.run(100)
+    assert_equal(0, len(network.cars))
+    assert_equal(0, len(network.occupied))
+    assert_equal(2 * len(path) + len(loop), simulation.moves)
+    assert_equal(len(path) + 1, simulation.tick)
+    assert simulation.throughput > 0
+
+
+
+def test_street_queue():
+    q = StreetQueue(maxsize=2)
+    assert q.empty()
+    assert_equal(None, q.peek())
+    assert_raises(queue.Empty, q.get)
+    q.put('a')
+    q.put('b')
+    assert q.full()
+    assert_raises(queue.Full, q.put, 'c')
+    assert_equal('a', q.peek())
+    assert_equal('a', q.get())
+    assert_equal(['b'], list(q))
+    assert not q.empty()
+    assert not StreetQueue().full()
+
+
+
+def test_route_cache():
+    network = StreetNetwork.square_lattice(4, 5)
+    source = network.lattice[0][0]
+    destinations = [ network.lattice[3][4], network.lattice[2][1],
+                     network.lattice[0][4] ]
+
+    # A one-to-many query caches the tree of its source, and later
+    # queries from that source are answered from it.
+    paths = network.shortest_paths_from(source, destinations)
+    assert_equal(1, len(network.routes))
+    for destination, path in zip(destinations, paths):
+        assert_equal(path, network.shortest_path(source, destination))
+    assert_equal(len(destinations), network.routes.hits)
+
+    # Changing a weight or cutting a street invalidates the cache.
+    detour = paths[2][0]
+    detour.weight = 100
+    assert paths[2][0] not in network.shortest_path(source, destinations[2])
+    assert_equal(0, len(network.routes))
+    network.shortest_paths_from(source, destinations)
+    network.cut_street(paths[0][-1])
+    assert paths[0][-1] not in network.shortest_path(source,
+                                                     destinations[0])
+    assert_equal(0, len(network.routes))
+
+    # The cache evicts the least recently used trees to stay within
+    # its memory budget.
+    tree_bytes = network.shortest_path_tree(source).nbytes
+    network.routes = routing.RouteCache(max_bytes=2 * tree_bytes)
+    for node in network.lattice[1][:3]:
+        network.shortest_path_tree(node)
+    assert_equal(2, len(network.routes))
+    assert network.intersection_id(network.lattice[1][0]) not in network.routes
+    assert network.intersection_id(network.lattice[1][2]) in network.routes
+
+
+
+def test_routing_algorithms():
+    height = 9
+    width = 8
+    rng = np.random.RandomState(2)
+    network = StreetNetwork.square_lattice(
+        height, width,
+        rng.randint(2, 9, (height-1, width)),
+        rng.randint(2, 9, (height, width-1)),
+        rng.randint(2, 9, (height-1, width)),
+        rng.randint(2, 9, (height, width-1)),
+        compact=True)
+    graph = network.compact_graph()
+    assert_equal(2, graph.manhattan_scale())
+
+    # Every algorithm finds a path as short as Dijkstra's, and A* and
+    # the bidirectional search expand fewer intersections.
+    source = network.lattice[1][1]
+    destination = network.lattice[7][6]
+    s = network.intersection_id(source)
+    d = network.intersection_id(destination)
+    length = dict()
+    expanded = dict()
+    for algorithm in ('dijkstra', 'astar', 'bidirectional'):
+        path = network.shortest_path(source, destination, algorithm)
+        assert_equal(source, path[0].tail)
+        assert_equal(destination, path[-1].head)
+        for street, next_street in zip(path, path[1:]):
+            assert_equal(street.head, next_street.tail)
+        length[algorithm] = sum(street.weight for street in path)
+        assert_equal(length['dijkstra'], length[algorithm])
+        _, expanded[algorithm] = routing.route(graph, s, d, algorithm)
+    assert expanded['astar'] < expanded['dijkstra']
+    assert expanded['bidirectional'] < expanded['dijkstra']
+
+    # The tie-breaking of the plain network in test_shortest_path is
+    # unchanged, since it has no lattice.
+    A, B, C = Intersection('A'), Intersection('B'), Intersection('C')
+    plain = StreetNetwork.no_cars([A, B, C], [Street(A, B), Street(B, C)])
+    assert_raises(ValueError, plain.shortest_path, A, C, 'astar')
+    assert_raises(DisconnectedPathError,
+                  plain.shortest_path, C, A, 'bidirectional')
+    assert_equal(plain.shortest_path(A, C),
+                 plain.shortest_path(A, C, 'bidirectional'))
+
+
+
+def test_contraction_hierarchy():
+    height = 6
+    width = 7
+    rng = np.random.RandomState(4)
+    network = StreetNetwork.square_lattice(
+        height, width,
+        rng.randint(1, 9, (height-1, width)),
+        rng.randint(1, 9, (height, width-1)),
+        rng.randint(1, 9, (height-1, width)),
+        rng.randint(1, 9, (height, width-1)))
+    source = network.lattice[0][1]
+    assert_raises(ValueError, network.shortest_path, source, source, 'ch')
+
+    # Build the hierarchy once and load it back from disk.
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'hierarchy.npz')
+    built = network.build_contraction_hierarchy(path)
+    loaded = network.build_contraction_hierarchy(path)
+    assert built is not loaded
+    assert_equal(built.fingerprint, loaded.fingerprint)
+    assert network.has_current_hierarchy()
+
+    # Routes through the hierarchy are as short as Dijkstra's.
+    def length(path):
+        return sum(street.weight for street in path)
+    for destination in network.intersections:
+        if destination == source:
+            continue
+        path = network.shortest_path(source, destination)
+        assert_equal(length(network.shortest_path(source, destination,
+                                                  'dijkstra')),
+                     length(path))
+        assert_equal(source, path[0].tail)
+        assert_equal(destination, path[-1].head)
+
+    # Once the network changes, routing falls back to searching it.
+    street = network.streets[0]
+    street.weight = 1000
+    assert not network.has_current_hierarchy()
+    assert not loaded.fits(network.compact_graph())
+    path = network.shortest_path(street.tail, street.head, 'ch')
+    assert street not in path
+
+
+
+def test_plan_routes():
+    network = StreetNetwork.square_lattice(5, 6)
+    corner = network.lattice[0][0]
+    od_pairs = [ (corner, node) for node in network.intersections[1:] ]
+    od_pairs += [ (network.lattice[4][5], corner),
+                  (network.lattice[2][3], network.lattice[1][1]) ]
+
+    # Routes planned by worker processes match the ones planned here,
+    # and turn back into paths that cars can follow.
+    routes = network.plan_routes(od_pairs, workers=2)
+    assert_equal(len(od_pairs), len(routes))
+    for (source, destination), route in zip(od_pairs, routes):
+        path = network.streets_of(route)
+        assert_equal(len(network.shortest_path(source, destination)),
+                     len(path))
+        assert_equal(source, path[0].tail)
+        assert_equal(destination, path[-1].head)
+    car = Car(network.streets_of(routes[-1]), network)
+    Simulation(network).run(100)
+    assert car not in network.cars
+
+    local = network.plan_routes(od_pairs, workers=0)
+    assert_equal([ route.tolist() for route in routes ],
+                 [ route.tolist() for route in local ])
+    assert_equal(0, len(network.plan_routes([(corner, corner)],
+                                            workers=0)[0]))
+
+    # A worker sees the graph as a lattice, as this process does, so
+    # that A* works out its estimates the same cheap way.
+    from multiprocessing import shared_memory
+    graph = network.compact_graph()
+    blocks, layout = [], dict()
+    for name, array in routing._shared_arrays(graph).items():
+        block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        blocks.append(block)
+        np.ndarray(array.shape, array.dtype, block.buf)[...] = array
+        layout[name] = (block.name, array.shape, array.dtype.str)
+    routing._attach_graph(graph.n_intersections, graph.lattice_width,
+                          layout, 'astar')
+    worker_graph = routing._worker.pop('graph')
+    assert_equal(6, worker_graph.lattice_width)
+    assert_equal(routing.route(graph, 0, 29, 'astar'),
+                 routing.route(worker_graph, 0, 29, 'astar'))
+    for block in routing._worker.pop('blocks').values():
+        block.close()
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+
+def test_save_and_load():
+    directory = tempfile.mkdtemp()
+
+    # A lattice comes back with the same streets, weights, labels,
+    # and routes, and its arrays are mapped from the files.
+    rng = np.random.RandomState(6)
+    network = StreetNetwork.square_lattice(
+        3, 4, rng.randint(1, 9, (2, 4)), rng.randint(1, 9, (3, 3)),
+        rng.randint(1, 9, (2, 4)), rng.randint(1, 9, (3, 3)))
+    path = os.path.join(directory, 'lattice')
+    network.save(path)
+    loaded = StreetNetwork.load(path)
+    assert isinstance(loaded.graph.weight.base, np.memmap)
+    assert_equal([ (street.label, street.weight)
+                   for street in network.streets ],
+                 [ (street.label, street.weight)
+                   for street in loaded.streets ])
+    assert_equal([ street.label for street in network.west_streets ],
+                 [ street.label for street in loaded.west_streets ])
+    assert_equal(network.lattice[2][1].label, loaded.lattice[2][1].label)
+    source, destination = network.lattice[0][0], network.lattice[2][3]
+    assert_equal([ street.label for street
+                   in network.shortest_path(source, destination) ],
+                 [ street.label for street
+                   in loaded.shortest_path(loaded.lattice[0][0],
+                                           loaded.lattice[2][3]) ])
+
+    # Weights changed after loading stay private to the process.
+    loaded.streets[0].weight = 50
+    assert_equal(network.streets[0].weight,
+                 StreetNetwork.load(path).streets[0].weight)
+    read_only = StreetNetwork.load(path, mmap_mode='r')
+    assert_raises(ValueError, setattr, read_only.streets[0], 'weight', 2)
+
+    # Other networks keep their own labels.
+    A, B, C = Intersection('A'), Intersection(('B', 1)), Intersection()
+    AB, BC = Street(A, B, 2, 'AB'), Street(B, C, 3)
+    path = os.path.join(directory, 'plain')
+    StreetNetwork.no_cars([A, B, C], [AB, BC]).save(path)
+    loaded = StreetNetwork.load(path)
+    assert_equal(['A', ('B', 1), None],
+                 [ node.label for node in loaded.intersections ])
+    assert_equal(['AB', None], [ street.label for street in loaded.streets ])
+    assert_equal(5, sum(street.weight for street in
+                        loaded.shortest_path(loaded.intersections[0],
+                                             loaded.intersections[2])))
+    assert_equal(None, loaded.lattice)
+
+
+
+def test_checkpoint():
+    directory = tempfile.mkdtemp()
+    rng = np.random.RandomState(7)
+    network = StreetNetwork.square_lattice(4, 5)
+    network_path = os.path.join(directory, 'network')
+    network.save(network_path)
+    for _ in range(30):
+        source, destination = rng.choice(network.intersections, 2,
+                                         replace=False)
+        Car(network.shortest_path(source, destination), network)
+    simulation = Simulation(network)
+    simulation.run(3)
+
+    # Save the warm state, then fork it into two fresh networks.
+    checkpoint_path = os.path.join(directory, 'checkpoint.npz')
+    simulation.checkpoint().save(checkpoint_path)
+    checkpoint = Checkpoint.load(checkpoint_path)
+    forks = [ Simulation.restore(StreetNetwork.load(network_path), checkpoint)
+              for _ in range(2) ]
+    assert_equal(3, forks[0].tick)
+    assert_raises(CannotRestoreError, checkpoint.restore, forks[0].network)
+
+    # Every copy carries on exactly as the original does.
+    def state(network):
+        return [ (street.label, [ [ s.label for s in car.path[car.cursor:] ]
+                                  for car in street.q ])
+                 for street in sorted(network.occupied,
+                                      key=network.street_id) ]
+    for _ in range(4):
+        assert_equal(state(network), state(forks[0].network))
+        assert_equal(state(network), state(forks[1].network))
+        for copy in [simulation] + forks:
+            copy.step()
+    assert_equal(len(network.cars), len(forks[1].network.cars))
+
+
+
+def test_car_population():
+    network = StreetNetwork.square_lattice(4, 4, compact=True)
+    population = CarPopulation(network, capacity=2)
+    corner = network.lattice[0][0]
+    paths = [ network.shortest_path(corner, node)
+              for node in network.intersections[1:] ]
+
+    # Population cars behave like Car objects: they queue, move along
+    # their paths, and leave the network at the end.
+    views = [ population.add(path) for path in paths ]
+    assert_equal(len(paths), len(population))
+    first = views[0]
+    assert_equal(paths[0][0], first.location)
+    assert first in paths[0][0].q.queue
+    assert_equal(paths[0], first.path)
+    assert_raises(NotAtFrontOfQueueError, views[1].move)
+    assert_equal(population.car(0), paths[0][0].q.peek())
+
+    # A population runs in a simulation alongside Car objects, and the
+    # two advance the same way.
+    twin = StreetNetwork.square_lattice(4, 4, compact=True)
+    twin_cars = [ Car(twin.streets_of([ street.id for street in path ]),
+                      twin) for path in paths ]
+    simulation = Simulation(network)
+    twin_simulation = Simulation(twin)
+    for _ in range(3):
+        simulation.step()
+        twin_simulation.step()
+    assert_equal([ car.cursor for car in twin_cars if car.location ],
+                 [ car.cursor for car in population.cars() ])
+    assert_equal(len(twin.cars), len(population))
+
+    # Checkpoints carry population cars, and can restore them into
+    # another population.
+    checkpoint = simulation.checkpoint()
+    copy = StreetNetwork.square_lattice(4, 4, compact=True)
+    restored = Simulation.restore(copy, checkpoint, CarPopulation(copy))
+    simulation.run(20)
+    restored.run(20)
+    assert_equal(0, len(population))
+    assert_equal(len(paths), population.arrived)
+    assert_equal(checkpoint.queue_cars.size, copy.populations[0].arrived)
+    assert first.location is None
+
+    broken = CarPopulation(network)
+    car = broken.add([paths[0][0].id, paths[-1][-1].id])
+    assert_raises(DisconnectedPathError, car.move)
+
+
+
+def test_spawn_from_od_matrix():
+    network = StreetNetwork.square_lattice(4, 4, compact=True)
+    ids = network.lattice_ids()[0]
+    matrix = np.zeros((16, 16), dtype=np.int64)
+    matrix[0, 15] = 3
+    matrix[0, 5] = 1
+    matrix[12, 3] = 2
+    matrix[7, 7] = 4
+
+    # Every trip follows the shortest path of its pair, in the order
+    # of the matrix, and trips from an intersection to itself are
+    # dropped.
+    population = network.spawn_from_od_matrix(matrix, cells=True)
+    assert_equal(6, len(population))
+    assert_equal(0, len(network.routes))
+    lattice = network.lattice
+    assert_equal(network.shortest_path(lattice[0][0], lattice[1][1]),
+                 population.car(0).path)
+    assert_equal(network.shortest_path(lattice[0][0], lattice[3][3]),
+                 population.car(3).path)
+    assert_equal(network.shortest_path(lattice[3][0], lattice[0][3]),
+                 population.car(5).path)
+
+    # The same trips as a dict of intersection ids, departing later.
+    other = StreetNetwork.square_lattice(4, 4, compact=True)
+    trips = { (int(ids.flat[o]), int(ids.flat[d])):int(matrix[o, d])
+              for o, d in zip(*np.nonzero(matrix)) }
+    departures = [0, 0, 0, 2, 5, 5]
+    waiting = other.spawn_from_od_matrix(trips, departures)
+    assert_equal(0, len(waiting))
+    assert_equal(6, waiting.waiting)
+    simulation = Simulation(other)
+    simulation.step()
+    assert_equal(3, len(waiting))
+    simulation.run(4)
+    assert_equal(2, waiting.waiting)
+
+    # Cars that have not departed survive a checkpoint, but only in a
+    # population.
+    checkpoint = simulation.checkpoint()
+    copy = StreetNetwork.square_lattice(4, 4, compact=True)
+    assert_raises(CannotRestoreError, checkpoint.restore, copy)
+    restored = Simulation.restore(copy, checkpoint, CarPopulation(copy))
+    assert_equal(2, copy.populations[0].waiting)
+    simulation.run(50)
+    restored.run(50)
+    assert_equal(6, waiting.arrived)
+    assert_equal(len(checkpoint.cursor), copy.populations[0].arrived)
+    assert_equal(simulation.tick, restored.tick)
+
+    # A random demand model draws distinct origins and destinations,
+    # the same way for the same seed.
+    demand = network.random_od_matrix(200, seed=3)
+    assert_equal(200, sum(demand.values()))
+    assert all(origin != destination for origin, destination in demand)
+    assert_equal(demand, network.random_od_matrix(200, seed=3))
+    network.spawn_from_od_matrix(demand, population=population)
+    assert_equal(206, len(population))
+
+    # Routing the trips in worker processes gives the same paths.
+    parallel = network.spawn_from_od_matrix(demand, workers=2)
+    for car in range(200):
+        assert_equal(population.car(6 + car).path, parallel.car(car).path)
+
+
+
+def test_dynamic_rerouting():
+    # Repairing a dynamic tree after changing a few costs gives the same
+    # distances as building it again, and expands fewer intersections.
+    network = StreetNetwork.square_lattice(12, 12, compact=True)
+    graph = network.compact_graph()
+    rng = np.random.RandomState(8)
+    cost = rng.uniform(1, 2, graph.n_streets)
+    tree = routing.DynamicShortestPathTree(graph, 0, cost)
+    full = tree.expanded
+    for _ in range(10):
+        streets = rng.choice(graph.n_streets, 5, replace=False)
+        cost[streets] = rng.uniform(0.5, 4, 5)
+        expanded = tree.update(streets, cost[streets])
+        fresh = routing.DynamicShortestPathTree(graph, 0, cost)
+        assert np.allclose(fresh.distance, tree.distance)
+        assert expanded < full
+    path = tree.path(graph.n_intersections - 1)
+    assert_equal(0, graph.head[path[-1]])
+    assert np.isclose(tree.distance_from(graph.n_intersections - 1),
+                      cost[path].sum())
+
+    # Congestion makes a queue expensive to join.
+    assert_equal(1.0, congestion_costs([1.0], [0])[0])
+    assert congestion_costs([1.0], [3])[0] > 10
+
+    # Cars heading into a jam are sent around it.
+    network = StreetNetwork.square_lattice(5, 5)
+    lattice = network.lattice
+    path = network.shortest_path(lattice[0][0], lattice[0][4])
+    jam = path[2]
+    for _ in range(5):
+        Car([jam], network)
+    car = Car(path, network)
+    rerouter = Rerouter(network, period=1)
+    simulation = Simulation(network, rerouter)
+    simulation.step()
+    assert rerouter.rerouted > 0
+    assert jam not in car.path[car.cursor+1:]
+    assert_equal(lattice[0][4], car.path[-1].head)
+    simulation.run(50)
+    assert car.location is None
+
+    # Population cars are rerouted the same way.
+    network = StreetNetwork.square_lattice(5, 5, compact=True)
+    lattice = network.lattice
+    path = network.shortest_path(lattice[0][0], lattice[0][4])
+    population = CarPopulation(network)
+    population.add_paths([[path[2].id]] * 5)
+    car = population.add(path)
+    Simulation(network, Rerouter(network, period=1)).step()
+    assert path[2] not in car.path[car.cursor+1:]
+    assert_equal(lattice[0][4], car.path[-1].head)
+
+    # Rerouting reuses or compacts the array of paths, so that it does
+    # not grow with the number of reroutes.
+    ids = [ street.id for street in path ]
+    other = population.add(path)
+    for k in range(1000):
+        population.reroute(car.id, ids[:k % 4 + 1])
+        population.reroute(other.id, ids[:k % 3 + 1])
+    assert population.n_path_streets <= 3 * 4 * 7
+    assert_equal(ids[:4], population.path_ids(car.id)[car.cursor+1:]
+                 .tolist())
+    assert_equal(ids[:1], population.path_ids(other.id)[1:].tolist())
+    assert_equal([path[2].id], population.path_ids(0).tolist())
+
+
+
+def test_signals():
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    signals = SignalController(network)
+    signals.signalize_all(durations=(2, 3))
+    _, north, east, south, west = network.lattice_ids()
+    center = network.lattice[1][1]
+
+    # Fixed-time signals alternate between the north-south and the
+    # east-west streets.
+    vertical = set(north) | set(south)
+    def green_streets():
+        return set(street.id for street in signals.green_streets(center))
+    instreets = set(street.id for street in center.instreets)
+    assert_equal(instreets & vertical, green_streets())
+    signals.step()
+    assert_equal(instreets & vertical, green_streets())
+    assert_equal(9, signals.step())
+    assert_equal(instreets - vertical, green_streets())
+    for _ in range(3):
+        signals.step()
+    assert_equal(instreets & vertical, green_streets())
+
+    # Cars wait at red lights, and refuse to run them.
+    eastbound = [ street for street in center.instreets if street.id in east ]
+    car = Car([eastbound[0]], network)
+    assert_raises(RedLightError, car.move)
+    simulation = Simulation(network)
+    simulation.run(2)
+    assert car.location is not None
+    simulation.run(10)
+    assert car.location is None
+
+    # An actuated signal serves a waiting car as soon as its green
+    # streets are empty.
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    signals = SignalController(network)
+    signals.signalize_all(actuated=True, min_green=1, max_green=20)
+    center = network.lattice[1][1]
+    street = [ street for street in center.instreets
+               if not signals.is_green(street) ][0]
+    car = Car([street], network)
+    simulation = Simulation(network)
+    simulation.step()
+    assert signals.is_green(street)
+    simulation.step()
+    assert car.location is None
+
+    # Checkpoints carry the state of the lights.
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    SignalController(network).signalize_all(durations=3)
+    Simulation(network).run(4)
+    checkpoint = Checkpoint.capture(network, 4)
+    copy = StreetNetwork.square_lattice(3, 3, compact=True)
+    assert_raises(CannotRestoreError, checkpoint.restore, copy)
+    SignalController(copy).signalize_all(durations=3)
+    checkpoint.restore(copy)
+    assert_equal(list(network.signals.green), list(copy.signals.green))
+
+
+
+def test_capacity_and_spillback():
+    network = StreetNetwork.square_lattice(2, 2, compact=True)
+    capacity = network.limit_capacity()
+    assert (capacity == 1).all()
+    lattice = network.lattice
+    corners = [ lattice[0][0], lattice[0][1], lattice[1][1], lattice[1][0] ]
+    ring = [ [ street for street in a.outstreets if street.head == b ][0]
+             for a, b in zip(corners, corners[1:] + corners[:1]) ]
+
+    # A car cannot enter a full street.
+    first = Car([ring[0], ring[1]], network)
+    second = Car([ring[1]], network)
+    assert_raises(StreetFullError, first.move)
+    assert_equal(ring[0], first.location)
+
+    # But it can take the place of a car that leaves in the same tick.
+    simulation = Simulation(network)
+    assert_equal(2, simulation.step())
+    assert_equal(ring[1], first.location)
+    assert second.location is None
+
+    # Cars that wait on each other around a block are in gridlock.
+    first.move()
+    cars = [ Car([street, ring[(i + 1) % 4]], network)
+             for i, street in enumerate(ring) ]
+    assert_equal(0, simulation.step())
+    assert_equal(1, len(simulation.gridlocks))
+    assert_equal(set(ring), set(simulation.gridlocks[0]))
+    assert_equal(4, simulation.blocked)
+
+    # Only one of two cars heading for the last free place gets it.
+    network = StreetNetwork.square_lattice(2, 2, compact=True)
+    network.limit_capacity()
+    lattice = network.lattice
+    target = [ street for street in lattice[0][1].outstreets
+               if street.head == lattice[1][1] ][0]
+    entries = list(lattice[0][1].instreets)
+    cars = [ Car([street, target], network) for street in entries ]
+    simulation = Simulation(network)
+    assert_equal(1, simulation.step())
+    assert_equal(1, sum(car.location == target for car in cars))
+    assert_equal(1, len(target.q))
+
+    # Lanes and weights set the capacities.
+    a, b = Intersection(), Intersection()
+    street = Street(a, b, weight=3.5, lanes=2)
+    network = StreetNetwork([a, b], [street], [])
+    assert_equal([6], list(network.limit_capacity()))
+    assert_equal(6, street.q.maxsize)
+
+
+
+def test_partitioned_simulation():
+    # A partitioned run moves every car exactly as a single-process
+    # run does, whether the tiles run in worker processes or not.
+    def scenario():
+        network = StreetNetwork.square_lattice(6, 7, compact=True)
+        rng = np.random.RandomState(9)
+        for _ in range(40):
+            source, destination = rng.choice(network.intersections, 2,
+                                             replace=False)
+            Car(network.shortest_path(source, destination), network)
+        demand = network.random_od_matrix(60, seed=10)
+        network.spawn_from_od_matrix(demand, rng.randint(0, 8, 60))
+        return network
+
+    expected = scenario()
+    single = Simulation(expected)
+    single.run(6)
+    reference = single.checkpoint()
+    single.run(100)
+
+    for tiles, processes in (((2, 3), 0), ((3, 2), 2)):
+        network = scenario()
+        partitioned = PartitionedSimulation(network, tiles, processes)
+        # The workers stay alive across steps and synchronizations.
+        partitioned.run(2)
+        workers = partitioned._workers
+        partitioned.synchronize()
+        for _ in range(4):
+            partitioned.step()
+        assert partitioned._workers is workers
+        checkpoint = partitioned.checkpoint()
+        for name in ('path_streets', 'path_offsets', 'cursor',
+                     'queue_streets', 'queue_cars', 'departure'):
+            assert_equal(getattr(reference, name).tolist(),
+                         getattr(checkpoint, name).tolist())
+        partitioned.run(100)
+        assert_equal(single.tick, partitioned.tick)
+        assert_equal(single.moves, partitioned.moves)
+        assert_equal(0, len(network.cars))
+        assert_equal(60, network.populations[0].arrived)
+
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    network.limit_capacity()
+    assert_raises(CannotPartitionError, PartitionedSimulation(network).run, 1)
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    Metrics(network)
+    assert_raises(CannotPartitionError, PartitionedSimulation(network).run, 1)
+
+
+
+def test_benchmark():
+    import benchmark
+    results = benchmark.run(['lattice_construction', 'car_movement'],
+                            quick=True)
+    results = json.loads(json.dumps(results))
+    assert_equal([], benchmark.compare(results, results))
+
+    # Slower times and lower rates than the baseline are regressions.
+    faster = json.loads(json.dumps(results))
+    faster['benchmarks']['lattice_construction']['10x10_compact'][
+        'median'] /= 10
+    faster['benchmarks']['car_movement']['objects'][
+        'moves_per_second'] *= 10
+    regressions = benchmark.compare(results, faster)
+    assert_equal([('lattice_construction', '10x10_compact', 'median'),
+                  ('car_movement', 'objects', 'moves_per_second')],
+                 [ regression[:3] for regression in regressions ])
+    assert_equal([], benchmark.compare(faster, results))
+
+
+
+def test_instrumentation():
+    # A ring buffer keeps the most recent rows, oldest first.
+    buffer = RingBuffer(3, tick=np.int64, lengths=(np.int32, (2,)))
+    for tick in range(5):
+        buffer.append(tick, [tick, -tick])
+    assert_equal(3, len(buffer))
+    columns = buffer.columns()
+    assert_equal([2, 3, 4], columns['tick'].tolist())
+    assert_equal([[2, -2], [3, -3], [4, -4]], columns['lengths'].tolist())
+    assert_equal(['tick', 'lengths[0]', 'lengths[1]'],
+                 list(buffer.flat_columns()))
+
+    network = StreetNetwork.square_lattice(3, 3, compact=True)
+    assert_is_none(Metrics(network).street_lengths)
+    metrics = Metrics(network, capacity=100, street_samples=2,
+                      street_every=2)
+    path = network.shortest_path(network.intersections[0],
+                                 network.intersections[8], 'dijkstra')
+    routes = metrics.routes.columns()
+    assert_equal([0], routes['source'].tolist())
+    assert_equal([8], routes['destination'].tolist())
+    assert_equal(['dijkstra'], [ Metrics.ALGORITHMS[algorithm] for algorithm
+                                 in routes['algorithm'].tolist() ])
+    assert_true(routes['expanded'][0] > 0)
+
+    # A car alone on the road moves every tick and takes as many ticks
+    # as it has streets.
+    Car(path, network)
+    simulation = Simulation(network)
+    simulation.run(10)
+    assert_equal(4, len(path))
+    ticks = metrics.ticks.columns()
+    assert_equal([0, 1, 2, 3], ticks['tick'].tolist())
+    assert_equal([1, 1, 1, 1], ticks['moves'].tolist())
+    assert_equal([1, 1, 1, 0], ticks['cars'].tolist())
+    assert_true((ticks['seconds'] >= ticks['movement']).all())
+    trips = metrics.trips.columns()
+    assert_equal([3], trips['arrival'].tolist())
+    assert_equal([4], trips['travel_time'].tolist())
+    assert_equal([4], trips['length'].tolist())
+    assert_equal([0, 2], metrics.street_lengths.columns()['tick'].tolist())
+    ids = [ network.street_id(street) for street in path ]
+    assert_equal(sorted(ids),
+                 np.flatnonzero(metrics.street_throughput).tolist())
+    assert_equal(4, metrics.street_throughput.sum())
+
+    with tempfile.TemporaryDirectory() as directory:
+        metrics.export(directory)
+        with open(os.path.join(directory, 'trips.csv')) as f:
+            assert_equal(['arrival,travel_time,length', '3,4,4'],
+                         f.read().split())
+        assert_equal(['routes.csv', 'street_lengths.csv',
+                      'street_throughput.csv', 'ticks.csv', 'trips.csv'],
+                     sorted(os.listdir(directory)))
+        try:
+            import pyarrow
+        except ImportError:
+            assert_raises(CannotExportError, metrics.export, directory,
+                          'parquet')
+        assert_raises(CannotExportError, metrics.export, directory, 'xlsx')
+
+    # Once detached, nothing more is recorded.
+    metrics.detach()
+    assert_is_none(network.metrics)
+    network.shortest_path(network.intersections[0], network.intersections[8])
+    assert_equal(1, len(metrics.routes))
+
+
+
+def test_batch_street_closures():
+    network = StreetNetwork.square_lattice(4, 4)
+    streets = list(network.streets)
+    corner = network.lattice[0][0]
+    before = network.compact_graph()
+    revision = network.revision
+
+    # Closing the streets into a corner cuts it off.
+    closed = list(corner.instreets)
+    network.cut_streets(closed)
+    assert_equal(len(streets) - 2, len(network.streets))
+    assert_equal([], list(corner.instreets))
+    assert_true(all(street not in network.streets for street in closed))
+    assert_not_equal(revision, network.revision)
+    assert_equal(revision[0] + 1, network.revision[0])
+    assert_raises(DisconnectedPathError, network.shortest_path,
+                  network.lattice[3][3], corner)
+
+    # A batch with an occupied or missing street changes nothing.
+    car = Car(network.shortest_path(network.lattice[3][3],
+                                     network.lattice[0][2]), network)
+    revision = network.revision
+    assert_raises(CannotCutStreetError, network.cut_streets,
+                  [network.streets[0], car.location])
+    assert_raises(CannotCutStreetError, network.cut_streets, closed[:1])
+    assert_equal(len(streets) - 2, len(network.streets))
+    assert_equal(revision, network.revision)
+    assert_raises(CannotRestoreStreetError, network.restore_streets,
+                  closed + [network.streets[0]])
+    assert_equal(len(streets) - 2, len(network.streets))
+
+    # Restoring the streets puts them back where they were, so the
+    # network has the same street ids as before.
+    network.restore_streets(closed)
+    assert_equal(streets, network.streets)
+    assert_equal(closed, corner.instreets)
+    assert_equal(before.head.tolist(), network.compact_graph().head.tolist())
+    assert_equal(1, len(network.shortest_path(network.lattice[0][1],
+                                              network.lattice[0][0])))
+
+    # Cutting most of the streets compacts the lists, after which
+    # restored streets go to the end.
+    cut = [ street for street in streets if street.q.empty() ][:40]
+    network.cut_streets(cut)
+    assert_equal(len(streets) - 40, len(network.streets))
+    assert_equal([ street for street in streets if street not in cut ],
+                 list(network.streets))
+    network.restore_streets(cut)
+    assert_equal(set(streets), set(network.streets))
+    assert_equal(len(streets), len(network.streets))
+
+    compact = StreetNetwork.square_lattice(2, 2, compact=True)
+    assert_raises(CannotCutStreetError, compact.cut_streets,
+                  compact.streets[:1])
+
+    # Cutting a street would shift the ids that population cars keep
+    # their paths by, so it is refused while there are populations.
+    network = StreetNetwork.square_lattice(4, 4)
+    path = network.shortest_path(network.lattice[3][3], network.lattice[0][0])
+    population = CarPopulation(network)
+    car = population.add(path)
+    assert_raises(CannotCutStreetError, network.cut_street,
+                  network.streets[0])
+    assert_equal(path, car.path)
+    Simulation(network).run(10)
+    assert_equal(1, population.arrived)
+
+
+
+def test_event_simulation():
+    # A car takes the weight of every street to travel it, and cars
+    # leave a street at least a headway apart.
+    network = StreetNetwork.square_lattice(1, 4,
+                                           east_weights=[[1.5, 2, 0.5]])
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[0][3])
+    first = Car(path, network)
+    second = Car(path, network)
+    simulation = EventSimulation(network)
+    assert_equal(4, simulation.run(4.0))
+    assert_equal(4.0, simulation.time)
+    assert_is_none(first.location)
+    assert_is(path[1], second.location)
+    assert_equal({ second:4.5 }, simulation.ready)
+    assert_equal(2, simulation.run())
+    assert_equal(5.0, simulation.time)
+    assert_equal(6, simulation.moves)
+    assert_equal(6, simulation.events)
+    assert_equal({}, network.occupied)
+
+    # Cars of a population depart at their departure times, before the
+    # cars that move at the same time.
+    network = StreetNetwork.square_lattice(1, 4, compact=True)
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[0][3])
+    population = CarPopulation(network)
+    population.add_paths([ [ street.id for street in path ] ] * 2,
+                         departures=[0, 3])
+    simulation = EventSimulation(network)
+    simulation.run(3)
+    assert_equal(1, population.arrived)
+    assert_equal(1, population.active)
+    assert_equal(0, population.waiting)
+    assert_equal(3, simulation.run())
+    assert_equal(6, simulation.time)
+    assert_equal(2, population.arrived)
+
+    # A car waits at the front of its street while the next one is
+    # full.
+    network = StreetNetwork.square_lattice(1, 3, east_weights=[[1, 3]])
+    network.limit_capacity(vehicle_length=3)
+    streets = network.shortest_path(network.lattice[0][0],
+                                    network.lattice[0][2])
+    Car(streets[1:], network)
+    behind = Car(streets, network)
+    simulation = EventSimulation(network)
+    assert_equal(0, simulation.run(2))
+    assert_is(streets[0], behind.location)
+    assert_equal(3, simulation.run())
+    assert_equal(6, simulation.time)
+
+    # The work done follows the cars, not the size of the network.
+    network = StreetNetwork.square_lattice(100, 100, compact=True)
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[99][99])
+    Car(path, network)
+    simulation = EventSimulation(network)
+    assert_equal(len(path), simulation.run())
+    assert_equal(len(path), simulation.events)
+
+    SignalController(network)
+    assert_raises(CannotSimulateError, EventSimulation, network)
+
+
+
+def path_weight(network, variant):
+    # A run for test_ensemble: the weight of the shortest path across
+    # the lattice, from a fresh copy of the base network.
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[-1][-1])
+    return sum(street.weight for street in path)
+
+
+
+def test_ensemble():
+    network = StreetNetwork.square_lattice(4, 4, compact=True)
+    east, south = network.lattice_ids()[2:4]
+    variants = [ Variant('base'),
+                 Variant('slow', east_weights=np.full((4, 3), 2.0),
+                         south_weights=np.full((3, 4), 2.0)),
+                 Variant('detour', weights={ int(street):5.0
+                                             for street in east[:3] }),
+                 Variant('closed', cuts=east[:3]) ]
+
+    # Every run starts from the base network, whatever the runs before
+    # it overlaid.
+    with Ensemble(network, processes=0) as ensemble:
+        results = list(ensemble.run(iter(variants), path_weight))
+        assert_equal(variants, [ variant for variant, _ in results ])
+        assert_equal([6, 12, 6, 6], [ result for _, result in results ])
+        assert_equal(1.0, ensemble.network().compact_graph().weight.max())
+    assert_equal(1.0, network.compact_graph().weight.max())
+    assert_false(os.path.exists(ensemble.path))
+
+    # Worker processes stream the same results, in order.
+    demand = [ Variant(n_trips, n_trips=n_trips, seed=n_trips, n_ticks=50)
+               for n_trips in (0, 10, 20, 40, 80) ]
+    with Ensemble(network, processes=2) as ensemble:
+        pooled = [ result for _, result in ensemble.run(demand) ]
+        assert_equal([6, 12, 6, 6], [ result for _, result in
+                                      ensemble.run(variants, path_weight) ])
+    with Ensemble(network, processes=0) as ensemble:
+        assert_equal(pooled, [ result for _, result in ensemble.run(demand) ])
+    assert_equal([0, 10, 20, 40, 80],
+                 [ result['arrived'] for result in pooled ])
+    assert_true(all(result['moves'] > 0 for result in pooled[1:]))
+
+    assert_raises(LatticeDimensionsError, list, Ensemble(
+        network, processes=0).run([ Variant(east_weights=np.ones((3, 3))) ]))
+
+
+
+def test_trajectory_recorder():
+    network = StreetNetwork.square_lattice(1, 4, compact=True)
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[0][3])
+    ids = [ street.id for street in path ]
+    early = Car(path, network)
+    population = CarPopulation(network)
+    population.add_paths([ids[1:], ids], departures=[2, 4])
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The car already on the road is recorded from the start, and
+        # small chunks are written out as they fill.
+        with TrajectoryRecorder(network, directory, chunk_size=3) as recorder:
+            Simulation(network).run(20)
+            assert_true(recorder.n_chunks > 0)
+        assert_is_none(network.recorder)
+        assert_equal(11, recorder.n_events)
+        assert_equal(4, recorder.n_chunks)
+        chunks = list(read_chunks(directory))
+        assert_equal([3, 3, 3, 2], [ len(chunk['car']) for chunk in chunks ])
+
+        trajectories = list(read_trajectories(directory))
+        assert_equal([0, 1, 2], [ trajectory.car
+                                  for trajectory in trajectories ])
+        assert_equal([ids, ids[1:], ids],
+                     [ trajectory.streets.tolist()
+                       for trajectory in trajectories ])
+        assert_equal([[0, 1, 2], [2, 3], [4, 5, 6]],
+                     [ trajectory.times.tolist()
+                       for trajectory in trajectories ])
+        assert_equal([3, 4, 7], [ trajectory.arrival
+                                  for trajectory in trajectories ])
+        assert_equal([3, 2, 3], [ trajectory.travel_time
+                                  for trajectory in trajectories ])
+
+    # An event simulation records continuous times, and the cars that
+    # have not arrived come last.
+    network = StreetNetwork.square_lattice(1, 3, east_weights=[[1.5, 2]])
+    path = network.shortest_path(network.lattice[0][0],
+                                 network.lattice[0][2])
+    Car(path, network)
+    Car(path[1:], network)
+    with tempfile.TemporaryDirectory() as directory:
+        with TrajectoryRecorder(network, directory):
+            EventSimulation(network).run(2.5)
+        trajectories = list(read_trajectories(directory))
+        assert_equal([1, 0], [ trajectory.car
+                               for trajectory in trajectories ])
+        assert_equal(2.0, trajectories[0].arrival)
+        assert_equal([0, 1.5], trajectories[1].times.tolist())
+        assert_is_none(trajectories[1].arrival)
+        assert_is_none(trajectories[1].travel_time)
+
+
+
+def test_revisions_are_per_network():
+    network = StreetNetwork.square_lattice(4, 4)
+    compact = StreetNetwork.square_lattice(4, 4, compact=True)
+    compact.build_contraction_hierarchy()
+    graph = network.compact_graph()
+    revision = network.revision
+
+    # Building or reweighting streets elsewhere changes nothing here,
+    # and snapshots do not format the lazy lattice labels.
+    Street(Intersection(), Intersection()).weight = 5
+    StreetNetwork.square_lattice(2, 2)
+    assert_equal(revision, network.revision)
+    assert_is(graph, network.compact_graph())
+    assert_true(compact.has_current_hierarchy())
+    assert_true(all(street._label is None for street in network.streets))
+
+    # Reweighting a street changes every network it is in, and a
+    # street that was cut no longer reports to its old network.
+    street = network.streets[0]
+    twin = StreetNetwork.no_cars(network.intersections,
+                                 list(network.streets))
+    twin_revision = twin.revision
+    street.weight = 2
+    assert_not_equal(revision, network.revision)
+    assert_not_equal(twin_revision, twin.revision)
+    assert_equal(2, network.compact_graph().weight[0])
+    network.cut_street(street)
+    revision = network.revision
+    street.weight = 3
+    assert_equal(revision, network.revision)
+
+    compact.streets[0].weight = 2
+    assert_false(compact.has_current_hierarchy())
+
+
+
+def test_routes_do_not_depend_on_the_cache():
+    rng = np.random.RandomState(7)
+    weights = [ rng.randint(1, 4, shape).astype(float)
+                for shape in ((6, 7), (7, 6)) * 2 ]
+    network = StreetNetwork.square_lattice(7, 7, *weights, compact=True)
+    graph = network.compact_graph()
+    nodes = network.intersections
+    for algorithm in (None, 'astar', 'bidirectional'):
+        for source in nodes[::4]:
+            network.routes.clear()
+            cold = [ network.shortest_path(source, destination, algorithm)
+                     for destination in nodes if destination != source ]
+            network.shortest_path_tree(source)
+            warm = [ network.shortest_path(source, destination, algorithm)
+                     for destination in nodes if destination != source ]
+            assert_equal(cold, warm)
+            if algorithm != 'bidirectional':
+                # The default A* search finds Dijkstra's paths.
+                assert_equal([ routing.route(graph, source.id,
+                                             destination.id)[0]
+                               for destination in nodes
+                               if destination != source ],
+                             [ [ street.id for street in path ]
+                               for path in cold ])
+
+
+
+def test_repeated_shortest_paths_are_cached():
+    # The tree of a source that is asked for again is cached, and the
+    # later queries from it are read from the tree.
+    network = StreetNetwork.square_lattice(5, 5)
+    source, destination = network.lattice[0][0], network.lattice[4][3]
+    paths = [ network.shortest_path(source, destination) for _ in range(5) ]
+    assert all(path == paths[0] for path in paths)
+    assert_equal(1, len(network.routes))
+    assert_equal(3, network.routes.hits)
+    assert_equal(2, network.routes.misses)
+    other = network.shortest_path(source, network.lattice[2][2], 'dijkstra')
+    assert_equal(4, network.routes.hits)
+    assert_equal(len(other), 4)
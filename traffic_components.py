@@ -1,12 +1,111 @@
+import collections
+import collections.abc
+import contextlib
+import json
+import os
 import queue
+import time
+import weakref
 import numpy as np
+import routing
+
+
+
+# The version of the on-disk format of StreetNetwork.save.
+STORAGE_FORMAT = 1
 
 
 
 class DisconnectedPathError(Exception): pass
 class NotAtFrontOfQueueError(Exception): pass
 class CannotCutStreetError(Exception): pass
+class CannotRestoreStreetError(Exception): pass
 class LatticeDimensionsError(Exception): pass
+class RedLightError(Exception): pass
+class StreetFullError(Exception): pass
+
+
+
+def lattice_arrays(height, width, north_weights=None, east_weights=None,
+                   south_weights=None, west_weights=None):
+    '''Computes the streets of a square lattice as arrays. Returns
+    the 2d array of intersection ids (row-major), the tail, head, and
+    weight of every street, the rank of each street's direction in
+    the order south, north, east, west, and the (start, stop) ids of
+    the north, east, south, and west streets, which are numbered in
+    that order. Raises LatticeDimensionsError if the weights do not
+    fit the lattice.'''
+
+    if north_weights is None: north_weights = np.ones((height-1, width)) 
+    if east_weights is None: east_weights = np.ones((height, width-1)) 
+    if south_weights is None: south_weights = np.ones((height-1, width)) 
+    if west_weights is None: west_weights = np.ones((height, width-1)) 
+
+    # First check that the dimensions of the weights arrays match
+    # the given width and height.
+    weights = { 'north':north_weights, 'east':east_weights,
+                'south':south_weights, 'west':west_weights }
+    for name in weights:
+        if name == 'north' or name == 'south':
+            h = height - 1
+            w = width
+        elif name == 'east' or name == 'west':
+            h = height
+            w = width - 1
+
+        if len(weights[name]) != h:
+            raise LatticeDimensionsError(
+                'There are {} rows of {}_weights but there should be {}'
+                .format(len(weights[name]), name, h))
+
+        try:
+            array = np.asarray(weights[name], dtype=np.float64)
+        except ValueError:
+            array = None
+        if array is None or (h > 0 and array.shape != (h, w)):
+            raise LatticeDimensionsError(
+                'A row in {}_weights has length {} but it should be {}'
+                .format(name,
+                        [ len(row) for row in weights[name]
+                          if len(row) != w ][0],
+                        w))
+        weights[name] = array.reshape(h, w)
+
+    # Derive the endpoints of each directional block of streets from
+    # the 2d array of node ids: e.g., northbound street (i,j) goes
+    # from node (i+1,j) to node (i,j).
+    nodes = np.arange(height * width, dtype=np.int32).reshape(height, width)
+    tails = [ nodes[1:,:], nodes[:,:-1], nodes[:-1,:], nodes[:,1:] ]
+    heads = [ nodes[:-1,:], nodes[:,1:], nodes[1:,:], nodes[:,:-1] ]
+    names = [ 'north', 'east', 'south', 'west' ]
+
+    sizes = [ weights[name].size for name in names ]
+    stops = np.cumsum(sizes).tolist()
+    blocks = list(zip([0] + stops[:-1], stops))
+    tail = np.concatenate([ array.ravel() for array in tails ])
+    head = np.concatenate([ array.ravel() for array in heads ])
+    weight = np.concatenate([ weights[name].ravel() for name in names ])
+    rank = np.repeat(np.array([1, 2, 0, 3], dtype=np.int8), sizes)
+
+    return nodes, tail, head, weight, rank, blocks
+
+
+
+def lattice_street_label(tail, head):
+    '''The label of the lattice street between the given coordinates,
+    i.e., 'Direction: (a,b)->(c,d)' where (a,b) are the coordinates of
+    the tail and (c,d) are the coordinates of the head.'''
+
+    if head[0] < tail[0]:
+        direction = 'North'
+    elif head[1] > tail[1]:
+        direction = 'East'
+    elif head[0] > tail[0]:
+        direction = 'South'
+    else:
+        direction = 'West'
+    return '{}: ({},{})->({},{})'.format(direction, tail[0], tail[1],
+                                         head[0], head[1])
 
 
 
@@ -16,17 +115,47 @@ class StreetNetwork:
     are not merely ordered pairs of nodes but full Street objects.
     StreetNetworks also know a list of cars that move within them. If
     the StreetNetwork is a square lattice, then it knows the 2d arrays
-    of intersections and north/east/south/west-bound streets.'''
+    of intersections and north/east/south/west-bound streets. A
+    compact StreetNetwork keeps its topology in a CompactGraph instead
+    of in Intersection and Street objects; its intersections and
+    streets are then views over the graph's arrays.'''
     
     def __init__(self, intersections, streets, cars,
                  lattice=None, north_streets=None, east_streets=None,
-                 south_streets=None, west_streets=None):
+                 south_streets=None, west_streets=None, graph=None):
         '''Construct a street network as a simple digraph given the
         nodes and edges.'''
 
+        # The number of changes to the streets of a network of
+        # objects, which its streets report; see revision.
+        self._changes = 0
+        if graph is None:
+            streets = StreetList(streets, self)
         self.intersections = intersections
         self.streets = streets
-        self.cars = cars
+        self.cars = CarRegistry(cars)
+        self.graph = graph
+
+        # The streets whose queues are not empty, kept up to date by
+        # the cars as they move, any CarPopulations of cars that are
+        # not in self.cars, the SignalController of the traffic
+        # lights, if there are any, and whether limit_capacity bounded
+        # the queues. Any Metrics that instrument the network, and any
+        # TrajectoryRecorder of its cars, register themselves here too.
+        self.occupied = dict.fromkeys(car.location for car in self.cars)
+        self.populations = []
+        self.signals = None
+        self.capacity_limited = False
+        self.metrics = None
+        self.recorder = None
+
+        # Shortest path trees, and the CompactGraph that routing runs
+        # on if the network is made of objects.
+        self.routes = routing.RouteCache()
+        self.hierarchy = None
+        self._snapshot = None
+        self._snapshot_revision = None
+        self._hierarchy_revision = None
         
         self.lattice = lattice
         self.north_streets = north_streets
@@ -48,10 +177,35 @@ class StreetNetwork:
         
         return cls(intersections, streets, [])
 
+    @classmethod
+    def from_graph(cls, graph, lattice=None,
+                   north_streets=None, east_streets=None,
+                   south_streets=None, west_streets=None):
+        '''Construct a compact street network with no cars on top of
+        a CompactGraph. The lattice, if given, is a 2d array of
+        intersection ids and the directional streets are arrays of
+        street ids.'''
+
+        intersections = ViewSequence(graph, IntersectionView,
+                                     range(graph.n_intersections))
+        streets = ViewSequence(graph, StreetView, range(graph.n_streets))
+        if lattice is not None:
+            if graph.coordinates is None:
+                graph.set_lattice(lattice)
+            lattice = [ ViewSequence(graph, IntersectionView, row)
+                        for row in lattice ]
+        directions = [ None if ids is None
+                       else ViewSequence(graph, StreetView, ids)
+                       for ids in (north_streets, east_streets,
+                                   south_streets, west_streets) ]
+        return cls(intersections, streets, [], lattice, *directions,
+                   graph=graph)
+
     @classmethod
     def square_lattice(cls, height, width,
                        north_weights=None, east_weights=None,
-                       south_weights=None, west_weights=None):
+                       south_weights=None, west_weights=None,
+                       compact=False):
         '''Construct a street network on top of a square lattice
         (i.e., a grid), given the width (number of intersections going
         horizontally) and height (number of intersections going
@@ -59,131 +213,524 @@ class StreetNetwork:
         bidirectional. The weights can be preset by giving 2d arrays
         of numbers, e.g., north_weights contains the weights of all
         northbound streets. If they are not given, then the
-        constructor uses weights of 1.'''
-        
-        if north_weights is None: north_weights = np.ones((height-1, width)) 
-        if east_weights is None: east_weights = np.ones((height, width-1)) 
-        if south_weights is None: south_weights = np.ones((height-1, width)) 
-        if west_weights is None: west_weights = np.ones((height, width-1)) 
-
-        # First check that the dimensions of the weights arrays match
-        # the given width and height.
-        weights = { 'north':north_weights, 'east':east_weights,
-                    'south':south_weights, 'west':west_weights }
-        for name in weights:
-            if name == 'north' or name == 'south':
-                h = height - 1
-                w = width
-            elif name == 'east' or name == 'west':
-                h = height
-                w = width - 1
-            
-            if len(weights[name]) != h:
-                raise LatticeDimensionsError(
-                    'There are {} rows of {}_weights but there should be {}'
-                    .format(len(weights[name]), name, h))
-
-            if any([ (len(row) != w) for row in weights[name] ]):
-                raise LatticeDimensionsError(
-                    'A row in {}_weights has length {} but it should be {}'
-                    .format(name,
-                            [ len(row) for row in weights[name]
-                              if len(row) != w ][0],
-                            w))
+        constructor uses weights of 1. If compact is true, then the
+        network is backed by a CompactGraph and no Intersection or
+        Street objects are created.'''
+
+        nodes, tail, head, weight, rank, blocks = lattice_arrays(
+            height, width,
+            north_weights, east_weights, south_weights, west_weights)
+
+        if compact:
+            graph = CompactGraph(height * width, tail, head, weight,
+                                 np.lexsort((rank, tail)),
+                                 np.lexsort((rank, head)),
+                                 lambda node: divmod(node, width),
+                                 lambda street: lattice_street_label(
+                                     divmod(int(tail[street]), width),
+                                     divmod(int(head[street]), width)))
+            return cls.from_graph(graph, nodes,
+                                  *[ np.arange(start, stop, dtype=np.int32)
+                                     for start, stop in blocks ])
 
         # Construct a 2d array of nodes.
-        nodes = [ [ Intersection((i,j)) for j in range(width) ] 
+        flattened_nodes = [ Intersection(divmod(node, width))
+                            for node in range(height * width) ]
+        nodes = [ flattened_nodes[i*width:(i+1)*width]
                   for i in range(height) ]
 
-        # Construct 2d arrays of streets in each of the four cardinal
-        # directions, using the given weights. The street labels are
-        # 'Direction: (a,b)->(c,d)' where (a,b) are the coordinates of
-        # the tail and (c,d) are the coordinates of the head.
-        south_streets = [ Street(nodes[i][j], nodes[i+1][j],
-                                 weights['south'][i][j],
-                                 'South: ({},{})->({},{})'.format(i,j,i+1,j))
-                          for i in range(height-1) for j in range(width) ]
-        north_streets = [ Street(nodes[i+1][j], nodes[i][j],
-                                 weights['south'][i][j],
-                                 'North: ({},{})->({},{})'.format(i+1,j,i,j))
-                          for i in range(height-1) for j in range(width) ]
-        east_streets = [ Street(nodes[i][j], nodes[i][j+1],
-                                weights['east'][i][j],
-                                 'East: ({},{})->({},{})'.format(i,j,i,j+1))
-                         for i in range(height) for j in range(width-1) ]
-        west_streets = [ Street(nodes[i][j+1], nodes[i][j],
-                                weights['west'][i][j],
-                                 'West: ({},{})->({},{})'.format(i,j+1,i,j))
-                         for i in range(height) for j in range(width-1) ]
-        streets = north_streets + east_streets + south_streets + west_streets
-        
-        flattened_nodes = []
-        for row in nodes:
-            flattened_nodes.extend(row)
-        return cls(flattened_nodes, streets, [],
-                   nodes, north_streets, east_streets,
-                   south_streets, west_streets)
+        # Construct the streets in each of the four cardinal
+        # directions. They are created south, north, east, then west,
+        # which fixes the order of every intersection's instreets and
+        # outstreets, but are listed north, east, south, then west.
+        # Labels are generated from the endpoints when needed.
+        tail = tail.tolist()
+        head = head.tolist()
+        weight = weight.tolist()
+        streets = [None] * len(tail)
+        north, east, south, west = blocks
+        for start, stop in (south, north, east, west):
+            for street in range(start, stop):
+                streets[street] = LatticeStreet(flattened_nodes[tail[street]],
+                                                flattened_nodes[head[street]],
+                                                weight[street])
+
+        return cls(flattened_nodes, streets, [], nodes,
+                   *[ streets[start:stop] for start, stop in blocks ])
+
+    def compact(self):
+        '''Returns a compact copy of this network's topology and
+        weights, without any cars.'''
+
+        return StreetNetwork.from_graph(CompactGraph.from_network(self),
+                                        *self.lattice_ids())
+
+    def lattice_ids(self):
+        '''Returns the lattice as a 2d array of intersection ids and
+        the north, east, south, and west streets as arrays of street
+        ids, or Nones if the network is not a lattice.'''
+
+        def ids(sequence, to_id):
+            if sequence is None:
+                return None
+            elif isinstance(sequence, ViewSequence):
+                return np.asarray(sequence.ids, dtype=np.int32)
+            return np.array([ to_id(item) for item in sequence ],
+                            dtype=np.int32)
+
+        lattice = None
+        if self.lattice is not None:
+            lattice = np.array([ ids(row, self.intersection_id)
+                                 for row in self.lattice ], dtype=np.int32)
+        directions = [ ids(streets, self.street_id)
+                       for streets in (self.north_streets, self.east_streets,
+                                       self.south_streets, self.west_streets) ]
+        return [lattice] + directions
+
+    def save(self, path, labels=True):
+        '''Writes the network's topology and weights, but not its
+        cars, to the directory at path, as a small JSON header and one
+        .npy file per array; see CompactGraph.save. A lattice and its
+        directional streets are saved as arrays of ids.'''
+
+        arrays = dict(zip(('lattice', 'north_streets', 'east_streets',
+                           'south_streets', 'west_streets'),
+                          self.lattice_ids()))
+        self.compact_graph().save(path, labels and self.lattice is None,
+                                  { name:array for name, array
+                                    in arrays.items() if array is not None })
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        '''Opens a network written by save as a compact network whose
+        arrays are memory-mapped from the files, so that opening it
+        takes no time and processes that open the same files share
+        their pages. With the default mmap_mode of 'c', changes to the
+        weights stay private to this process; with 'r', the weights
+        cannot be changed. The labels of a lattice are generated from
+        its coordinates.'''
+
+        graph, arrays = CompactGraph.load(path, mmap_mode)
+        lattice = arrays.get('lattice')
+        if lattice is not None and graph.intersection_labels is None:
+            coordinates = graph.coordinates
+            graph.intersection_labels = (
+                lambda node: tuple(coordinates[node].tolist()))
+            graph.street_labels = lambda street: lattice_street_label(
+                coordinates[graph.tail[street]].tolist(),
+                coordinates[graph.head[street]].tolist())
+        return cls.from_graph(graph, lattice,
+                              *[ arrays.get(name) for name in
+                                 ('north_streets', 'east_streets',
+                                  'south_streets', 'west_streets') ])
+
+    def limit_capacity(self, vehicle_length=1.0):
+        '''Bounds the queue of every street by the number of cars that
+        fit on it: one per lane for every vehicle_length of its weight,
+        and at least one per lane. A car then cannot enter a full
+        street, and the cars behind it spill back onto the streets
+        upstream. Returns the capacities, as an array indexed by street
+        id.'''
+
+        graph = self.compact_graph()
+        lanes = 1 if graph.lanes is None else graph.lanes
+        capacity = (lanes * np.maximum(
+            1, np.floor(graph.weight / vehicle_length))).astype(np.int64)
+        if self.graph is not None:
+            self.graph.capacity = capacity
+            for street, q in self.graph.queues.items():
+                q.maxsize = int(capacity[street])
+        else:
+            for street, maxsize in zip(self.streets, capacity.tolist()):
+                street.q.maxsize = maxsize
+        self.capacity_limited = True
+        return capacity
 
     def cut_street(self, street):
         '''Cleanly removes a given street from the network.'''
 
-        if not street.q.empty:
+        self.cut_streets([street])
+
+    def cut_streets(self, streets):
+        '''Cleanly removes the given streets from the network, e.g.,
+        to close the roads of a scenario. Every street is checked
+        before any is removed, so either all of them are cut or, if
+        any is not in the network or has cars on it, none is. Each
+        removal takes constant time, and the cached routes, snapshot,
+        and hierarchy are only rebuilt once, when next needed. Since
+        cutting a street changes the ids of the streets after it, it
+        is refused while car populations, signals, metrics, or a
+        recorder keep state by street id.'''
+
+        streets = list(dict.fromkeys(streets))
+        self._check_topology_change(streets)
+        missing = [ street for street in streets
+                    if street not in self.streets ]
+        if missing:
+            raise CannotCutStreetError(
+                'Streets {} are not in the network.'
+                .format(', '.join(map(str, missing))))
+        occupied = [ street for street in streets if not street.q.empty() ]
+        if occupied:
             raise CannotCutStreetError(
-                'Street {} has the following cars in its queue: {}.'
-                .format(street, street.q.queue))
+                'Streets {} have cars in their queues: {}.'
+                .format(', '.join(map(str, occupied)),
+                        [ list(street.q.queue) for street in occupied ]))
 
-        self.streets.remove(street)
-        street.tail.outstreets.remove(street)
-        street.head.instreets.remove(street)
+        with self.streets.batch():
+            for street in streets:
+                self.streets.remove(street)
+                street.tail.outstreets.remove(street)
+                street.head.instreets.remove(street)
+
+    def restore_street(self, street):
+        '''Puts a street that was cut back into the network.'''
+
+        self.restore_streets([street])
+
+    def restore_streets(self, streets):
+        '''Puts streets that were cut back into the network, each in
+        constant time and, if the lists of streets have not been
+        compacted since, in the place it was cut from, so that
+        restoring a closure gives back the same street ids. Either all
+        of the streets are restored or, if any is in the network
+        already, none is.'''
+
+        streets = list(dict.fromkeys(streets))
+        self._check_topology_change(streets)
+        present = [ street for street in streets if street in self.streets ]
+        if present:
+            raise CannotRestoreStreetError(
+                'Streets {} are in the network already.'
+                .format(', '.join(map(str, present))))
+
+        with self.streets.batch():
+            for street in streets:
+                self.streets.restore(street)
+                street.tail.outstreets.restore(street)
+                street.head.instreets.restore(street)
+
+    def _check_topology_change(self, streets):
+        if self.graph is not None:
+            raise CannotCutStreetError(
+                'Streets {} belong to a compact network, whose topology'
+                ' cannot be changed.'.format(', '.join(map(str, streets))))
+        # Cutting or restoring a street changes the ids of the streets
+        # after it, which would leave the state kept by street id
+        # pointing at the wrong streets.
+        if (self.populations or self.signals is not None
+                or self.metrics is not None or self.recorder is not None):
+            raise CannotCutStreetError(
+                'Streets {} cannot be cut or restored while car'
+                ' populations, signals, metrics, or a recorder keep'
+                ' state by street id.'.format(', '.join(map(str, streets))))
+
+    def compact_graph(self):
+        '''Returns a CompactGraph of the network as it is now. This
+        is the graph of a compact network. For a network of objects,
+        it is a snapshot that is rebuilt whenever a street is added,
+        cut, or reweighted.'''
+
+        if self.graph is not None:
+            return self.graph
+        if self._snapshot is None or self._snapshot_revision != self.revision:
+            self._snapshot = CompactGraph.from_network(self)
+            self._snapshot_revision = self.revision
+        return self._snapshot
+
+    @property
+    def revision(self):
+        '''Identifies the current state of the network's topology and
+        weights: it changes whenever either of them does, and only
+        then. The streets of a network of objects report their changes
+        to the networks they are in, and a CompactGraph counts its
+        own.'''
+
+        graph = 0 if self.graph is None else self.graph.revision
+        return (self._changes, graph, len(self.intersections),
+                len(self.streets))
+
+    def changed(self):
+        '''Marks everything computed from the network, such as its
+        snapshot, cached routes, and hierarchy, as out of date.'''
+
+        self._changes += 1
+
+    def intersection_id(self, intersection):
+        '''The id of an intersection in compact_graph().'''
+
+        if self.graph is not None:
+            return intersection.id
+        return self.compact_graph().intersection_ids[intersection]
+
+    def street_id(self, street):
+        '''The id of a street in compact_graph().'''
+
+        if self.graph is not None:
+            return street.id
+        return self.compact_graph().street_ids[street]
+
+    def queue_lengths(self):
+        '''The number of cars on every street, as an array indexed by
+        street id.'''
+
+        graph = self.compact_graph()
+        lengths = np.zeros(graph.n_streets, dtype=np.int64)
+        if self.occupied:
+            if self.graph is not None:
+                ids = [ street.id for street in self.occupied ]
+            else:
+                ids = [ graph.street_ids[street] for street in self.occupied ]
+            lengths[ids] = [ len(street.q) for street in self.occupied ]
+        return lengths
+
+    def streets_of(self, ids):
+        '''The streets with the given ids in compact_graph().'''
+
+        if self.graph is not None:
+            return [ StreetView(self.graph, int(street)) for street in ids ]
+        streets = self.compact_graph().streets
+        return [ streets[street] for street in ids ]
+
+    def build_contraction_hierarchy(self, path=None):
+        '''Preprocesses the network into a ContractionHierarchy, which
+        shortest_path then uses until the network changes. If a path
+        is given and the file there holds a hierarchy of this network
+        as it is now, it is loaded instead of built; otherwise the new
+        hierarchy is saved there.'''
+
+        graph = self.compact_graph()
+        hierarchy = None
+        if path is not None and os.path.exists(path):
+            hierarchy = routing.ContractionHierarchy.load(path)
+            if not hierarchy.fits(graph):
+                hierarchy = None
+        if hierarchy is None:
+            hierarchy = routing.ContractionHierarchy.build(graph)
+            if path is not None:
+                hierarchy.save(path)
+
+        self.hierarchy = hierarchy
+        self._hierarchy_revision = self.revision
+        return hierarchy
+
+    def has_current_hierarchy(self):
+        '''Whether the network has a contraction hierarchy and has not
+        changed since it was built.'''
+
+        return (self.hierarchy is not None
+                and self._hierarchy_revision == self.revision)
+
+    def shortest_path_tree(self, source):
+        '''Returns the ShortestPathTree of the source intersection,
+        or of the intersection with that id, from the route cache if
+        it is there.'''
+
+        if not isinstance(source, (int, np.integer)):
+            source = self.intersection_id(source)
+        tree = self.routes.get(source, self.revision)
+        if tree is None:
+            tree = routing.ShortestPathTree.search(self.compact_graph(),
+                                                   source)
+            self.routes.put(tree, self.revision)
+        return tree
+
+    def shortest_paths_from(self, source, destinations):
+        '''Computes the shortest paths from the source to each of the
+        destinations with a single search, whose tree is cached.
+        Returns a list of paths in the order of the destinations.'''
+
+        tree = self.shortest_path_tree(source)
+        tail = self.compact_graph().tail
+        paths = []
+        for destination in destinations:
+            path = tree.path(self.intersection_id(destination), tail)
+            if path == []:
+                raise DisconnectedPathError(
+                    'There is no path whatsoever from {} to {}.'
+                    .format(source, destination))
+            paths.append(self.streets_of(path))
+        return paths
+
+    def plan_routes(self, od_pairs, workers=None, algorithm=None):
+        '''Computes the shortest paths between many (source,
+        destination) pairs of intersections in a pool of worker
+        processes that share the network's CompactGraph; see
+        routing.plan_routes. The algorithm defaults as in
+        shortest_path, except that contraction hierarchies are not
+        used. Returns an array of street ids for every pair, which is
+        empty if there is no path; streets_of turns it into a path
+        for a Car.'''
+
+        graph = self.compact_graph()
+        if algorithm is None:
+            algorithm = 'dijkstra' if graph.coordinates is None else 'astar'
+        pairs = [ (self.intersection_id(source),
+                   self.intersection_id(destination))
+                  for source, destination in od_pairs ]
+        return routing.plan_routes(graph, pairs, workers, algorithm)
+
+    def spawn_from_od_matrix(self, matrix, departure_times=None,
+                             population=None, cells=False, workers=None):
+        '''Creates the trips of an origin-destination matrix as cars
+        of a CarPopulation of the network, a new one unless one is
+        given, and returns the population. The matrix holds the number
+        of trips between every pair of intersections, either as a
+        square array indexed by intersection id, or by lattice cell in
+        row-major order if cells is true, or as a dict from (origin,
+        destination) pairs of intersections or their ids to counts,
+        such as random_od_matrix makes. Trips from an intersection to
+        itself are ignored. The trips are routed with
+        routing.plan_routes, in workers processes (by default one per
+        CPU), with a single search from each origin, shared by all of
+        its destinations and stopped once they are all reached, which
+        is not cached; the trips are then added in bulk. They are
+        numbered in the order of the matrix, or of
+        the ids of their pairs for a dict. All of them enter the
+        network at once, unless departure_times gives the departure
+        tick of every trip, or one tick for them all.'''
+
+        from population import CarPopulation
+
+        origins, destinations, counts = self._od_pairs(matrix, cells)
+        graph = self.compact_graph()
+        algorithm = 'dijkstra' if graph.coordinates is None else 'astar'
+        paths = routing.plan_routes(graph, np.stack([origins, destinations],
+                                                    axis=1),
+                                    workers, algorithm)
+        for origin, destination, path in zip(origins.tolist(),
+                                             destinations.tolist(), paths):
+            if len(path) == 0:
+                raise DisconnectedPathError(
+                    'There is no path whatsoever from intersection {}'
+                    ' to intersection {}.'.format(origin, destination))
+
+        trips = [ path for path, count in zip(paths, counts.tolist())
+                  for _ in range(count) ]
+        if departure_times is not None:
+            departure_times = np.broadcast_to(
+                np.asarray(departure_times, dtype=np.int64), (len(trips),))
+        if population is None:
+            population = CarPopulation(self, capacity=max(len(trips), 1))
+        population.add_paths(trips, departures=departure_times)
+        return population
+
+    def _od_pairs(self, matrix, cells):
+        # Returns the origin and destination ids and the counts of the
+        # pairs with trips, in the order of the matrix.
+        if isinstance(matrix, dict):
+            def node(intersection):
+                if isinstance(intersection, (int, np.integer)):
+                    return int(intersection)
+                return self.intersection_id(intersection)
+            pairs = sorted((node(origin), node(destination), count)
+                           for (origin, destination), count
+                           in matrix.items())
+            origins, destinations, counts = np.array(
+                pairs, dtype=np.int64).reshape(-1, 3).T
+        else:
+            matrix = np.asarray(matrix)
+            origins, destinations = np.nonzero(matrix)
+            counts = matrix[origins, destinations].astype(np.int64)
+            if cells:
+                ids = self.lattice_ids()[0].ravel()
+                origins = ids[origins]
+                destinations = ids[destinations]
+        trips = (origins != destinations) & (counts > 0)
+        return origins[trips], destinations[trips], counts[trips]
+
+    def random_od_matrix(self, n_trips, seed=None, weights=None):
+        '''Draws n_trips random trips between distinct intersections,
+        choosing origins and destinations independently with
+        probabilities proportional to weights, indexed by intersection
+        id, or uniformly. Returns them as a dict from (origin id,
+        destination id) to the number of trips, for
+        spawn_from_od_matrix.'''
+
+        rng = np.random.RandomState(seed)
+        n = self.compact_graph().n_intersections
+        p = None
+        if weights is not None:
+            p = np.asarray(weights, dtype=np.float64)
+            p = p / p.sum()
+        if n < 2 or (p is not None and np.count_nonzero(p) < 2):
+            raise ValueError('Trips need at least two possible'
+                             ' intersections.')
+
+        origins = rng.choice(n, n_trips, p=p)
+        destinations = rng.choice(n, n_trips, p=p)
+        same = origins == destinations
+        while same.any():
+            destinations[same] = rng.choice(n, int(same.sum()), p=p)
+            same = origins == destinations
+
+        pairs, counts = np.unique(origins * n + destinations,
+                                  return_counts=True)
+        return { (pair // n, pair % n): count for pair, count
+                 in zip(pairs.tolist(), counts.tolist()) }
+
+    def shortest_path(self, source, destination, algorithm=None):
+        '''Computes the shortest path in the network from the source
+        to the destination. Returns a path, which is just a list of
+        streets. The algorithm is 'dijkstra', 'astar', which needs a
+        lattice, 'bidirectional', or 'ch', which needs a contraction
+        hierarchy. By default it is 'ch' if the network has a current
+        contraction hierarchy, 'astar' for lattices, and 'dijkstra'
+        otherwise; 'ch' also falls back to those if the network has
+        changed since its hierarchy was built. All of them find a path
+        of the same length; 'dijkstra' and 'astar' find the same path,
+        but 'bidirectional' and 'ch' may break ties between equally
+        short paths differently. For 'dijkstra' and 'astar', if the
+        shortest path tree of the source is cached, the path is read
+        from it instead, which again gives the same path; the tree of
+        a source that is asked for repeatedly is computed and cached.'''
+
+        if self.metrics is not None:
+            start = time.perf_counter()
+        graph = self.compact_graph()
+        source_id = self.intersection_id(source)
+        destination_id = self.intersection_id(destination)
+        if algorithm is None or algorithm == 'ch':
+            if self.has_current_hierarchy():
+                algorithm = 'ch'
+            elif algorithm == 'ch' and self.hierarchy is None:
+                raise ValueError('The network has no contraction hierarchy.')
+            elif graph.coordinates is None:
+                algorithm = 'dijkstra'
+            else:
+                algorithm = 'astar'
+
+        tree = None
+        if algorithm in ('dijkstra', 'astar'):
+            tree = self.routes.get(source_id, self.revision)
+        if tree is not None:
+            path = tree.path(destination_id, graph.tail)
+            algorithm, expanded = 'cached', 0
+        elif (algorithm in ('dijkstra', 'astar')
+                and self.routes.repeated(source_id)):
+            tree = routing.ShortestPathTree.search(graph, source_id)
+            self.routes.put(tree, self.revision)
+            path = tree.path(destination_id, graph.tail)
+            algorithm = 'dijkstra'
+            expanded = int(np.count_nonzero(tree.distance < np.inf))
+        elif algorithm == 'ch':
+            path, expanded = self.hierarchy.query(source_id, destination_id)
+        else:
+            path, expanded = routing.route(graph, source_id, destination_id,
+                                           algorithm)
+        if self.metrics is not None:
+            self.metrics.routed(source_id, destination_id, algorithm,
+                                expanded, time.perf_counter() - start)
 
-    def shortest_path(self, source, destination):
-        '''Uses Dijkstra's algorithm to compute the shortest path in
-        the network from the source to the destination. Returns a
-        path, which is just a list of streets.'''
-        
-        # Initalize.
-        nodes = []
-        distance = dict()
-        previous_step = dict()
-        distance[source] = 0
-        for node in self.intersections:
-            if node != source:
-                distance[node] = float('inf')
-            previous_step[node] = None
-            nodes.append(node)
-        
-        # Label the nodes with the least total distance from the
-        # source as well as the previous step, i.e., the edge before
-        # it that gives that least distance.
-        while True:
-            node = min([ node for node in nodes ], key=distance.get)
-            if node == destination:
-                break
-            nodes.remove(node)
-            
-            for outstreet in node.outstreets:
-                neighbor = outstreet.head
-                alternative = distance[node] + outstreet.weight
-                if alternative < distance[neighbor]:
-                    distance[neighbor] = alternative
-                    previous_step[neighbor] = outstreet
-
-        # Backtrack from destination to source to build shortest path.
-        path = []
-        node = destination
-        while previous_step[node] is not None:
-            outstreet = previous_step[node]
-            path.insert(0, outstreet)
-            node = outstreet.tail
-        
         if path == []:
             raise DisconnectedPathError(
                 'There is no path whatsoever from {} to {}.'
                 .format(source, destination))
 
-        return path
+        return self.streets_of(path)
         
 
+
 class Intersection:
     '''Intersections are the nodes in the graph. They know the streets
     that lead into the intersection (instreets) and streets that lead
@@ -191,8 +738,8 @@ class Intersection:
 
     def __init__(self, label=None):
         self.label = label
-        self.instreets = []
-        self.outstreets = []
+        self.instreets = StreetList()
+        self.outstreets = StreetList()
 
     def __str__(self):
         if self.label is None:
@@ -201,7 +748,7 @@ class Intersection:
                 self.__class__.__name__,
                 hex(id(self)))
         else:
-            return self.label
+            return str(self.label)
 
 
 
@@ -212,19 +759,45 @@ class Street:
     are its endpoints. Also, streets are never bi-directional; this is
     achieved instead by two antiparallel streets. Streets contain
     information about its lanes as well as the queue of cars waiting
-    at traffic lights.'''
-    
-    def __init__(self, tail, head, weight=1, label=None):
-        # Will eventually contain lane information.
+    at traffic lights. A street reports changes to its weight to the
+    networks whose streets it is in, so that anything computed from
+    them can tell when it is out of date.'''
+
+    def __init__(self, tail, head, weight=1, label=None, lanes=1):
+        self._networks = None
         self.tail = tail
         self.head = head
         self.weight = weight
         self.label = label
-        self.q = queue.Queue()
+        self.lanes = lanes
+        self.q = StreetQueue()
         
         tail.outstreets.append(self)
         head.instreets.append(self)
 
+    @property
+    def weight(self):
+        return self._weight
+
+    @weight.setter
+    def weight(self, weight):
+        self._weight = weight
+        for network in self._networks or ():
+            network = network()
+            if network is not None:
+                network.changed()
+
+    def _add_network(self, network):
+        # The networks are held weakly, so that a street does not keep
+        # the networks it was once in alive.
+        if self._networks is None:
+            self._networks = []
+        self._networks.append(weakref.ref(network))
+
+    def _remove_network(self, network):
+        self._networks = [ ref for ref in self._networks or ()
+                           if ref() is not None and ref() is not network ]
+
     def __str__(self):
         if self.label is None:
             return '<{}.{} object at {}>'.format(
@@ -236,47 +809,802 @@ class Street:
 
 
 
+class StreetQueue:
+    '''The queue of cars on a street. It has the non-blocking part of
+    the interface of queue.Queue, but without any locking, since cars
+    move one at a time. The cars are kept in a deque, which is
+    exposed as the queue attribute. If maxsize is positive, then the
+    queue holds at most maxsize cars.'''
+
+    __slots__ = ('queue', 'maxsize')
+
+    def __init__(self, maxsize=0):
+        self.queue = collections.deque()
+        self.maxsize = maxsize
+
+    def put(self, car):
+        '''Adds a car to the back of the queue. Raises queue.Full if
+        the queue is full.'''
+
+        if 0 < self.maxsize <= len(self.queue):
+            raise queue.Full
+        self.queue.append(car)
+
+    def get(self):
+        '''Removes and returns the car at the front of the queue.
+        Raises queue.Empty if the queue is empty.'''
+
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    def peek(self):
+        '''Returns the car at the front of the queue, or None if the
+        queue is empty.'''
+
+        return self.queue[0] if self.queue else None
+
+    def empty(self):
+        return not self.queue
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.queue)
+
+    def qsize(self):
+        return len(self.queue)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+
+
+class StreetList(collections.abc.Sequence):
+    '''A list of streets, such as those of a network or the instreets
+    of an intersection, that appends, removes, and tests membership in
+    constant time. Each street has a slot; removing it leaves a
+    tombstone in its slot, so that the street can be restored to the
+    same position, and the tombstones are only dropped, in one pass,
+    once they outnumber the streets. Reading by position from a list
+    with tombstones goes through a compacted copy, which is rebuilt
+    after every change. The streets of a network are a list owned by
+    it, which registers the network with the streets it holds and
+    tells it about every change, or every batch of changes.'''
+
+    def __init__(self, streets=(), owner=None):
+        self._slots = list(streets)
+        self._index = { street:i for i, street in enumerate(self._slots) }
+        self._removed = dict()
+        self._compacted = None
+        self._owner = owner
+        self._batched = None
+        if owner is not None:
+            for street in self._slots:
+                street._add_network(owner)
+
+    def append(self, street):
+        self._removed.pop(street, None)
+        self._index[street] = len(self._slots)
+        self._slots.append(street)
+        self._compacted = None
+        self._changed(street, True)
+
+    def extend(self, streets):
+        for street in streets:
+            self.append(street)
+
+    def remove(self, street):
+        '''Removes a street. Raises ValueError if it is not in the
+        list.'''
+
+        try:
+            slot = self._index.pop(street)
+        except KeyError:
+            raise ValueError('{} is not in the list.'.format(street))
+        self._slots[slot] = None
+        self._removed[street] = slot
+        self._compacted = None
+        self._changed(street, False)
+        if len(self._removed) > len(self._index):
+            self._compact()
+
+    def restore(self, street):
+        '''Puts a removed street back in its slot, or at the end if
+        the tombstones were dropped since.'''
+
+        slot = self._removed.pop(street, None)
+        if slot is None:
+            self.append(street)
+            return
+        self._slots[slot] = street
+        self._index[street] = slot
+        self._compacted = None
+        self._changed(street, True)
+
+    def _changed(self, street, added):
+        if self._owner is None:
+            return
+        if added:
+            street._add_network(self._owner)
+        else:
+            street._remove_network(self._owner)
+        if self._batched is None:
+            self._owner.changed()
+        else:
+            self._batched = True
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Tells the owner about the changes made in the with
+        statement only once, at its end.'''
+
+        self._batched = False
+        try:
+            yield
+        finally:
+            changed, self._batched = self._batched, None
+            if changed:
+                self._owner.changed()
+
+    def _compact(self):
+        self._slots = [ street for street in self._slots
+                        if street is not None ]
+        self._index = { street:i for i, street in enumerate(self._slots) }
+        self._removed.clear()
+
+    def _list(self):
+        if not self._removed:
+            return self._slots
+        if self._compacted is None:
+            self._compacted = [ street for street in self._slots
+                                if street is not None ]
+        return self._compacted
+
+    def __getitem__(self, index):
+        return self._list()[index]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._list())
+
+    def __contains__(self, street):
+        return street in self._index
+
+    def index(self, street):
+        if street not in self._index:
+            raise ValueError('{} is not in the list.'.format(street))
+        if not self._removed:
+            return self._index[street]
+        return self._list().index(street)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, StreetList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'StreetList({!r})'.format(list(self))
+
+
+
+class LatticeStreet(Street):
+    '''A street of a square lattice. Its label is generated from the
+    coordinates of its endpoints the first time it is needed.'''
+
+    @property
+    def label(self):
+        if self._label is None:
+            self._label = lattice_street_label(self.tail.label,
+                                               self.head.label)
+        return self._label
+
+    @label.setter
+    def label(self, label):
+        self._label = label
+
+
+
 class Car:
     '''Cars are the agents in the system. A car is contained only in
     the queues of streets. It knows its path (a path is sequence of
-    streets), which contains both its source and its destionation.
+    streets), which contains both its source and its destionation,
+    and a cursor, which is the position of its location in the path.
     It also knows the street network it belongs to.'''
 
     def __init__(self, path, network):
         self.location = path[0]
         self.path = path
+        self.cursor = 0
         self.network = network
 
         self.location.q.put(self)
         self.network.cars.append(self)
+        self.network.occupied[self.location] = None
+        if network.metrics is not None:
+            network.metrics.entered([self])
+        if network.recorder is not None:
+            network.recorder.entered([self])
+
+    @classmethod
+    def restore(cls, path, cursor, network):
+        '''Recreates a car part way along its path, registered with
+        the network but not yet in any street's queue.'''
+
+        car = cls.__new__(cls)
+        car.location = path[cursor]
+        car.path = path
+        car.cursor = cursor
+        car.network = network
+        network.cars.append(car)
+        return car
 
     def move(self):
         '''Cars move by dequeueing themselves from their current
         street and enqueueing themselves in the next street they want
-        to move to. Streets do not have to handle the dequeuing.
-        Assumes that a path does not contain the same street twice.'''
+        to move to. Streets do not have to handle the dequeuing.'''
 
         # Determine the next street to move to. If there are no more
         # streets to move to, then the car has reaches its destination
         # and leaves the system.
-        index = self.path.index(self.location) + 1
+        index = self.cursor + 1
         if index >= len(self.path):
-            self.location.q.get()
+            self._check_signal()
+            self._check_front()
+            self._leave()
             self.location = None
             self.network.cars.remove(self)
+            if self.network.metrics is not None:
+                self.network.metrics.arrived(self)
+            if self.network.recorder is not None:
+                self.network.recorder.arrived(self)
             return
         next_street = self.path[index]
         
         if next_street not in self.location.head.outstreets:
             raise DisconnectedPathError(
                 ('The car {} attempted to move from {} to {}, but'
-                 +'these streets were not joined by an intersection.')
+                 +' these streets were not joined by an intersection.')
                 .format(self, self.location, next_street))
-        if self != self.location.q.queue[0]:
-            raise NotAtFrontOfQueueError(
-                'The car {} could not leave the queue because it was'
-                +'not at the front of the queue.')
+        self._check_signal()
+        self._check_front()
+        if next_street.q.full():
+            raise StreetFullError(
+                'The car {} could not enter {} because it is full.'
+                .format(self, next_street))
 
-        self.location.q.get()
+        self._leave()
         next_street.q.put(self)
+        self.network.occupied[next_street] = None
         self.location = next_street
+        self.cursor = index
+        if self.network.recorder is not None:
+            self.network.recorder.moved(self,
+                                        self.network.street_id(next_street))
+
+    def reroute(self, path):
+        '''Replaces the rest of the car's path, after the street it is
+        on, with another path from the head of that street.'''
+
+        self.path = self.path[:self.cursor+1] + list(path)
+
+    def next_street(self):
+        '''The street the car will move to next, or None if it will
+        leave the network.'''
+
+        index = self.cursor + 1
+        return self.path[index] if index < len(self.path) else None
+
+    def _check_signal(self):
+        signals = self.network.signals
+        if signals is not None and not signals.is_green(self.location):
+            raise RedLightError(
+                'The car {} could not leave {} because its light is'
+                ' red.'.format(self, self.location))
+
+    def _check_front(self):
+        if self is not self.location.q.peek():
+            raise NotAtFrontOfQueueError(
+                'The car {} could not leave the queue because it was'
+                ' not at the front of the queue.'.format(self))
+
+    def _leave(self):
+        q = self.location.q
+        q.get()
+        if q.empty():
+            del self.network.occupied[self.location]
+
+
+
+class CarRegistry:
+    '''The cars of a street network, in the order in which they were
+    added. It behaves like a list of cars, except that removing a car
+    takes constant time.'''
+
+    def __init__(self, cars=()):
+        self._cars = dict.fromkeys(cars)
+
+    def append(self, car):
+        self._cars[car] = None
+
+    def extend(self, cars):
+        self._cars.update(dict.fromkeys(cars))
+
+    def remove(self, car):
+        try:
+            del self._cars[car]
+        except KeyError:
+            raise ValueError('{} is not in the street network.'.format(car))
+
+    def __contains__(self, car):
+        return car in self._cars
+
+    def __iter__(self):
+        return iter(self._cars)
+
+    def __len__(self):
+        return len(self._cars)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+
+class CompactGraph:
+    '''An array-backed digraph that stores a street network without
+    any per-street or per-intersection Python objects. Intersections
+    and streets are integer ids. Street s goes from intersection
+    tail[s] to intersection head[s] with weight weight[s]. Adjacency
+    is stored in CSR form: the streets leaving intersection n are
+    out_streets[out_offsets[n]:out_offsets[n+1]], and likewise for
+    in_streets and in_offsets. Labels are either sequences indexed by
+    id or functions of the id, so they can be generated lazily. Street
+    queues are created only for streets that are actually used. The
+    number of lanes of every street is in lanes, or None if they all
+    have one, and the capacity of their queues in capacity, or None if
+    they are unbounded. revision counts the changes to the weights.'''
+
+    def __init__(self, n_intersections, tail, head, weight,
+                 out_streets=None, in_streets=None,
+                 intersection_labels=None, street_labels=None,
+                 out_offsets=None, in_offsets=None):
+        '''Construct the graph from the tail, head, and weight of
+        every street. The order of streets within an intersection's
+        out_streets and in_streets can be given as permutations of the
+        street ids grouped by tail and head respectively; by default
+        streets are ordered by id. Offsets are computed unless they
+        are given.'''
+
+        self.n_intersections = n_intersections
+        self.tail = np.asarray(tail, dtype=np.int32)
+        self.head = np.asarray(head, dtype=np.int32)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.n_streets = len(self.tail)
+
+        if out_streets is None:
+            out_streets = np.argsort(self.tail, kind='stable')
+        if in_streets is None:
+            in_streets = np.argsort(self.head, kind='stable')
+        self.out_streets = np.asarray(out_streets, dtype=np.int32)
+        self.in_streets = np.asarray(in_streets, dtype=np.int32)
+        self.out_offsets = (self._offsets(self.tail) if out_offsets is None
+                            else out_offsets)
+        self.in_offsets = (self._offsets(self.head) if in_offsets is None
+                           else in_offsets)
+
+        self.intersection_labels = intersection_labels
+        self.street_labels = street_labels
+        self.queues = dict()
+        self.lanes = None
+        self.capacity = None
+        self.coordinates = None
+        self.lattice_width = None
+        self.revision = 0
+        self._out_arrays = None
+        self._in_arrays = None
+        self._adjacency_lists = None
+        self._out_lists = None
+        self._manhattan_scale = None
+
+        # The objects of the network this graph was built from, if
+        # any, and their ids.
+        self.intersections = None
+        self.streets = None
+        self.intersection_ids = None
+        self.street_ids = None
+
+    def _offsets(self, endpoints):
+        offsets = np.zeros(self.n_intersections + 1, dtype=np.int64)
+        np.cumsum(np.bincount(endpoints, minlength=self.n_intersections),
+                  out=offsets[1:])
+        return offsets
+
+    @classmethod
+    def from_network(cls, network):
+        '''Construct the graph of an object-based StreetNetwork. Ids
+        are positions in network.intersections and network.streets,
+        and each intersection keeps the order of its instreets and
+        outstreets. Streets that are not in network.streets are
+        ignored.'''
+
+        position = { node:i for i, node in enumerate(network.intersections) }
+        street_position = { street:i
+                            for i, street in enumerate(network.streets) }
+        streets = network.streets
+        n = len(streets)
+
+        tail = np.fromiter((position[street.tail] for street in streets),
+                           dtype=np.int32, count=n)
+        head = np.fromiter((position[street.head] for street in streets),
+                           dtype=np.int32, count=n)
+        weight = np.fromiter((street.weight for street in streets),
+                             dtype=np.float64, count=n)
+        out_streets = np.fromiter((street_position[street]
+                                   for node in network.intersections
+                                   for street in node.outstreets
+                                   if street in street_position),
+                                  dtype=np.int32, count=n)
+        in_streets = np.fromiter((street_position[street]
+                                  for node in network.intersections
+                                  for street in node.instreets
+                                  if street in street_position),
+                                 dtype=np.int32, count=n)
+
+        # The labels are read from the objects when they are needed,
+        # so that lazy labels stay lazy.
+        intersections = list(network.intersections)
+        streets = list(streets)
+        graph = cls(len(intersections), tail, head, weight,
+                    out_streets, in_streets,
+                    lambda node: intersections[node].label,
+                    lambda street: streets[street].label)
+        lanes = np.fromiter((street.lanes for street in streets),
+                            dtype=np.int32, count=n)
+        if (lanes != 1).any():
+            graph.lanes = lanes
+        graph.intersections = intersections
+        graph.streets = streets
+        graph.intersection_ids = position
+        graph.street_ids = street_position
+        if network.lattice is not None:
+            graph.set_lattice([ [ position[node] for node in row ]
+                                for row in network.lattice ])
+        return graph
+
+    def save(self, path, labels=True, extra_arrays=None):
+        '''Writes the graph to the directory at path, which is created
+        if needed: a header.json file and a .npy file for each of
+        tail, head, weight, out_streets, in_streets, their offsets,
+        the coordinates and lanes if there are any, and any extra
+        arrays. If labels is true, then the labels are written to
+        labels.json, which needs them to be JSON values or tuples.'''
+
+        os.makedirs(path, exist_ok=True)
+        arrays = { 'tail':self.tail, 'head':self.head,
+                   'weight':self.weight, 'out_streets':self.out_streets,
+                   'in_streets':self.in_streets,
+                   'out_offsets':self.out_offsets,
+                   'in_offsets':self.in_offsets }
+        if self.coordinates is not None:
+            arrays['coordinates'] = self.coordinates
+        if self.lanes is not None:
+            arrays['lanes'] = self.lanes
+        arrays.update(extra_arrays or dict())
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+        header = { 'format':STORAGE_FORMAT,
+                   'n_intersections':self.n_intersections,
+                   'n_streets':self.n_streets,
+                   'arrays':sorted(arrays),
+                   'labels':bool(labels),
+                   'lattice_width':self.lattice_width }
+        if labels:
+            with open(os.path.join(path, 'labels.json'), 'w') as f:
+                json.dump({ 'intersections':[ self.intersection_label(node)
+                                              for node in
+                                              range(self.n_intersections) ],
+                            'streets':[ self.street_label(street)
+                                        for street in
+                                        range(self.n_streets) ] }, f)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        '''Opens a graph written by save, memory-mapping its arrays
+        with the given mmap_mode (None reads them into memory).
+        Returns the graph and a dict of the extra arrays.'''
+
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header.get('format') != STORAGE_FORMAT:
+            raise ValueError('{} is not a street network saved in format {}.'
+                             .format(path, STORAGE_FORMAT))
+
+        arrays = { name:np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode=mmap_mode)
+                   for name in header['arrays'] }
+        intersection_labels = street_labels = None
+        if header['labels']:
+            with open(os.path.join(path, 'labels.json')) as f:
+                labels = json.load(f)
+            intersection_labels = [ _label_from_json(label)
+                                    for label in labels['intersections'] ]
+            street_labels = [ _label_from_json(label)
+                              for label in labels['streets'] ]
+
+        graph = cls(header['n_intersections'],
+                    arrays.pop('tail'), arrays.pop('head'),
+                    arrays.pop('weight'), arrays.pop('out_streets'),
+                    arrays.pop('in_streets'),
+                    intersection_labels, street_labels,
+                    arrays.pop('out_offsets'), arrays.pop('in_offsets'))
+        graph.coordinates = arrays.pop('coordinates', None)
+        graph.lanes = arrays.pop('lanes', None)
+        graph.lattice_width = header['lattice_width']
+        return graph, arrays
+
+    @property
+    def nbytes(self):
+        '''The memory used by the graph's arrays.'''
+
+        return sum(array.nbytes for array in (
+            self.tail, self.head, self.weight,
+            self.out_streets, self.in_streets,
+            self.out_offsets, self.in_offsets))
+
+    def out_arrays(self):
+        '''Returns out_streets together with the head and the weight
+        of each of those streets, so that a search can read all of an
+        intersection's neighbors from one contiguous slice.'''
+
+        if self._out_arrays is None:
+            self._out_arrays = (self.out_streets,
+                                self.head[self.out_streets],
+                                self.weight[self.out_streets])
+        return self._out_arrays
+
+    def in_arrays(self):
+        '''Returns in_streets together with the tail and the weight
+        of each of those streets.'''
+
+        if self._in_arrays is None:
+            self._in_arrays = (self.in_streets,
+                               self.tail[self.in_streets],
+                               self.weight[self.in_streets])
+        return self._in_arrays
+
+    def adjacency_lists(self):
+        '''Returns the tail and head of every street, and the offsets
+        and street ids of the outstreets and instreets of every
+        intersection, as lists, which are much faster to index one at
+        a time than arrays. They do not depend on the weights.'''
+
+        if self._adjacency_lists is None:
+            self._adjacency_lists = tuple(
+                array.tolist() for array in (self.tail, self.head,
+                                             self.out_offsets,
+                                             self.out_streets,
+                                             self.in_offsets,
+                                             self.in_streets))
+        return self._adjacency_lists
+
+    def out_lists(self):
+        '''Returns, for every intersection, a list of the (street id,
+        head, weight) of its outstreets, which is the fastest layout
+        for a search in Python to read them from.'''
+
+        if self._out_lists is None:
+            out_streets, out_head, out_weight = self.out_arrays()
+            offsets = self.out_offsets.tolist()
+            entries = list(zip(out_streets.tolist(), out_head.tolist(),
+                               out_weight.tolist()))
+            self._out_lists = [ entries[start:stop] for start, stop
+                                in zip(offsets[:-1], offsets[1:]) ]
+        return self._out_lists
+
+    def set_weights(self, streets, weights):
+        '''Sets the weights of the given street ids, which changes the
+        revision of the graph and of its network.'''
+
+        self.weight[streets] = weights
+        self._out_arrays = None
+        self._out_lists = None
+        self._in_arrays = None
+        self._manhattan_scale = None
+        self.revision += 1
+
+    def set_lattice(self, lattice):
+        '''Records the (row, column) coordinates of the intersections
+        from a 2d array of their ids. If the lattice does not cover
+        every intersection, then the graph has no coordinates.'''
+
+        lattice = np.asarray(lattice, dtype=np.int64)
+        self.lattice_width = None
+        if lattice.size != self.n_intersections:
+            self.coordinates = None
+            return
+        if np.array_equal(lattice.ravel(), np.arange(lattice.size)):
+            self.lattice_width = lattice.shape[1]
+        rows, columns = np.indices(lattice.shape)
+        self.coordinates = np.empty((self.n_intersections, 2),
+                                    dtype=np.int64)
+        self.coordinates[lattice.ravel(), 0] = rows.ravel()
+        self.coordinates[lattice.ravel(), 1] = columns.ravel()
+        self._manhattan_scale = None
+
+    def manhattan_scale(self):
+        '''The largest factor by which the Manhattan distance between
+        the coordinates of two intersections can be multiplied and
+        still never exceed the length of a path between them, i.e.,
+        the least weight per unit of Manhattan distance of any
+        street.'''
+
+        if self._manhattan_scale is None:
+            span = np.abs(self.coordinates[self.head]
+                          - self.coordinates[self.tail]).sum(axis=1)
+            moves = span > 0
+            if moves.any():
+                scale = (self.weight[moves] / span[moves]).min()
+            else:
+                scale = 0.0
+            self._manhattan_scale = max(float(scale), 0.0)
+        return self._manhattan_scale
+
+    def outstreet_ids(self, node):
+        return self.out_streets[self.out_offsets[node]:
+                                self.out_offsets[node+1]]
+
+    def instreet_ids(self, node):
+        return self.in_streets[self.in_offsets[node]:
+                               self.in_offsets[node+1]]
+
+    def intersection_label(self, node):
+        return self._label(self.intersection_labels, node)
+
+    def street_label(self, street):
+        return self._label(self.street_labels, street)
+
+    def _label(self, labels, i):
+        if labels is None:
+            return None
+        elif callable(labels):
+            return labels(i)
+        else:
+            return labels[i]
+
+    def queue(self, street):
+        '''Returns the queue of a street, creating it on first use.'''
+
+        q = self.queues.get(street)
+        if q is None:
+            maxsize = 0 if self.capacity is None else int(self.capacity[street])
+            q = self.queues[street] = StreetQueue(maxsize)
+        return q
+
+
+
+def _label_from_json(label):
+    # JSON has no tuples, so lattice coordinates come back as lists.
+    return tuple(label) if isinstance(label, list) else label
+
+
+
+class IntersectionView(Intersection):
+    '''An Intersection of a compact StreetNetwork. It only holds its
+    graph and its id; everything else is read from the graph.'''
+
+    __slots__ = ('graph', 'id')
+
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
+
+    @property
+    def label(self):
+        return self.graph.intersection_label(self.id)
+
+    @property
+    def instreets(self):
+        return [ StreetView(self.graph, street)
+                 for street in self.graph.instreet_ids(self.id).tolist() ]
+
+    @property
+    def outstreets(self):
+        return [ StreetView(self.graph, street)
+                 for street in self.graph.outstreet_ids(self.id).tolist() ]
+
+    def __eq__(self, other):
+        if not isinstance(other, IntersectionView):
+            return NotImplemented
+        return self.graph is other.graph and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.graph), self.id))
+
+
+
+class StreetView(Street):
+    '''A Street of a compact StreetNetwork. It only holds its graph
+    and its id; everything else is read from the graph.'''
+
+    __slots__ = ('graph', 'id')
+
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
+
+    @property
+    def tail(self):
+        return IntersectionView(self.graph, int(self.graph.tail[self.id]))
+
+    @property
+    def head(self):
+        return IntersectionView(self.graph, int(self.graph.head[self.id]))
+
+    @property
+    def weight(self):
+        return float(self.graph.weight[self.id])
+
+    @weight.setter
+    def weight(self, weight):
+        self.graph.set_weights(self.id, weight)
+
+    @property
+    def label(self):
+        return self.graph.street_label(self.id)
+
+    @property
+    def lanes(self):
+        if self.graph.lanes is None:
+            return 1
+        return int(self.graph.lanes[self.id])
+
+    @property
+    def q(self):
+        return self.graph.queue(self.id)
+
+    def __eq__(self, other):
+        if not isinstance(other, StreetView):
+            return NotImplemented
+        return self.graph is other.graph and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.graph), self.id))
+
+
+
+class ViewSequence:
+    '''A read-only sequence of intersection or street views, given
+    by their ids, that creates each view on demand.'''
+
+    def __init__(self, graph, view, ids):
+        self.graph = graph
+        self.view = view
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ViewSequence(self.graph, self.view, self.ids[i])
+        return self.view(self.graph, int(self.ids[i]))
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.view(self.graph, int(i))
+
+    def __contains__(self, item):
+        return (isinstance(item, self.view) and item.graph is self.graph
+                and item.id in self.ids)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
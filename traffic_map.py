@@ -1,5 +1,6 @@
+import time
 from traffic_components import *
-from PIL import Image, ImageDraw
+from PIL import GifImagePlugin, Image
 
 
 
@@ -8,32 +9,214 @@ class CannotMapError(Exception): pass
 
 
 class TrafficMap:
+    '''Renders a square lattice StreetNetwork as an image, without a
+    display. Every street is drawn as one lane of its road, on the
+    right-hand side in its direction of travel, and is colored by how
+    many cars are queued on it: light gray when it is empty, then from
+    green to red as its queue approaches jam_length cars (or its
+    maxsize, if it has one). The pixels of every street are worked out
+    once, so each frame is painted with a few array operations.'''
 
-    def __init__(self, network):
+    # Palette entries: background, intersections, empty streets, and
+    # then the congestion gradient from green through yellow to red.
+    levels = 16
+    palette = np.array(
+        [ (255, 255, 255), (90, 90, 90), (200, 200, 200) ]
+        + [ (int(min(1, 2 * x) * 230), int(min(1, 2 * (1 - x)) * 200), 0)
+            for x in np.linspace(0, 1, levels) ],
+        dtype=np.uint8)
+
+    def __init__(self, network, width=600, height=600, padding=20,
+                 street_width=10, jam_length=10):
         if network.lattice is None:
             raise CannotMapError(
                 'The StreetNetwork given is not a square lattice.')
         else:
             self.network = network
 
-    def draw(self):
-        width = 600
-        height = 600
-        padding = 20
-        street_width = 10
+        self.width = width
+        self.height = height
+        self.padding = padding
+        self.street_width = street_width
+        self.jam_length = jam_length
+
+        rows = len(network.lattice)
+        columns = len(network.lattice[0])
+        block_width = int(( width - 2*padding - street_width * columns)
+                          / max(columns - 1, 1))
+        block_height = int(( height - 2*padding - street_width * rows)
+                           / max(rows - 1, 1))
+        if block_width < 1 or block_height < 1:
+            raise CannotMapError(
+                'A {}x{} lattice does not fit in a {}x{} image.'
+                .format(rows, columns, width, height))
+
+        # The top-left corner of every intersection's square.
+        graph = network.compact_graph()
+        coordinates = graph.coordinates
+        x = padding + coordinates[:,1] * (block_width + street_width)
+        y = padding + coordinates[:,0] * (block_height + street_width)
+
+        # Every street's lane is the half of the road between its
+        # endpoints on its right-hand side: e.g., an eastbound street
+        # takes the lower half of the road.
+        half = street_width // 2
+        tail_x, tail_y = x[graph.tail], y[graph.tail]
+        head_x, head_y = x[graph.head], y[graph.head]
+        horizontal = tail_y == head_y
+        left = np.where(horizontal, np.minimum(tail_x, head_x) + street_width,
+                        tail_x)
+        right = np.where(horizontal, np.maximum(tail_x, head_x),
+                         tail_x + street_width)
+        top = np.where(horizontal, tail_y,
+                       np.minimum(tail_y, head_y) + street_width)
+        bottom = np.where(horizontal, tail_y + street_width,
+                          np.maximum(tail_y, head_y))
+        eastbound = horizontal & (head_x > tail_x)
+        westbound = horizontal & (head_x < tail_x)
+        southbound = ~horizontal & (head_y > tail_y)
+        northbound = ~horizontal & (head_y < tail_y)
+        top = np.where(eastbound, top + half, top)
+        bottom = np.where(westbound, bottom - half, bottom)
+        right = np.where(southbound, right - half, right)
+        left = np.where(northbound, left + half, left)
+
+        self.street_pixels, self.pixel_streets = self._rectangles(
+            left, top, right, bottom)
+        self.intersection_pixels, _ = self._rectangles(
+            x, y, x + street_width, y + street_width)
+
+    def _rectangles(self, left, top, right, bottom):
+        '''Returns the flat indices of the pixels inside the given
+        rectangles, and the rectangle each of them belongs to.'''
+
+        widths = np.maximum(right - left, 0)
+        heights = np.maximum(bottom - top, 0)
+        counts = widths * heights
+        owners = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)
+                                                      - counts, counts)
+        widths = np.maximum(widths, 1)
+        xs = left[owners] + offsets % widths[owners]
+        ys = top[owners] + offsets // widths[owners]
+        return ys * self.width + xs, owners
+
+    def colors(self):
+        '''The palette entry of every street, from its queue length.'''
+
+        lengths = self.network.queue_lengths()
+        capacity = np.full(len(lengths), self.jam_length, dtype=np.float64)
+        for street in self.network.occupied:
+            if street.q.maxsize > 0:
+                capacity[self.network.street_id(street)] = street.q.maxsize
+        level = np.ceil(np.minimum(lengths / capacity, 1) * self.levels)
+        return np.where(lengths > 0, 2 + level.astype(np.int64), 2)
+
+    def render_indexed(self):
+        '''Renders the network as a 2d array of palette entries.'''
+
+        start = time.perf_counter()
+        image = np.zeros(self.height * self.width, dtype=np.uint8)
+        image[self.intersection_pixels] = 1
+        image[self.street_pixels] = self.colors()[self.pixel_streets]
+        if self.network.metrics is not None:
+            self.network.metrics.add_time('rendering',
+                                          time.perf_counter() - start)
+        return image.reshape(self.height, self.width)
+
+    def render(self):
+        '''Renders the network as an RGB PIL image.'''
 
-        block_width = int(( width - 2*padding
-                            - street_width * len(self.network.lattice[0]))
-                          / (len(self.network.lattice[0])) - 1)
-        block_height = int(( height - 2*padding
-                             - street_width * len(self.network.lattice))
-                           / (len(self.network.lattice)) - 1)
-        
-        img = Image.new('RGB', (width, height), 'white')
+        return Image.fromarray(self.palette[self.render_indexed()], 'RGB')
 
-        draw = ImageDraw.Draw(img)
-        draw.line((0,0)+(width, height), fill=128)
+    def draw(self, show=False):
+        '''Renders the network and returns the image, also showing it
+        in an image viewer if show is true.'''
+
+        img = self.render()
+        if show:
+            img.show()
+        return img
+
+    def record(self, simulation, n_ticks, path, fps=10):
+        '''Records a frame of the simulation's network before every one
+        of n_ticks ticks and after the last one; see FrameWriter.'''
+
+        with FrameWriter(self, path, fps) as writer:
+            writer.write()
+            for _ in range(n_ticks):
+                simulation.step()
+                simulation.synchronize()
+                writer.write()
+
+
+
+class FrameWriter:
+    '''Writes frames of a TrafficMap as they are rendered. If the path
+    contains a '{}' field, then every frame is written to its own PNG
+    file, numbered from 0, and nothing is kept in memory. GIF files
+    are streamed too, one frame at a time, with Pillow's GIF encoder
+    and the map's palette as their global color table. MP4 files need
+    the optional imageio package with its ffmpeg plugin, and are
+    streamed.'''
+
+    def __init__(self, traffic_map, path, fps=10):
+        self.traffic_map = traffic_map
+        self.path = path
+        self.fps = fps
+        self.frames = 0
+        self._gif = None
+        self._video = None
+
+        if '{}' in path:
+            pass
+        elif path.endswith('.gif'):
+            self._gif = open(path, 'wb')
+        elif path.endswith('.mp4'):
+            try:
+                import imageio
+            except ImportError:
+                raise CannotMapError(
+                    'Writing MP4 files needs the imageio package.')
+            self._video = imageio.get_writer(path, fps=fps)
+        else:
+            raise CannotMapError(
+                'Cannot write frames to {}; use a PNG pattern with a {{}}'
+                ' field, a .gif file, or an .mp4 file.'.format(path))
+
+    def write(self):
+        '''Renders the current state of the network as the next
+        frame.'''
+
+        if self._gif is not None:
+            frame = Image.fromarray(self.traffic_map.render_indexed(), 'P')
+            frame.putpalette(self.traffic_map.palette.ravel().tolist())
+            duration = int(1000 / self.fps)
+            if self.frames == 0:
+                header, _ = GifImagePlugin.getheader(
+                    frame, info={ 'loop':0, 'duration':duration })
+                self._gif.write(b''.join(header))
+            self._gif.write(b''.join(GifImagePlugin.getdata(
+                frame, duration=duration)))
+        elif self._video is not None:
+            self._video.append_data(
+                self.traffic_map.palette[self.traffic_map.render_indexed()])
+        else:
+            self.traffic_map.render().save(self.path.format(self.frames))
+        self.frames += 1
 
-        img.show()
+    def close(self):
+        if self._gif is not None:
+            # The trailer that ends a GIF file.
+            self._gif.write(b';')
+            self._gif.close()
+            self._gif = None
+        if self._video is not None:
+            self._video.close()
+            self._video = None
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()